@@ -95,6 +95,46 @@ final class APIClient {
         let _: Ok = try await send(req)
     }
 
+    // MARK: - Live updates
+    /// One WebSocket carrying state changes of all of the user's downloads.
+    /// Pass the last seen `epoch`/`seq` to resume after a reconnect.
+    func liveUpdates(token: String, epoch: String? = nil, cursor: Int? = nil) -> AsyncThrowingStream<LiveEvent, Error> {
+        var comps = URLComponents(url: API_BASE.appendingPathComponent("ws"), resolvingAgainstBaseURL: false)!
+        comps.scheme = (API_BASE.scheme == "https") ? "wss" : "ws"
+        if let cursor {
+            comps.queryItems = [URLQueryItem(name: "cursor", value: String(cursor)),
+                                URLQueryItem(name: "epoch", value: epoch ?? "")]
+        }
+        var req = URLRequest(url: comps.url!)
+        req.setValue("Bearer \(token)", forHTTPHeaderField: "Authorization")
+        let task = urlSession.webSocketTask(with: req)
+
+        return AsyncThrowingStream { continuation in
+            continuation.onTermination = { _ in task.cancel(with: .goingAway, reason: nil) }
+            func receive() {
+                task.receive { result in
+                    switch result {
+                    case .failure(let error):
+                        continuation.finish(throwing: error)
+                    case .success(let message):
+                        var data: Data?
+                        switch message {
+                        case .string(let s): data = s.data(using: .utf8)
+                        case .data(let d): data = d
+                        @unknown default: data = nil
+                        }
+                        if let data, let ev = try? JSONDecoder().decode(LiveEvent.self, from: data) {
+                            continuation.yield(ev)
+                        }
+                        receive()
+                    }
+                }
+            }
+            task.resume()
+            receive()
+        }
+    }
+
     // MARK: - File download
     func downloadURL(fileId: String, token: String) -> URL {
         let tokenQS = token.addingPercentEncoding(withAllowedCharacters: .urlQueryAllowed) ?? token
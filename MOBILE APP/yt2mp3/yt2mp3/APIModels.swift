@@ -26,7 +26,19 @@ struct MeResponse: Decodable { let user: String; let is_admin: Bool }
 
 struct VideoRequest: Encodable { let url: String }
 struct StatusResponse: Decodable { let ready: Bool }
-struct DownloadStartResponse: Decodable { let file_id: String; let filename: String }
+struct DownloadStartResponse: Decodable { let file_id: String; let filename: String?; let status: String? }
+
+// One message from the /ws live-updates socket ("hello" | "progress" | "created" | "deleted" | "evicted" | "resync" | "ping")
+struct LiveEvent: Decodable {
+    let type: String
+    let seq: Int?
+    let epoch: String?
+    let cursor: Int?
+    let file_id: String?
+    let status: String?
+    let stage: String?
+    let percent: Double?
+}
 
 struct VideoItem: Decodable, Identifiable {
     let id: String
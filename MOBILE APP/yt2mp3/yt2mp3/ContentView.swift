@@ -163,7 +163,7 @@ struct ContentView: View {
                                             lastFilename = res.filename
                                             yt = ""
                                             statusText = ""
-                                            okText = "Link converted."
+                                            okText = "Queued for conversion."
                                             await refreshDownloads()
                                         } catch {
                                             statusText = error.localizedDescription
@@ -331,6 +331,7 @@ struct ContentView: View {
         .onAppear {
             UINavigationBar.appearance().largeTitleTextAttributes = [.foregroundColor: UIColor.white]
         }
+        .task(id: token) { await runLiveUpdates() }
         .alert("Admin must use the PC to log in", isPresented: $showAdminAlert) {
             Button("OK", role: .cancel) { }
         } message: {
@@ -373,6 +374,49 @@ struct ContentView: View {
         }
     }
     
+    /// Keeps the /ws socket open while logged in and applies its events; reconnects with backoff.
+    @MainActor
+    private func runLiveUpdates() async {
+        var epoch: String? = nil
+        var cursor: Int? = nil
+        var retry = 0
+        while let token, !Task.isCancelled {
+            do {
+                for try await ev in APIClient.shared.liveUpdates(token: token, epoch: epoch, cursor: cursor) {
+                    retry = 0
+                    if ev.type == "hello" {
+                        if epoch != ev.epoch || cursor == nil { epoch = ev.epoch; cursor = ev.cursor }
+                        continue
+                    }
+                    if let seq = ev.seq { cursor = max(cursor ?? 0, seq) }
+                    switch ev.type {
+                    case "progress":
+                        guard let id = ev.file_id else { break }
+                        if ev.status == "ready" || ev.status == "error" {
+                            flashMessage(for: id, ev.status == "ready" ? "Ready" : "Failed")
+                            await refreshDownloads()
+                        } else if ev.stage == "downloading", let p = ev.percent {
+                            itemMessages[id] = "Downloading \(Int(p))%"
+                        } else if let stage = ev.stage {
+                            itemMessages[id] = stage.capitalized
+                        }
+                    case "resync":
+                        cursor = ev.cursor
+                        await refreshDownloads()
+                    case "created", "deleted", "evicted":
+                        await refreshDownloads()
+                    default:
+                        break
+                    }
+                }
+            } catch {
+                print("live updates dropped:", error)
+            }
+            retry += 1
+            try? await Task.sleep(nanoseconds: UInt64(min(30, 1 << min(retry, 5))) * 1_000_000_000)
+        }
+    }
+
     @MainActor
     private func flashMessage(for id: String, _ text: String) {
         itemMessages[id] = text
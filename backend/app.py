@@ -1,12 +1,19 @@
-import os, glob, uuid, secrets, tempfile, subprocess, stat, shutil, string
+import os, re, uuid, hashlib, hmac, base64, secrets, tempfile, subprocess, stat, shutil, signal, string, threading, logging
+import asyncio, collections, json, time
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List
+from email.utils import formatdate
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Collection, Dict, Optional, List, Union
 
-from fastapi import FastAPI, HTTPException, Header
+import archive, mp3_parallel, storage, waveform
+
+from fastapi import FastAPI, HTTPException, Header, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, UniqueConstraint
+from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Integer, Float, UniqueConstraint, or_, and_, func
 from sqlalchemy.orm import sessionmaker, declarative_base
 from passlib.context import CryptContext
 from cryptography.fernet import Fernet
@@ -37,7 +44,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     allow_credentials=False,
-    expose_headers=["Content-Disposition"],
+    expose_headers=["Content-Disposition", "Content-Range", "Accept-Ranges", "ETag", "X-File-Id"],
 )
 
 # Root
@@ -55,9 +62,24 @@ class Video(Base):
     __tablename__ = "videos"
     id = Column(String, primary_key=True, index=True)
     url = Column(String)
-    status = Column(String)
+    status = Column(String, index=True)
     filename = Column(String)
     owner_username = Column(String, index=True, nullable=True)
+    source_key = Column(String, index=True, nullable=True)   # canonical source, e.g. "youtube:<id>"
+    batch_id = Column(String, index=True, nullable=True)
+    job_id = Column(String, index=True, nullable=True)       # jobs.id of the conversion that fills it
+    path = Column(String, index=True, nullable=True)         # artifact, relative to TMP_DIR (see job_dir)
+    size = Column(Integer, nullable=True)                    # artifact bytes, counted against quotas
+    accessed_at = Column(DateTime, nullable=True)            # last download (LRU eviction)
+    title = Column(String, nullable=True)                    # from a metadata probe, before the download
+    duration = Column(Integer, nullable=True)                # seconds, ditto
+    clip_start = Column(Float, nullable=True)                # only this time range of the source (seconds)
+    clip_end = Column(Float, nullable=True)                  # None with a clip_start: to the end
+    audio_format = Column(String, nullable=True)             # requested output format (OUTPUT_FORMATS), None = mp3
+    formats = Column(String, nullable=True)                  # JSON list when several were requested (first = audio_format)
+    artifacts = Column(String, nullable=True)                # with formats: JSON {format: [path, size, filename]} once ready
+    job_dir = Column(String, index=True, nullable=True)      # job directory all its artifacts are in (see release_file)
+    crc = Column(Integer, nullable=True)                     # CRC-32 of the main artifact (ZIP exports)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
 class User(Base):
@@ -98,6 +120,63 @@ class PwAudit(Base):
     at = Column(DateTime, default=datetime.utcnow)
     details = Column(String, nullable=True)            # free-form (never store plaintext)
 
+# Many URLs / one playlist submitted together; the videos point back via Video.batch_id
+class Batch(Base):
+    __tablename__ = "batches"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    owner_username = Column(String, index=True, nullable=False)
+    playlist_url = Column(String, nullable=True)
+    status = Column(String, nullable=False)            # 'expanding' | 'running' | 'failed'
+    total = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# A library export (ZIP/TAR of chosen videos); kept so a signed link can be resumed with Range
+class Export(Base):
+    __tablename__ = "exports"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    owner_username = Column(String, index=True, nullable=False)    # who asked for it
+    format = Column(String, nullable=False)                        # 'zip' | 'tar'
+    file_ids = Column(String, nullable=False)                      # JSON list, archive order
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# One row per conversion job (shared by all Video rows attached to it), so a restart can tell
+# what was interrupted and where. id = in-memory Job.id = prefix of the job's temp files.
+class JobRecord(Base):
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True)
+    cache_key = Column(String, nullable=False)
+    url = Column(String, nullable=False)
+    owner_username = Column(String, nullable=False)
+    batch_id = Column(String, nullable=True)
+    status = Column(String, index=True, nullable=False)   # 'queued' | 'processing' | 'ready' | 'error'
+    stage = Column(String, nullable=True)                 # last stage reached (see _publish_progress)
+    attempts = Column(Integer, default=0)                 # times a worker picked it up
+    error = Column(String, nullable=True)
+    queued_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    downloading_at = Column(DateTime, nullable=True)
+    converting_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    audio_format = Column(String, nullable=True)
+    cpu_seconds = Column(Float, nullable=True)             # yt-dlp + ffmpeg CPU time of the successful run
+
+# Converted artifacts reusable across users: one row per (source, audio format, quality)
+class CacheEntry(Base):
+    __tablename__ = "cache_entries"
+    key = Column(String, primary_key=True)              # "<source_key>:<format>:<quality>"
+    source_key = Column(String, index=True, nullable=False)
+    audio_format = Column(String, nullable=False)
+    audio_quality = Column(String, nullable=False)
+    filename = Column(String, index=True, nullable=False)   # download name (original title)
+    path = Column(String, index=True, nullable=True)        # artifact, relative to TMP_DIR
+    job_dir = Column(String, index=True, nullable=True)     # its job directory
+    crc = Column(Integer, nullable=True)                    # CRC-32 of the file (ZIP exports)
+    size = Column(Integer, nullable=True)               # bytes; guards against a swapped file
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_hit_at = Column(DateTime, nullable=True)
+
 Base.metadata.create_all(bind=engine)
 
 # --- tiny auto-migrations for SQLite ---
@@ -113,6 +192,61 @@ with engine.begin() as conn:
     cols_vid = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info(videos)").fetchall()]
     if "owner_username" not in cols_vid:
         conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN owner_username TEXT;")
+    if "source_key" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN source_key TEXT;")
+    if "batch_id" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN batch_id TEXT;")
+    if "job_id" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN job_id TEXT;")
+    if "path" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN path TEXT;")
+    if "size" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN size INTEGER;")
+    if "accessed_at" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN accessed_at DATETIME;")
+    if "title" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN title TEXT;")
+    if "duration" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN duration INTEGER;")
+    if "clip_start" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN clip_start FLOAT;")
+    if "clip_end" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN clip_end FLOAT;")
+    if "audio_format" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN audio_format TEXT;")
+    if "formats" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN formats TEXT;")
+    if "artifacts" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN artifacts TEXT;")
+    if "job_dir" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN job_dir TEXT;")
+        for vid, path in conn.exec_driver_sql("SELECT id, path FROM videos WHERE path LIKE 'store%'").fetchall():
+            conn.exec_driver_sql("UPDATE videos SET job_dir = ? WHERE id = ?", (os.path.dirname(path), vid))
+    if "crc" not in cols_vid:
+        conn.exec_driver_sql("ALTER TABLE videos ADD COLUMN crc INTEGER;")
+    # ALTER TABLE doesn't create the indexes create_all gives a new table
+    for col in ("status", "source_key", "batch_id", "job_id", "path", "job_dir"):
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_videos_{col} ON videos ({col})")
+
+    # jobs
+    cols_jobs = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info(jobs)").fetchall()]
+    if "audio_format" not in cols_jobs:
+        conn.exec_driver_sql("ALTER TABLE jobs ADD COLUMN audio_format TEXT;")
+    if "cpu_seconds" not in cols_jobs:
+        conn.exec_driver_sql("ALTER TABLE jobs ADD COLUMN cpu_seconds FLOAT;")
+
+    # cache entries
+    cols_cache = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info(cache_entries)").fetchall()]
+    if "path" not in cols_cache:
+        conn.exec_driver_sql("ALTER TABLE cache_entries ADD COLUMN path TEXT;")
+    if "job_dir" not in cols_cache:
+        conn.exec_driver_sql("ALTER TABLE cache_entries ADD COLUMN job_dir TEXT;")
+        for key, path in conn.exec_driver_sql("SELECT key, path FROM cache_entries WHERE path LIKE 'store%'").fetchall():
+            conn.exec_driver_sql("UPDATE cache_entries SET job_dir = ? WHERE key = ?", (os.path.dirname(path), key))
+    if "crc" not in cols_cache:
+        conn.exec_driver_sql("ALTER TABLE cache_entries ADD COLUMN crc INTEGER;")
+    for col in ("path", "job_dir"):
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_cache_entries_{col} ON cache_entries ({col})")
 
     # required tables
     conn.exec_driver_sql("""
@@ -202,7 +336,8 @@ def _load_or_create_key() -> bytes:
         pass
     return key
 
-FERNET = Fernet(_load_or_create_key())
+SECRET_KEY = _load_or_create_key()
+FERNET = Fernet(SECRET_KEY)
 
 def encrypt_password(pw: str) -> str:
     return FERNET.encrypt(pw.encode("utf-8")).decode("utf-8")
@@ -243,6 +378,32 @@ def _get_user_by_token(authorization: str | None):
     finally:
         db.close()
 
+# URLs that can't carry an Authorization header (EventSource, WebSocket, <audio>: /events, /ws,
+# /stream, /preview, /peaks) take ?token=<URL token> from POST /url_token instead of the session
+# token: the user and an expiry under an HMAC, checked without a lookup and useless once expired,
+# so a URL that ends up in a log or the history doesn't hand out the session.
+URL_TOKEN_TTL = int(os.environ.get("URL_TOKEN_TTL", "300"))   # seconds; checked when a request starts
+_URL_TOKEN_KEY = hashlib.sha256(b"ytmp3 url token\0" + SECRET_KEY).digest()
+
+def _url_token_sig(user: str, exp: int) -> str:
+    msg = f"{exp}\n{user}".encode()
+    return base64.urlsafe_b64encode(hmac.new(_URL_TOKEN_KEY, msg, hashlib.sha256).digest()).decode().rstrip("=")
+
+def make_url_token(user: str) -> tuple:
+    exp = int(time.time()) + URL_TOKEN_TTL
+    return f"{exp}.{_url_token_sig(user, exp)}.{user}", exp
+
+def _username_from_url_token(token: Optional[str]) -> Optional[str]:
+    exp, _, rest = (token or "").partition(".")
+    sig, _, user = rest.partition(".")
+    try:
+        exp_i = int(exp)
+    except ValueError:
+        return None
+    if exp_i < time.time() or not user or not hmac.compare_digest(sig, _url_token_sig(user, exp_i)):
+        return None
+    return user
+
 # -------------------- Schemas --------------------
 class LoginRequest(BaseModel):
     username: str
@@ -274,6 +435,41 @@ class GenTempBody(BaseModel):
 TMP_DIR = os.environ.get("TMP_DIR", tempfile.gettempdir())
 os.makedirs(TMP_DIR, exist_ok=True)
 
+# Every job works in its own directory, sharded by a hash of the job id so no directory grows
+# with the number of files:  {TMP_DIR}/store/ab/cd/<job id>/audio.mp3
+# Video.path / CacheEntry.path hold the artifact path relative to TMP_DIR, which is also its key
+# in STORAGE below (rows from before the layout have none: their file is TMP_DIR/<filename>).
+# Video.filename stays the original title and is what downloads are named.
+STORE_DIR = "store"
+
+def job_dir(job_id: str) -> str:
+    h = hashlib.sha1(job_id.encode()).hexdigest()
+    return os.path.join(STORE_DIR, h[:2], h[2:4], job_id)
+
+def artifact_path(job_id: str, fmt: str) -> str:
+    return os.path.join(job_dir(job_id), f"audio.{fmt}")
+
+def rel_dir(rel: Optional[str]) -> Optional[str]:
+    """Job directory of an artifact path (None for files from before the layout)."""
+    return os.path.dirname(rel) if rel and rel.startswith(STORE_DIR + os.sep) else None
+
+def abs_path(rel: str) -> str:
+    return os.path.join(TMP_DIR, rel)
+
+# Finished artifacts are handed to STORAGE under that same relative path (storage.py). Job
+# directories under TMP_DIR stay the local scratch space with either backend.
+# STORAGE_BACKEND=local (default): artifacts stay in TMP_DIR.
+# STORAGE_BACKEND=s3: S3_BUCKET [S3_PREFIX, S3_ENDPOINT_URL for MinIO & co., S3_REGION,
+#   S3_PART_SIZE_MB]; credentials come from boto3's usual chain (AWS_ACCESS_KEY_ID, ...).
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+if STORAGE_BACKEND == "s3":
+    STORAGE = storage.S3Storage(os.environ["S3_BUCKET"], prefix=os.environ.get("S3_PREFIX", ""),
+                                endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+                                region=os.environ.get("S3_REGION"),
+                                part_size=int(os.environ.get("S3_PART_SIZE_MB", "16")) * 1024 * 1024)
+else:
+    STORAGE = storage.LocalStorage(TMP_DIR)
+
 # -------------------- User endpoints --------------------
 @app.post("/register", tags=["auth"], summary="Register User")
 def register(data: RegisterRequest):
@@ -313,6 +509,12 @@ def me(authorization: str = Header(None)):
     u = _get_user_by_token(authorization)
     return {"user": u.username, "is_admin": bool(u.is_admin)}
 
+@app.post("/url_token", tags=["auth"], summary="Short-lived token for ?token= URLs")
+def url_token(authorization: str = Header(None)):
+    u = _get_user_by_token(authorization)
+    token, exp = make_url_token(u.username)
+    return {"token": token, "expires_at": exp}
+
 @app.get("/users", tags=["users"], summary="List Users")
 def list_users(authorization: str = Header(None)):
     _ = _get_user_by_token(authorization)
@@ -480,71 +682,2427 @@ def admin_pw_audit(authorization: str = Header(None)):
     finally:
         db.close()
 
-# -------------------- Video endpoints --------------------
-class VideoRequest(BaseModel):
-    url: str
+# -------------------- Event bus --------------------
+# Job/video state changes are published from worker threads and request handlers; SSE and
+# WebSocket handlers subscribe from the event loop. Each event carries `owners`
+# ({file_id: owner_username}) for routing and a monotonically increasing `seq`, and the last
+# EVENT_HISTORY events are kept so a reconnecting client can resume from its cursor.
+# Events are full snapshots, so a slow subscriber may safely drop some.
+EVENT_HISTORY = int(os.environ.get("EVENT_HISTORY", "2000"))
 
-@app.post("/download", tags=["videos"], summary="Start YouTube → MP3")
-def download_video(data: VideoRequest, authorization: str = Header(None)):
-    current = _get_user_by_token(authorization)
+class EventBus:
+    def __init__(self, history: int = EVENT_HISTORY):
+        self._subs: List[tuple] = []      # (loop, asyncio.Queue, predicate)
+        self._lock = threading.Lock()
+        self._history = collections.deque(maxlen=history)
+        self.seq = 0
+        self.epoch = secrets.token_hex(4)   # changes on restart, so old cursors are recognised
+
+    def subscribe(self, predicate: Callable[[dict], bool], since: Optional[int] = None):
+        """Call from a coroutine. Returns (queue, backlog, head): events matching `predicate` are
+        delivered to the queue; with a `since` cursor, backlog lists the retained matching events
+        after it (None if some were already evicted, i.e. the client must resync). head is the
+        seq at subscription time."""
+        q: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=256)
+        with self._lock:
+            self._subs.append((asyncio.get_running_loop(), q, predicate))
+            backlog: Optional[List[dict]] = None
+            if since is not None:
+                oldest = self._history[0]["seq"] if self._history else self.seq + 1
+                if oldest - 1 <= since <= self.seq:
+                    backlog = [ev for ev in self._history if ev["seq"] > since and predicate(ev)]
+            return q, backlog, self.seq
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs = [s for s in self._subs if s[1] is not q]
+
+    def publish(self, event: dict):
+        with self._lock:
+            self.seq += 1
+            event = {"seq": self.seq, **event}
+            self._history.append(event)
+            subs = list(self._subs)
+        for loop, q, predicate in subs:
+            try:
+                if predicate(event):
+                    loop.call_soon_threadsafe(_offer, q, event)
+            except RuntimeError:
+                pass   # loop already closed
+
+def _offer(q, event):
+    try:
+        q.put_nowait(event)
+    except asyncio.QueueFull:
+        pass
+
+BUS = EventBus()
+
+# -------------------- Job queue --------------------
+# /download only enqueues; a fixed pool of worker threads runs yt-dlp outside the request path.
+# Requests for the same source while a job is queued/running attach to that job (single-flight):
+# every requester gets its own Video row, all rows point at the one shared MP3.
+# Finished MP3s are indexed in cache_entries, so a later request for the same source/format is
+# served from disk without touching yt-dlp at all.
+# Queued jobs are handed to the workers by SCHEDULER (weighted fair queuing across owners).
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))           # global cap on running jobs
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", "1000"))   # max queued+running jobs (503 beyond)
+JOB_PER_USER = int(os.environ.get("JOB_PER_USER", "2"))         # running jobs per owner
+JOB_ADMIN_WEIGHT = float(os.environ.get("JOB_ADMIN_WEIGHT", "4"))   # admins' share relative to a user's 1
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))  # jobs of one batch queued/running at once
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+# Job cost = estimated seconds of source media (probed duration, else probed filesize at
+# ~128 kbps, else JOB_COST_DEFAULT). It drives admission (JOB_QUEUE_MAX_COST), deferral of
+# heavy jobs (at most JOB_HEAVY_SLOTS of them run at once, so long jobs can't occupy every
+# worker) and, with JOB_SJF=1, shortest-job-first with aging (see FairScheduler).
+# JOB_PROBE=1 probes every /download first so costs are known (see probe).
+JOB_COST_DEFAULT = float(os.environ.get("JOB_COST_DEFAULT", "600"))
+JOB_QUEUE_MAX_COST = float(os.environ.get("JOB_QUEUE_MAX_COST", "0"))   # total queued+running cost, 0 = off
+JOB_HEAVY_COST = float(os.environ.get("JOB_HEAVY_COST", "3600"))
+JOB_HEAVY_SLOTS = int(os.environ.get("JOB_HEAVY_SLOTS", str(max(1, JOB_WORKERS // 2))))
+JOB_SJF = os.environ.get("JOB_SJF", "0") == "1"
+JOB_SJF_AGING = float(os.environ.get("JOB_SJF_AGING", "30"))   # cost credited per second waited
+JOB_PROBE = os.environ.get("JOB_PROBE", "0") == "1"
+COST_BUCKETS = [(300, "<5m"), (1200, "5-20m"), (3600, "20-60m"), (10800, "1-3h"), (float("inf"), ">3h")]
+JOB_ERRORS: Dict[str, str] = {}          # file_id -> last error message (in-memory)
+INFLIGHT: Dict[str, "Job"] = {}          # cache key -> queued/running job
+VIDEO_JOBS: Dict[str, "Job"] = {}        # file_id -> queued/running job it is attached to
+CACHE_STATS = {"hits": 0, "misses": 0, "coalesced": 0}
+AUDIO_FORMAT = "mp3"                     # default output format
+AUDIO_QUALITY = os.environ.get("AUDIO_QUALITY", "5")   # yt-dlp --audio-quality (0 best .. 10 worst, or e.g. 192K)
+# Output formats. mp3 is always a transcode. opus / m4a prefer a source stream that already has
+# that codec (YouTube offers both), which yt-dlp then only remuxes (ffmpeg -c:a copy, no decode);
+# "source" keeps whatever the best audio stream is.
+#   format -> (yt-dlp --audio-format, -f selector, extensions the result can have)
+OUTPUT_FORMATS = {
+    "mp3": ("mp3", "bestaudio/best", ("mp3",)),
+    "opus": ("opus", "bestaudio[acodec^=opus]/bestaudio/best", ("opus",)),
+    "m4a": ("m4a", "bestaudio[ext=m4a]/bestaudio[acodec^=mp4a]/bestaudio/best", ("m4a",)),
+    "source": ("best", "bestaudio/best", ("opus", "m4a", "webm", "ogg", "mp3", "aac", "flac", "wav", "mka")),
+}
+MEDIA_TYPES = {"mp3": "audio/mpeg", "opus": "audio/ogg", "ogg": "audio/ogg", "m4a": "audio/mp4", "aac": "audio/aac",
+               "webm": "audio/webm", "flac": "audio/flac", "wav": "audio/wav", "mka": "audio/x-matroska"}
+
+def media_type(rel: str) -> str:
+    return MEDIA_TYPES.get(os.path.splitext(rel)[1].lstrip(".").lower(), "application/octet-stream")
+
+def format_quality(fmt: str) -> str:
+    return "native" if fmt == "source" else AUDIO_QUALITY
+# "subprocess": one yt-dlp CLI process per job (default, always available as fallback)
+# "inprocess":  JOB_WORKERS long-lived processes with yt-dlp imported once (see ytdl_engine.py)
+JOB_ENGINE = os.environ.get("JOB_ENGINE", "subprocess")
+_engine_pool = None
+_engine_events = None                    # multiprocessing.Queue of (job id, stage, fields) from the engine
+_engine_listeners: Dict[str, Callable] = {}
+_engine_lock = threading.Lock()
+PROGRESS_MIN_INTERVAL = 0.25             # seconds between published progress events per job
+_inflight_lock = threading.Lock()
+_job_threads: List[threading.Thread] = []
+log = logging.getLogger("ytmp3")
+
+class JobError(Exception):
+    pass
+
+class Job:
+    def __init__(self, key: str, src_key: str, url: str, owner: str, video_id: str):
+        self.id = video_id                # first requester's file_id, also the temp-file prefix
+        self.key = key                    # cache key
+        self.source_key = src_key
+        self.url = url
+        self.owner = owner
+        self.status = "queued"
+        self.video_ids: List[str] = [video_id]
+        self.owners: Dict[str, str] = {video_id: owner}   # file_id -> owner, for event routing
+        self.progress: Dict = {"stage": "queued"}   # latest stage/bytes/percent/eta snapshot
+        self.last_publish = 0.0
+        self.batch: Optional[BatchRun] = None
+        self.weight = 1.0                 # scheduler share of the owner (JOB_ADMIN_WEIGHT for admins)
+        self.queued_at = 0.0
+        self.started_at = 0.0
+        self.clip: Optional[tuple] = None   # (start, end) seconds when only a range is wanted
+        self.fmt = AUDIO_FORMAT           # one of OUTPUT_FORMATS
+        self.formats: List[str] = [self.fmt]   # all outputs of the job, fmt first (see _convert_multi)
+        self.cost = JOB_COST_DEFAULT      # estimated media seconds (see estimate_cost)
+        self.cost_known = False
+        self.live: Optional["LiveStream"] = None   # set for streaming jobs (see /stream)
+
+    @property
+    def bucket(self) -> str:
+        if not self.cost_known:
+            return "unknown"
+        return next(name for limit, name in COST_BUCKETS if self.cost < limit)
+
+class BatchRun:
+    """Per-batch concurrency cap: at most `cap` of a batch's jobs sit in the scheduler or run,
+    the rest wait in `pending` until one of them finishes."""
+    def __init__(self, cap: int):
+        self.cap = max(1, cap)
+        self.running = 0
+        self.pending: "collections.deque[Job]" = collections.deque()
+
+class FairScheduler:
+    """Weighted fair queuing of jobs across owners (start-time fair queuing on a virtual clock).
+
+    Each owner has a FIFO of jobs and a virtual time; a worker always gets the head job of the
+    eligible owner with the smallest virtual time, which then advances by 1/weight. An owner is
+    eligible while it runs fewer than `per_user` jobs. One user's 500-item batch therefore takes
+    turns with everybody else instead of filling the whole worker pool, and an owner with weight
+    4 (admins) gets four turns for every one of a weight-1 user.
+
+    Heavy jobs (cost >= heavy_cost) are deferred while `heavy_slots` of them are running. With
+    `sjf`, an owner's next job is its cheapest one, where every second spent waiting takes
+    `aging` off a job's cost so long jobs still get their turn, and the owner's virtual time
+    advances in proportion to the job's cost instead of by one per job."""
+    def __init__(self, per_user: int, heavy_cost: float = float("inf"), heavy_slots: int = 1,
+                 sjf: bool = False, aging: float = 0.0):
+        self.per_user = max(1, per_user)
+        self.heavy_cost = heavy_cost
+        self.heavy_slots = max(1, heavy_slots)
+        self.sjf = sjf
+        self.aging = aging
+        self._cv = threading.Condition()
+        self._queues: Dict[str, "collections.deque[Job]"] = {}
+        self._running: Dict[str, int] = {}
+        self._heavy = 0              # heavy jobs running
+        self._vtime: Dict[str, float] = {}
+        self._clock = 0.0            # virtual start time of the last dispatched job
+        self._stop = 0               # pending stop requests, one per worker
+        self._waits: Dict[str, Dict] = {}   # owner -> queue-wait stats
+        self._buckets: Dict[str, Dict] = {}   # cost bucket -> recent queue waits / turnarounds
+
+    def put(self, job: Job):
+        with self._cv:
+            q = self._queues.setdefault(job.owner, collections.deque())
+            if not q:   # owner becomes backlogged: no credit for the time it was idle
+                self._vtime[job.owner] = max(self._vtime.get(job.owner, 0.0), self._clock)
+            job.queued_at = time.monotonic()
+            q.append(job)
+            self._cv.notify()
+
+    def _is_heavy(self, job: Job) -> bool:
+        return job.cost >= self.heavy_cost
+
+    def _next(self, q: "collections.deque[Job]", now: float) -> Optional[int]:
+        """Index of the job to run next from one owner's queue, None if all are deferred."""
+        best, best_key = None, None
+        for i, job in enumerate(q):
+            if self._is_heavy(job) and self._heavy >= self.heavy_slots:
+                continue
+            if not self.sjf:
+                return i
+            key = job.cost - self.aging * (now - job.queued_at)
+            if best is None or key < best_key:
+                best, best_key = i, key
+        return best
+
+    def _pick(self) -> Optional[Job]:
+        now = time.monotonic()
+        best, best_i = None, None
+        for owner, q in self._queues.items():
+            if q and self._running.get(owner, 0) < self.per_user:
+                if best is None or self._vtime[owner] < self._vtime[best]:
+                    i = self._next(q, now)
+                    if i is not None:
+                        best, best_i = owner, i
+        if best is None:
+            return None
+        q = self._queues[best]
+        job = q[best_i]
+        del q[best_i]
+        self._clock = self._vtime[best]
+        units = max(job.cost, 60.0) / JOB_COST_DEFAULT if self.sjf else 1.0
+        self._vtime[best] += units / max(job.weight, 0.01)
+        self._running[best] = self._running.get(best, 0) + 1
+        if self._is_heavy(job):
+            self._heavy += 1
+        w = self._waits.setdefault(best, {"jobs": 0, "total": 0.0, "max": 0.0,
+                                          "recent": collections.deque(maxlen=200)})
+        waited = now - job.queued_at
+        w["jobs"] += 1; w["total"] += waited; w["max"] = max(w["max"], waited)
+        w["recent"].append(waited)
+        self._bucket(job)["wait"].append(waited)
+        job.started_at = now
+        return job
+
+    def _bucket(self, job: Job) -> Dict:
+        return self._buckets.setdefault(job.bucket, {"wait": collections.deque(maxlen=500),
+                                                     "total": collections.deque(maxlen=500)})
+
+    def get(self) -> Optional[Job]:
+        """Block until a job may run; None tells the worker to exit."""
+        with self._cv:
+            while True:
+                if self._stop:
+                    self._stop -= 1
+                    return None
+                job = self._pick()
+                if job is not None:
+                    return job
+                self._cv.wait()
+
+    def done(self, job: Job):
+        with self._cv:
+            if self._is_heavy(job):
+                self._heavy -= 1
+            self._bucket(job)["total"].append(time.monotonic() - job.queued_at)
+            n = self._running.get(job.owner, 1) - 1
+            if n > 0:
+                self._running[job.owner] = n
+            else:
+                self._running.pop(job.owner, None)
+                if not self._queues.get(job.owner):
+                    self._queues.pop(job.owner, None)
+            self._cv.notify_all()
+
+    def stop(self, workers: int):
+        with self._cv:
+            self._stop += workers
+            self._cv.notify_all()
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._cv:
+            owners = set(self._queues) | set(self._running) | set(self._waits)
+            out = {}
+            for o in sorted(owners):
+                w = self._waits.get(o)
+                recent = sorted(w["recent"]) if w else []
+                out[o] = {
+                    "queued": len(self._queues.get(o) or ()),
+                    "running": self._running.get(o, 0),
+                    "dispatched": w["jobs"] if w else 0,
+                    "wait_avg": round(w["total"] / w["jobs"], 3) if w and w["jobs"] else None,
+                    "wait_p50": round(recent[len(recent) // 2], 3) if recent else None,
+                    "wait_p95": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 3) if recent else None,
+                    "wait_max": round(w["max"], 3) if w else None,
+                }
+            return out
+
+    def bucket_stats(self) -> Dict[str, Dict]:
+        """Queue wait and turnaround (queued -> finished) percentiles per cost bucket, over the
+        last 500 jobs of each."""
+        def pct(xs: List[float]) -> Dict:
+            xs = sorted(xs)
+            at = lambda p: round(xs[min(len(xs) - 1, int(len(xs) * p))], 3)
+            return {"n": len(xs), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99)} if xs else {"n": 0}
+        with self._cv:
+            queued: Dict[str, int] = {}
+            for q in self._queues.values():
+                for job in q:
+                    queued[job.bucket] = queued.get(job.bucket, 0) + 1
+            names = [name for _, name in COST_BUCKETS] + ["unknown"]
+            return {name: {"queued": queued.get(name, 0),
+                           "wait": pct(list(self._buckets[name]["wait"])) if name in self._buckets else {"n": 0},
+                           "turnaround": pct(list(self._buckets[name]["total"])) if name in self._buckets else {"n": 0}}
+                    for name in names}
+
+SCHEDULER = FairScheduler(JOB_PER_USER, JOB_HEAVY_COST, JOB_HEAVY_SLOTS, JOB_SJF, JOB_SJF_AGING)
+
+# Process budget: a running job is one conversion (JOB_WORKERS caps those, STREAM_MAX streaming
+# ones). Every ffmpeg a job starts besides (its preview, the extra segments of a parallel MP3
+# encode, a peaks decode) takes one of EXTRA_PROCS slots shared by all jobs of all users, so
+# the scheduler's caps hold for processes too: at most JOB_WORKERS + STREAM_MAX + EXTRA_PROCS.
+# Previews and segments only take what is free at the moment (a job never waits for a slot);
+# peaks, made after the job, wait for one.
+EXTRA_PROCS = max(1, int(os.environ.get("EXTRA_PROCS", str(JOB_WORKERS))))
+_extra_slots = threading.BoundedSemaphore(EXTRA_PROCS)
+
+def _take_slots(n: int) -> int:
+    """Take up to `n` free EXTRA_PROCS slots without waiting; returns how many (_give_slots them back)."""
+    got = 0
+    while got < n and _extra_slots.acquire(blocking=False):
+        got += 1
+    return got
+
+def _give_slots(n: int):
+    for _ in range(n):
+        _extra_slots.release()
+
+_YT_ID_RE = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/|/v/)([A-Za-z0-9_-]{11})")
+
+def source_key(url: str) -> str:
+    """Canonical key for a source URL, so watch?v=, youtu.be/ and shorts/ links of one video match."""
+    url = url.strip()
+    if "youtu" in url:
+        m = _YT_ID_RE.search(url)
+        if m:
+            return f"youtube:{m.group(1)}"
+    return f"url:{url}"
+
+def cache_key(src_key: str, fmt: str = AUDIO_FORMAT, quality: str = AUDIO_QUALITY,
+              clip: Optional[tuple] = None) -> str:
+    key = f"{src_key}:{fmt}:{quality}"
+    if clip:   # a time range is its own artifact: "...:t=30-60" ("t=30-" up to the end)
+        start, end = clip
+        key += f":t={start:g}-{'' if end is None else f'{end:g}'}"
+    return key
+
+def video_format(video) -> str:
+    return video.audio_format or AUDIO_FORMAT
+
+def video_formats(video) -> List[str]:
+    return json.loads(video.formats) if video.formats else [video_format(video)]
+
+def format_keys(video) -> List[str]:
+    """Cache key of each output format of a row."""
+    clip = video_clip(video)
+    return [cache_key(video.source_key, f, format_quality(f), clip) for f in video_formats(video)]
+
+def video_key(video) -> str:
+    """Key of the job that fills a row: the first format's cache key, "+<format>" for each
+    further one (several formats are one job, see _convert_multi)."""
+    fmts = video_formats(video)
+    return format_keys(video)[0] + "".join("+" + f for f in fmts[1:])
+
+def video_artifacts(video) -> Dict[str, list]:
+    """format -> [path, size, filename] of every output of a row, the main one first."""
+    if video.artifacts:
+        return json.loads(video.artifacts)
+    return {video_format(video): [video.path or video.filename, video.size, video.filename]}
+
+def video_files(video) -> List[str]:
+    """Artifact paths a row uses (other formats can sit in other jobs' directories)."""
+    rels = [video.path or video.filename] + [a[0] for a in video_artifacts(video).values()]
+    return list(dict.fromkeys(r for r in rels if r))
+
+def video_sidecar(video, name: str) -> Optional[str]:
+    """Path of one of a row's SIDECARS: in the job directory of its artifact, or of its
+    running job."""
+    if video.path and video.path.startswith(STORE_DIR + os.sep):
+        return os.path.join(os.path.dirname(video.path), name)
+    return os.path.join(job_dir(video.job_id), name) if video.job_id else None
+
+def video_clip(video) -> Optional[tuple]:
+    if video.clip_start is None and video.clip_end is None:
+        return None
+    return (video.clip_start or 0.0, video.clip_end)
+
+def clip_label(clip: tuple) -> str:
+    """(90, 3725.5) -> '1m30s-1h02m05.5s' (file-name safe)"""
+    def ts(t):
+        m, sec = divmod(t, 60)
+        h, m = divmod(int(m), 60)
+        sec = f"{sec:04.1f}".rstrip("0").rstrip(".") if sec % 1 else f"{int(sec):02d}"
+        return f"{h}h{m:02d}m{sec}s" if h else f"{m}m{sec}s"
+    start, end = clip
+    return f"{ts(start)}-{ts(end) if end is not None else 'end'}"
+
+def _ytdlp_env() -> Dict[str, str]:
+    env = os.environ.copy()
+    try:
+        import certifi
+        env.setdefault("SSL_CERT_FILE", certifi.where())
+    except Exception:
+        pass
+    return env
+
+_PROGRESS_TEMPLATES = [
+    "download:[progress] %(progress.downloaded_bytes)s %(progress.total_bytes)s "
+    "%(progress.total_bytes_estimate)s %(progress.eta)s %(progress.speed)s",
+    "postprocess:[postprocess] %(progress.status)s %(progress.postprocessor)s",
+]
+
+def _num(v: str) -> Optional[float]:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None   # yt-dlp prints "NA" for unknown fields
+
+def _parse_progress(line: str):
+    """Turn one line printed via _PROGRESS_TEMPLATES into (stage, fields), else None."""
+    parts = line.split()
+    if len(parts) == 6 and parts[0] == "[progress]":
+        return "downloading", {
+            "downloaded_bytes": _num(parts[1]),
+            "total_bytes": _num(parts[2]) or _num(parts[3]),
+            "eta": _num(parts[4]),
+            "speed": _num(parts[5]),
+        }
+    if len(parts) >= 2 and parts[0] == "[postprocess]" and parts[1] == "started":
+        return "converting", {"postprocessor": parts[2] if len(parts) > 2 else None}
+    return None
+
+def _cli_download(outtmpl: str, url: str, on_progress: Optional[Callable] = None, info_path: Optional[str] = None,
+                  clip: Optional[tuple] = None, fmt: str = AUDIO_FORMAT) -> Optional[float]:
+    """Returns the CPU seconds yt-dlp and its ffmpeg children used (None where unknown)."""
+    ffmpeg_loc = os.getenv("FFMPEG_LOCATION")
+    ytfmt, selector, _ = OUTPUT_FORMATS[fmt]
+    args = [
+        "yt-dlp", "-f", selector, "-x", "--audio-format", ytfmt, "--audio-quality", AUDIO_QUALITY,
+        "--newline", "-o", outtmpl,
+    ]
+    for tmpl in _PROGRESS_TEMPLATES:
+        args.extend(["--progress-template", tmpl])
+    if ffmpeg_loc:
+        args.extend(["--ffmpeg-location", ffmpeg_loc])
+    env = _ytdlp_env()
+    if env.get("YTDLP_NO_CHECK_CERTS") == "1":
+        args.append("--no-check-certificates")
+    if clip:
+        # yt-dlp has ffmpeg seek into the remote media, so only the range is fetched and encoded
+        start, end = clip
+        args.extend(["--download-sections", f"*{start:g}-{'inf' if end is None else f'{end:g}'}"])
+    # from a probed info JSON (see probe), yt-dlp skips extraction; it re-extracts from the URL
+    # in there by itself if the format URLs have gone stale
+    args.extend(["--load-info-json", info_path] if info_path else [url])
+
+    proc = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, text=True, errors="replace")
+    for line in proc.stdout:
+        ev = _parse_progress(line)
+        if ev and on_progress:
+            on_progress(ev[0], **ev[1])
+    cpu = _wait_cpu(proc)
+    if proc.returncode != 0:
+        raise JobError("Download failed")
+    return cpu
+
+def _wait_cpu(proc: subprocess.Popen) -> Optional[float]:
+    """Wait for `proc`; returns the CPU seconds it and the children it waited for used."""
+    cpu = None
+    if hasattr(os, "wait4"):
+        _, status, ru = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        cpu = ru.ru_utime + ru.ru_stime
+    proc.wait()
+    return cpu
+
+def _engine_pump(events):
+    while True:
+        item = events.get()
+        if item is None:
+            return
+        tag, stage, fields = item
+        cb = _engine_listeners.get(tag)
+        if cb:
+            try:
+                cb(stage, **fields)
+            except Exception:
+                log.exception("progress callback failed")
+
+def _engine():
+    """Lazily start the pool of long-lived yt-dlp worker processes (JOB_ENGINE=inprocess)."""
+    global _engine_pool, _engine_events
+    with _engine_lock:
+        if _engine_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            import ytdl_engine
+            ctx = multiprocessing.get_context("spawn")   # never fork a threaded server
+            _engine_events = ctx.Queue()
+            threading.Thread(target=_engine_pump, args=(_engine_events,), name="engine-events", daemon=True).start()
+            _engine_pool = ProcessPoolExecutor(
+                max_workers=max(1, JOB_WORKERS),
+                mp_context=ctx,
+                initializer=ytdl_engine.init,
+                initargs=(os.getenv("FFMPEG_LOCATION"), os.environ.get("YTDLP_NO_CHECK_CERTS") == "1",
+                          None, _engine_events),
+            )
+        return _engine_pool
+
+def _drop_engine():
+    global _engine_pool, _engine_events
+    with _engine_lock:
+        if _engine_pool is not None:
+            _engine_pool.shutdown(wait=False, cancel_futures=True)
+        if _engine_events is not None:
+            _engine_events.put(None)   # stops the pump thread
+        _engine_pool = _engine_events = None
+
+def _engine_download(outtmpl: str, url: str, on_progress: Optional[Callable] = None, info_path: Optional[str] = None,
+                     clip: Optional[tuple] = None, fmt: str = AUDIO_FORMAT) -> Optional[float]:
+    from concurrent.futures.process import BrokenProcessPool
+    import ytdl_engine
+    tag = uuid.uuid4().hex
+    if on_progress:
+        _engine_listeners[tag] = on_progress
+    try:
+        ytfmt, selector, _ = OUTPUT_FORMATS[fmt]
+        return _engine().submit(ytdl_engine.convert, outtmpl, url, ytfmt, AUDIO_QUALITY, tag, info_path,
+                                clip, selector).result()
+    except BrokenProcessPool:
+        # a worker died (OOM, segfault in ffmpeg bindings, ...): drop the pool, use the CLI this time
+        log.warning("yt-dlp engine pool broke, falling back to the CLI")
+        _drop_engine()
+        return _cli_download(outtmpl, url, on_progress, info_path, clip, fmt)
+    except RuntimeError as e:
+        log.warning("yt-dlp engine: %s", e)
+        raise JobError("Download failed")
+    finally:
+        _engine_listeners.pop(tag, None)
+
+def _convert(job_id: str, url: str, on_progress: Optional[Callable] = None, info: Optional[dict] = None,
+             clip: Optional[tuple] = None, fmt: str = AUDIO_FORMAT) -> tuple:
+    """Run yt-dlp for one job inside its job directory. Returns (artifact path relative to
+    TMP_DIR, download filename, CPU seconds or None). `on_progress(stage, **fields)` is called
+    with download/convert progress. `info`: the video's probed info dict, saves yt-dlp a second
+    extraction. `clip`: (start, end or None) seconds, only that range is downloaded and encoded.
+    `fmt`: one of OUTPUT_FORMATS."""
+    work = abs_path(job_dir(job_id))
+    os.makedirs(work, exist_ok=True)
+    outtmpl = os.path.join(work, "%(title).200s.%(ext)s")
+    info_path = None
+    if info is not None:
+        info_path = os.path.join(work, "probe.info.json")
+        with open(info_path, "w") as f:
+            json.dump(info, f)
+    if JOB_ENGINE == "inprocess":
+        cpu = _engine_download(outtmpl, url, on_progress, info_path, clip, fmt)
+    else:
+        cpu = _cli_download(outtmpl, url, on_progress, info_path, clip, fmt)
+
+    # the job directory only ever holds this job's few files
+    exts = OUTPUT_FORMATS[fmt][2]
+    found = [n for n in os.listdir(work) if os.path.splitext(n)[1].lstrip(".") in exts and n not in SIDECARS]
+    found = [n for n in found if not n.startswith("audio.")] or found
+    if not found:
+        raise JobError(f"{fmt.upper()} not found")
+    ext = os.path.splitext(found[0])[1].lstrip(".")
+    rel = artifact_path(job_id, ext)
+    os.replace(os.path.join(work, found[0]), abs_path(rel))
+    name = found[0]
+    if clip:
+        stem, ext = os.path.splitext(name)
+        name = f"{stem} [{clip_label(clip)}]{ext}"
+    return rel, name, cpu
+
+# Several formats from one job (VideoRequest.formats): yt-dlp fetches the best audio stream once
+# and only remuxes it (format "source"), then a single ffmpeg run decodes it once and feeds every
+# encoder from that decode. A requested format the source already has is the source file itself.
+#   extension -> (ffmpeg encoder, extra output options)
+ENCODERS = {
+    "mp3": ("libmp3lame", []),
+    "opus": ("libopus", []),
+    "m4a": ("aac", ["-f", "ipod"]),
+}
+# Long mp3 jobs (estimated cost >= MP3_PARALLEL_MIN_DURATION seconds of media) take the same
+# path, but their MP3 is encoded in up to MP3_PARALLEL_WORKERS time segments at once (as free
+# EXTRA_PROCS slots allow) and joined (mp3_parallel.py); LAME alone only ever uses one core.
+# <2 workers turns it off. Only when the MP3 is the one format encoded: next to others it
+# stays in their shared decode. mp3 jobs whose length even the worker's probe couldn't tell
+# take it too: the length is then read from the fetched source, and a short one gets the one
+# plain encode yt-dlp would have run.
+MP3_PARALLEL_WORKERS = int(os.environ.get("MP3_PARALLEL_WORKERS", str(os.cpu_count() or 1)))
+MP3_PARALLEL_MIN_DURATION = float(os.environ.get("MP3_PARALLEL_MIN_DURATION", "1200"))
+
+def _ffmpeg_bin() -> str:
+    loc = os.getenv("FFMPEG_LOCATION")   # like yt-dlp's --ffmpeg-location: the binary or its directory
+    if loc and os.path.isdir(loc):
+        return os.path.join(loc, "ffmpeg")
+    return loc or "ffmpeg"
+
+def _quality_args(encoder: str) -> List[str]:
+    """AUDIO_QUALITY as ffmpeg options, mapped the way yt-dlp maps --audio-quality, so a format
+    comes out the same from either path (and can share its cache entry)."""
+    q = AUDIO_QUALITY.strip().upper().rstrip("K")
+    try:
+        q = float(q)
+    except ValueError:
+        return []
+    if q > 10:
+        return ["-b:a", f"{q:g}k"]
+    limits = {"libmp3lame": (10, 0), "aac": (0.1, 4)}.get(encoder)   # (worst, best) -q:a
+    if not limits:
+        return []   # libopus: its default VBR, as with yt-dlp
+    return ["-q:a", f"{limits[1] + (limits[0] - limits[1]) * q / 10:g}"]
+
+def _splits_mp3(job: Job, cost: Optional[tuple] = None) -> bool:
+    """Whether the job's MP3 goes through mp3_parallel (see MP3_PARALLEL_MIN_DURATION).
+    `cost`: (cost, known) as estimate_cost returns it, else the job's own estimate."""
+    if job.live or MP3_PARALLEL_WORKERS < 2 or "mp3" not in job.formats:
+        return False
+    if any(f not in ("mp3", "source") for f in job.formats):
+        return False   # one decode for all encoders beats a second decode for the MP3
+    cost, known = cost or (job.cost, job.cost_known)
+    return not known or cost >= MP3_PARALLEL_MIN_DURATION
+
+def _encode_progress(on_progress: Optional[Callable], postprocessor: str,
+                     duration: Optional[float]) -> Optional[Callable[[float], None]]:
+    """Callback for ffmpeg's progress (seconds of `duration` encoded so far) that reports the
+    converting stage with percent and ETA (from the time spent so far)."""
+    if not on_progress or not duration:
+        return None
+    started = time.monotonic()
+
+    def report(done: float):
+        frac = min(max(done / duration, 0.0), 1.0)
+        eta = (time.monotonic() - started) * (1 - frac) / frac if frac >= 0.01 else None
+        on_progress("converting", postprocessor=postprocessor, percent=round(frac * 100, 1),
+                    eta=round(eta) if eta is not None else None)
+    return report
+
+def _add_cpu(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    return None if a is None or b is None else a + b
+
+def _convert_multi(job_id: str, url: str, on_progress: Optional[Callable] = None, info: Optional[dict] = None,
+                   clip: Optional[tuple] = None, formats: List[str] = (), parallel: bool = False,
+                   peaks: Optional[str] = None) -> tuple:
+    """_convert for several output formats at once. Returns ([(format, artifact path, download
+    filename)] in the order of `formats`, CPU seconds or None). `parallel`: encode the MP3 with
+    mp3_parallel instead of in the shared ffmpeg run. `peaks`: if there is a shared ffmpeg run,
+    also write the waveform peaks of its decode to that local path."""
+    src_rel, name, cpu = _convert(job_id, url, on_progress, info, clip, "source")
+    src_ext = os.path.splitext(src_rel)[1].lstrip(".")
+    stem = os.path.splitext(name)[0]
+    args = [_ffmpeg_bin(), "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", abs_path(src_rel)]
+    outputs, encoded, split_mp3 = [], False, None
+    for fmt in formats:
+        ext = src_ext if fmt == "source" else OUTPUT_FORMATS[fmt][0]
+        rel = artifact_path(job_id, ext)
+        if ext == "mp3" and parallel and src_ext != "mp3":
+            split_mp3 = rel
+        elif ext != src_ext and not any(r == rel for _, r, _ in outputs):
+            encoder, opts = ENCODERS[ext]
+            args += ["-map", "0:a:0", "-c:a", encoder, *_quality_args(encoder), *opts, abs_path(rel)]
+            encoded = True
+        outputs.append((fmt, rel, f"{stem}.{ext}"))
+    # for percent / ETA of the encode (yt-dlp only reports the download)
+    duration, rate = (mp3_parallel.probe(_ffmpeg_bin(), abs_path(src_rel)) if encoded or split_mp3
+                      else (None, None))
+    if encoded:
+        if on_progress:
+            on_progress("converting", postprocessor="MultiEncode")
+        if peaks:
+            args += ["-map", "0:a:0", *waveform.pcm_args(), "pipe:1"]
+        args[1:1] = mp3_parallel.progress_args()
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE if peaks else subprocess.DEVNULL, stderr=subprocess.PIPE)
+        err: List[str] = []
+        # stderr (progress and messages) next to the PCM on stdout, so neither pipe can fill up
+        reader = threading.Thread(target=lambda: err.append(mp3_parallel.watch(
+            proc.stderr, _encode_progress(on_progress, "MultiEncode", duration))), daemon=True)
+        reader.start()
+        if peaks:
+            try:
+                waveform.save(proc.stdout, peaks)
+            except Exception as e:
+                log.warning("peaks for job %s failed: %s", job_id, e)
+                while proc.stdout.read(FILE_CHUNK):   # the encoders still need the decode
+                    pass
+            proc.stdout.close()
+        reader.join()
+        ff_cpu = _wait_cpu(proc)
+        if proc.returncode != 0:
+            log.warning("ffmpeg for job %s failed: %s", job_id, "".join(err).strip()[-500:])
+            raise JobError("Conversion failed")
+        cpu = _add_cpu(cpu, ff_cpu)
+    if split_mp3:
+        if on_progress:
+            on_progress("converting", postprocessor="ParallelMP3")
+        # the job's own process, plus whatever EXTRA_PROCS slots are free (none: one plain encode)
+        extra = _take_slots(MP3_PARALLEL_WORKERS - 1)
+        try:
+            # from the real duration: below the threshold after all, it's one plain encode
+            cpu = _add_cpu(cpu, mp3_parallel.encode(_ffmpeg_bin(), abs_path(src_rel), abs_path(split_mp3),
+                                                    _quality_args("libmp3lame"), 1 + extra,
+                                                    MP3_PARALLEL_MIN_DURATION, duration, rate,
+                                                    _encode_progress(on_progress, "ParallelMP3", duration)))
+        except RuntimeError as e:
+            log.warning("parallel mp3 encode for job %s failed: %s", job_id, e)
+            raise JobError("Conversion failed")
+        finally:
+            _give_slots(extra)
+    return outputs, cpu
+
+# Streaming conversions (GET /stream): yt-dlp writes the source stream to stdout straight into
+# ffmpeg, and the MP3 ffmpeg produces is appended to the job's live.mp3 as it comes out. Any
+# number of listeners follow that growing file while the job runs; at the end it becomes the
+# job's normal cached artifact. Streaming jobs skip the scheduler queue (a listener is waiting)
+# but at most STREAM_MAX of them run at once; beyond that they are ordinary queued jobs.
+STREAM_MAX = int(os.environ.get("STREAM_MAX", str(JOB_WORKERS)))
+STREAM_POLL = 0.1   # seconds between a listener's checks for new bytes
+
+class LiveStream:
+    def __init__(self, path: str):
+        self.path = path                  # absolute path of the growing MP3
+        self.size = 0                     # bytes written so far
+        self.done = False                 # no more bytes will come
+        self.error: Optional[str] = None
+        self.rel: Optional[str] = None    # the finished artifact, once there is one
+
+def _pipe_args(work: str, url: str, info: Optional[dict], extra: List[str] = (),
+               info_name: str = "probe.info.json") -> tuple:
+    """(args, env) for a yt-dlp that writes the best audio stream of `url` to stdout."""
+    args = ["yt-dlp", "-f", OUTPUT_FORMATS["mp3"][1], "--quiet", "--no-warnings", *extra, "-o", "-"]
+    if os.getenv("FFMPEG_LOCATION"):
+        args.extend(["--ffmpeg-location", os.getenv("FFMPEG_LOCATION")])
+    env = _ytdlp_env()
+    if env.get("YTDLP_NO_CHECK_CERTS") == "1":
+        args.append("--no-check-certificates")
+    if info is not None:
+        info_path = os.path.join(work, info_name)
+        with open(info_path, "w") as f:
+            json.dump(info, f)
+        args.extend(["--load-info-json", info_path])
+    else:
+        args.append(url)
+    return args, env
+
+def _convert_live(job: Job, on_progress: Optional[Callable] = None, info: Optional[dict] = None) -> tuple:
+    """_convert for a streaming job, always to MP3 (no clip). Same return value."""
+    live = job.live
+    work = abs_path(job_dir(job.id))
+    os.makedirs(work, exist_ok=True)
+    title_path = os.path.join(work, "title.txt")
+    args, env = _pipe_args(work, job.url, info, ["--print-to-file", "%(title).200s", title_path])
+    # no Xing header (ffmpeg can't go back to fill one into a pipe) and no ID3 tag: add_xing below
+    ff = [_ffmpeg_bin(), "-nostdin", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-map", "0:a:0",
+          "-c:a", "libmp3lame", *_quality_args("libmp3lame"), "-id3v2_version", "0", "-flush_packets", "1",
+          "-f", "mp3", "pipe:1"]
+
+    procs = []
+    try:
+        with open(os.path.join(work, "stream.log"), "wb") as errlog:
+            dl = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=errlog)
+            procs.append(dl)
+            enc = subprocess.Popen(ff, stdin=dl.stdout, stdout=subprocess.PIPE, stderr=errlog)
+            procs.append(enc)
+            dl.stdout.close()   # ffmpeg has it now; yt-dlp gets SIGPIPE if ffmpeg dies
+            if on_progress:
+                on_progress("converting", postprocessor="Stream")
+            with open(live.path, "wb") as out:
+                while True:
+                    chunk = enc.stdout.read1(FILE_CHUNK)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    out.flush()
+                    live.size += len(chunk)
+                    if on_progress:
+                        on_progress("converting", postprocessor="Stream", output_bytes=live.size)
+            cpu = _add_cpu(_wait_cpu(enc), _wait_cpu(dl))
+        if dl.returncode != 0 or enc.returncode != 0 or not live.size:
+            with open(os.path.join(work, "stream.log"), errors="replace") as f:
+                log.warning("streaming job %s failed: %s", job.id, f.read().strip()[-500:])
+            raise JobError("Download failed" if dl.returncode != 0 else "Conversion failed")
+        rel = artifact_path(job.id, "mp3")
+        try:
+            mp3_parallel.add_xing(live.path, abs_path(rel))
+        except (OSError, RuntimeError) as e:
+            log.warning("streaming job %s: %s", job.id, e)
+            raise JobError("Conversion failed")
+        title = None
+        if os.path.exists(title_path):
+            with open(title_path, errors="replace") as f:
+                title = f.read().strip()
+        title = re.sub(r'[\\/\x00-\x1f]', "_", title or (info or {}).get("title") or "").strip(". ") or "audio"
+        live.rel = rel
+        return rel, f"{title}.mp3", cpu
+    except BaseException as e:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        live.error = str(e) if isinstance(e, JobError) else "Download failed"
+        raise
+    finally:
+        live.done = True
+
+# Previews: next to the full conversion, a job encodes the first PREVIEW_SECONDS of the source
+# at PREVIEW_BITRATE into preview.mp3 in the job directory, so /preview/{file_id} has something
+# to play seconds after the job starts. yt-dlp streams the source into ffmpeg, which stops after
+# that much, and yt-dlp is stopped with it, so only the start of the source is fetched, and
+# from the job's probed info (--load-info-json), so without a second extraction. The full
+# conversion never waits for it. Only made for sources whose probed duration is at least
+# PREVIEW_MIN_DURATION seconds; not for streaming jobs (the stream is there at once) or clips.
+PREVIEW_SECONDS = float(os.environ.get("PREVIEW_SECONDS", "30"))   # 0 = no previews
+PREVIEW_BITRATE = os.environ.get("PREVIEW_BITRATE", "64k")
+PREVIEW_MIN_DURATION = float(os.environ.get("PREVIEW_MIN_DURATION", "120"))
+PREVIEW_TIMEOUT = 60     # seconds; a source that slow gets no preview
+PREVIEW_NAME = "preview.mp3"
+
+def _kill(*procs: subprocess.Popen):
+    """SIGKILL without reaping (Popen.kill polls first), so _wait_cpu still gets the rusage."""
+    for proc in procs:
+        try:
+            os.kill(proc.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        except OSError:
+            pass
+
+_preview_pool = ThreadPoolExecutor(max_workers=max(1, JOB_WORKERS), thread_name_prefix="preview")
+
+def _wants_preview(job: Job, info: Optional[dict] = None) -> bool:
+    """Whether the job gets a preview; without `info`, whether it may (once probed)."""
+    if PREVIEW_SECONDS <= 0 or job.live is not None or job.clip:
+        return False
+    return info is None or (info.get("duration") or 0) >= PREVIEW_MIN_DURATION
+
+def _make_preview(job: Job, info: dict) -> Optional[float]:
+    """Make and store the job's preview, on an EXTRA_PROCS slot the caller took (given back
+    here). Returns the CPU seconds it took; a failure only costs the preview, the job goes on
+    without one."""
+    try:
+        return _encode_preview(job, info)
+    except Exception as e:
+        log.warning("preview for job %s failed: %s", job.id, e)
+        return None
+    finally:
+        _give_slots(1)
+
+def _encode_preview(job: Job, info: dict) -> Optional[float]:
+    rel = os.path.join(job_dir(job.id), PREVIEW_NAME)
+    if STORAGE.exists(rel):   # a resumed job
+        return 0.0
+    work = abs_path(job_dir(job.id))
+    os.makedirs(work, exist_ok=True)
+    tmp = abs_path(rel) + ".part"
+    args, env = _pipe_args(work, job.url, info, info_name="preview.info.json")   # the conversion writes its own
+    ff = [_ffmpeg_bin(), "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", "pipe:0", "-map", "0:a:0",
+          "-t", f"{PREVIEW_SECONDS:g}", "-c:a", "libmp3lame", "-b:a", PREVIEW_BITRATE, "-id3v2_version", "0",
+          "-f", "mp3", tmp]
+    dl = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    enc = subprocess.Popen(ff, stdin=dl.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    dl.stdout.close()
+    timer = threading.Timer(PREVIEW_TIMEOUT, _kill, (enc, dl))
+    timer.start()
+    err = enc.stderr.read()
+    timer.cancel()
+    enc_cpu = _wait_cpu(enc)
+    _kill(dl)   # ffmpeg has all it wants; no need to fetch the rest
+    cpu = _add_cpu(enc_cpu, _wait_cpu(dl))
+    try:
+        if enc.returncode != 0 or not os.path.getsize(tmp):
+            raise JobError(err.decode(errors="replace").strip()[-300:] or f"ffmpeg exited with {enc.returncode}")
+        os.replace(tmp, abs_path(rel))
+        size = STORAGE.put(rel, abs_path(rel), "audio/mpeg")
+    except Exception as e:
+        log.warning("preview for job %s failed: %s", job.id, e)
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return cpu
+    with _inflight_lock:
+        event = {"type": "preview", "owners": dict(job.owners), "status": job.status, "preview_bytes": size}
+    BUS.publish(event)
+    return cpu
+
+# Waveform peaks: mono PCM of a job's audio reduced to min/max peaks at several zoom levels
+# (waveform.py, NumPy), stored as peaks.bin next to the artifacts and served by /peaks/{file_id}.
+# A job whose formats share one ffmpeg run (_convert_multi) gets them from that decode; any
+# other job's main artifact is decoded once more, after its rows are ready, so that never
+# delays a download (/peaks says "not yet" meanwhile). Needs numpy; PEAKS=0 turns it off.
+PEAKS = os.environ.get("PEAKS", "1") == "1"
+PEAKS_NAME = "peaks.bin"
+PEAKS_MAX_AGE = int(os.environ.get("PEAKS_MAX_AGE", "86400"))   # seconds clients may cache peaks
+# files a job directory holds besides the artifacts (released together with them)
+SIDECARS = (PREVIEW_NAME, PEAKS_NAME)
+PEAKS_PENDING: set = set()   # job directories whose peaks are still being made
+_peaks_pool = ThreadPoolExecutor(max_workers=max(1, JOB_WORKERS), thread_name_prefix="peaks")
+
+def _peaks_enabled() -> bool:
+    global PEAKS
+    if PEAKS and not waveform.available():
+        log.warning("numpy is not installed: no waveform peaks")
+        PEAKS = False
+    return PEAKS
+
+def _make_peaks(job: Job, src: str, keep: Collection[str]):
+    """Compute (unless the shared decode already did) and store the peaks of the job's local
+    artifact `src`, then remove the job's leftovers (_remove_leftovers `keep`), which `src` may
+    be one of. Runs on _peaks_pool; like the preview, a failure only costs the peaks."""
+    d = job_dir(job.id)
+    rel = os.path.join(d, PEAKS_NAME)
+    try:
+        if os.path.exists(abs_path(rel)):   # from the shared decode
+            cpu = 0.0
+        else:
+            with _extra_slots:
+                cpu = waveform.compute(_ffmpeg_bin(), src, abs_path(rel))
+        STORAGE.put(rel, abs_path(rel), "application/octet-stream")
+        db = SessionLocal()
+        try:
+            released = not db.query(CacheEntry).filter(CacheEntry.job_dir == d).count()
+        finally:
+            db.close()
+        if released:   # deleted while the peaks were made; release_file has been and gone
+            STORAGE.delete(rel)
+            return
+        if cpu != 0.0:
+            _update_job(job.id, cpu_seconds=None if cpu is None else JobRecord.cpu_seconds + cpu)
+        with _inflight_lock:
+            event = {"type": "peaks", "owners": dict(job.owners), "status": job.status}
+        BUS.publish(event)
+    except Exception as e:
+        log.warning("peaks for job %s failed: %s", job.id, e)
+    finally:
+        PEAKS_PENDING.discard(d)
+        _remove_leftovers(job.id, keep)
+
+def _flat_entries(url: str) -> List[Dict]:
+    """List a playlist's entries (id/url/title) without resolving each video."""
+    if JOB_ENGINE == "inprocess":
+        import ytdl_engine
+        try:
+            return _engine().submit(ytdl_engine.extract_flat, url).result()
+        except RuntimeError as e:
+            log.warning("yt-dlp engine: %s", e)
+            raise JobError("Could not read playlist")
+    args = ["yt-dlp", "--flat-playlist", "-J", "--no-warnings"]
+    env = _ytdlp_env()
+    if env.get("YTDLP_NO_CHECK_CERTS") == "1":
+        args.append("--no-check-certificates")
+    args.append(url)
+    try:
+        out = subprocess.run(args, env=env, capture_output=True, text=True, check=True, timeout=300).stdout
+        info = json.loads(out)
+    except (subprocess.SubprocessError, ValueError):
+        raise JobError("Could not read playlist")
+    entries = info.get("entries")
+    if entries is None:
+        entries = [info]
+    return [{"id": e.get("id"), "url": e.get("url") or e.get("webpage_url"), "title": e.get("title")}
+            for e in entries if e]
+
+def expand_playlist(url: str) -> List[str]:
+    urls = []
+    for e in _flat_entries(url):
+        u = e.get("url")
+        if e.get("id") and (not u or not u.startswith(("http://", "https://"))):
+            u = f"https://www.youtube.com/watch?v={e['id']}"   # flat YouTube entries may carry only the id
+        if u:
+            urls.append(u)
+    return urls
+
+# Metadata probe: yt-dlp extraction only (title, duration, formats), cached per source for
+# PROBE_TTL in a bounded LRU. The full info dict is kept as well so a conversion started within
+# the TTL hands it to yt-dlp (--load-info-json) instead of extracting the video again; the
+# format URLs in it expire after a few hours on YouTube, hence the short TTL.
+PROBE_TTL = float(os.environ.get("PROBE_TTL", "1800"))               # seconds
+PROBE_CACHE_SIZE = int(os.environ.get("PROBE_CACHE_SIZE", "256"))    # entries (full info ~100-300 KB each)
+MAX_DURATION = float(os.environ.get("MAX_DURATION_SECONDS", "0"))     # 0 = no limit
+PROBES: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()   # source_key -> (expires, summary, info)
+PROBE_STATS = {"hits": 0, "misses": 0}
+_probe_lock = threading.Lock()
+# bulky parts of the info dict that neither the summary nor the download needs
+_PROBE_DROP = ("automatic_captions", "subtitles", "thumbnails", "heatmap", "chapters", "description")
+
+def _probe_info(url: str) -> dict:
+    if JOB_ENGINE == "inprocess":
+        import ytdl_engine
+        try:
+            return _engine().submit(ytdl_engine.probe, url).result()
+        except RuntimeError as e:
+            log.warning("yt-dlp engine: %s", e)
+            raise JobError("Could not read video info")
+    args = ["yt-dlp", "-J", "--skip-download", "--no-playlist", "--no-warnings"]
+    env = _ytdlp_env()
+    if env.get("YTDLP_NO_CHECK_CERTS") == "1":
+        args.append("--no-check-certificates")
+    args.append(url)
+    try:
+        out = subprocess.run(args, env=env, capture_output=True, text=True, check=True, timeout=120).stdout
+        return json.loads(out)
+    except (subprocess.SubprocessError, ValueError):
+        raise JobError("Could not read video info")
+
+def _probe_summary(info: dict) -> dict:
+    dur = info.get("duration")
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "duration": int(dur) if dur is not None else None,
+        "is_live": bool(info.get("is_live")),
+        "uploader": info.get("uploader") or info.get("channel"),
+        "thumbnail": info.get("thumbnail"),
+        "formats": [{"format_id": f.get("format_id"), "ext": f.get("ext"), "acodec": f.get("acodec"),
+                     "abr": f.get("abr"), "asr": f.get("asr"), "filesize": f.get("filesize") or f.get("filesize_approx")}
+                    for f in info.get("formats") or []
+                    if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")],   # audio-only
+    }
+
+def cached_probe(src_key: str, full: bool = False) -> Optional[dict]:
+    """The cached summary (or full info dict) for a source, None if missing or expired."""
+    with _probe_lock:
+        hit = PROBES.get(src_key)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del PROBES[src_key]
+            return None
+        PROBES.move_to_end(src_key)
+        return hit[2] if full else hit[1]
+
+def probe(url: str) -> tuple:
+    """(summary, cached) for one video, extracting it on a cache miss. Raises JobError."""
+    src = source_key(url)
+    summary = cached_probe(src)
+    with _probe_lock:
+        PROBE_STATS["hits" if summary else "misses"] += 1
+    if summary:
+        return summary, True
+    info = _probe_info(url)
+    if info.get("_type") == "playlist" or info.get("entries") is not None:
+        raise JobError("That is a playlist, not a single video")
+    for k in _PROBE_DROP:
+        info.pop(k, None)
+    summary = _probe_summary(info)
+    with _probe_lock:
+        PROBES[src] = (time.monotonic() + PROBE_TTL, summary, info)
+        PROBES.move_to_end(src)
+        while len(PROBES) > PROBE_CACHE_SIZE:
+            PROBES.popitem(last=False)
+    return summary, False
+
+def check_duration(summary: dict, clip: Optional[tuple] = None):
+    """422 if the source (only the clip of it, with `clip`) exceeds MAX_DURATION."""
+    dur = summary.get("duration")
+    if clip and dur and clip[0] >= dur:
+        raise HTTPException(status_code=400, detail="Clip starts after the end of the video")
+    if clip and clip[1] is not None:
+        summary = {**summary, "duration": clip[1] - clip[0]}   # only the clip counts
+    elif clip and dur:
+        summary = {**summary, "duration": dur - clip[0]}
+    if not MAX_DURATION:
+        return
+    if summary.get("is_live"):
+        raise HTTPException(status_code=422, detail="Live streams can't be converted")
+    if (summary.get("duration") or 0) > MAX_DURATION:
+        raise HTTPException(status_code=422, detail=f"Video is longer than the {timedelta(seconds=int(MAX_DURATION))} limit")
+
+def estimate_cost(src_key: str, duration: Optional[int] = None, clip: Optional[tuple] = None) -> tuple:
+    """(cost, known) of converting a source: its duration in seconds, else its probed
+    best-audio filesize at ~128 kbps, else JOB_COST_DEFAULT. A clip costs its own length."""
+    if clip and clip[1] is not None:
+        return max(clip[1] - clip[0], 1.0), True
+    if clip and duration:
+        return max(duration - clip[0], 1.0), True
+    if duration:
+        return float(duration), True
+    meta = cached_probe(src_key)
+    if meta:
+        if meta.get("duration"):
+            return float(meta["duration"]), True
+        sizes = [f["filesize"] for f in meta.get("formats") or [] if f.get("filesize")]
+        if sizes:
+            return max(sizes) / 16000.0, True
+    return JOB_COST_DEFAULT, False
+
+def _publish_progress(job: Job, stage: str, force: bool = False, **fields):
+    """Record the job's latest progress and push it to subscribers (rate-limited unless the
+    stage changes or `force`)."""
+    now = time.monotonic()
+    with _inflight_lock:
+        changed = stage != job.progress.get("stage")
+        force = force or changed
+        snap = {"stage": stage, **{k: v for k, v in fields.items() if v is not None}}
+        done, total = fields.get("downloaded_bytes"), fields.get("total_bytes")
+        if done is not None and total:
+            snap["percent"] = round(min(100.0, done * 100.0 / total), 1)
+        job.progress = snap
+        if not force and now - job.last_publish < PROGRESS_MIN_INTERVAL:
+            return
+        job.last_publish = now
+        event = {"type": "progress", "owners": dict(job.owners), "status": job.status, **snap}
+    if changed and stage in ("downloading", "converting"):
+        _update_job(job.id, stage=stage, **{f"{stage}_at": datetime.utcnow()})
+    BUS.publish(event)
+
+def publish_video(kind: str, video: Video, **fields):
+    """Publish a created/deleted event for one Video row."""
+    BUS.publish({"type": kind, "owners": {video.id: video.owner_username or ""},
+                 "status": video.status, "filename": video.filename, **fields})
+
+def _update_videos(ids: List[str], **fields):
     db = SessionLocal()
-    video_id = str(uuid.uuid4())
-    video = Video(id=video_id, url=data.url, status="processing", owner_username=current.username)
-    db.add(video); db.commit()
     try:
-        ffmpeg_loc = os.getenv("FFMPEG_LOCATION")
-        args = [
-            "yt-dlp", "-x", "--audio-format", "mp3",
-            "-o", f"{TMP_DIR}/{video_id}-%(title).200s.%(ext)s", data.url
-        ]
-        if ffmpeg_loc:
-            args.extend(["--ffmpeg-location", ffmpeg_loc])
+        for v in db.query(Video).filter(Video.id.in_(ids)).all():
+            for k, val in fields.items():
+                setattr(v, k, val)
+        db.commit()
+    finally:
+        db.close()
 
-        env = os.environ.copy()
+def _update_job(job_id: str, **fields):
+    db = SessionLocal()
+    try:
+        db.query(JobRecord).filter(JobRecord.id == job_id).update(fields, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def _remove_leftovers(job_id: str, keep: Collection[str] = ()):
+    """Delete a job's intermediate files (.part, .webm, ...): everything in its job directory
+    except the names in `keep`; without `keep` the directory goes too."""
+    work = abs_path(job_dir(job_id))
+    try:
+        names = os.listdir(work)
+    except OSError:
+        return
+    for name in names:
+        if name not in keep:
+            try:
+                os.remove(os.path.join(work, name))
+            except OSError:
+                pass
+    if not keep:
         try:
-            import certifi
-            env.setdefault("SSL_CERT_FILE", certifi.where())
-        except Exception:
+            os.rmdir(work)
+        except OSError:
             pass
-        if env.get("YTDLP_NO_CHECK_CERTS") == "1":
-            args.append("--no-check-certificates")
 
-        if not ffmpeg_loc and not shutil.which("ffmpeg"):
-            raise HTTPException(status_code=500, detail="ffmpeg not found. Install ffmpeg or set FFMPEG_LOCATION.")
+def _dispatch(job: Job):
+    """Hand a new job to the workers, honouring its batch's cap. Caller holds _inflight_lock."""
+    b = job.batch
+    if b is not None:
+        if b.running >= b.cap:
+            b.pending.append(job)
+            return
+        b.running += 1
+    SCHEDULER.put(job)
+
+def _finish_job(job: Job, status: str) -> List[str]:
+    with _inflight_lock:
+        INFLIGHT.pop(job.key, None)
+        job.status = status
+        ids = list(job.video_ids)
+        for vid in ids:
+            VIDEO_JOBS.pop(vid, None)
+        b = job.batch
+        if b is not None:
+            b.running -= 1
+            while b.pending and b.running < b.cap:
+                b.running += 1
+                SCHEDULER.put(b.pending.popleft())
+    return ids
+
+def _run_job(job: Job):
+    with _inflight_lock:
+        job.status = "processing"
+        ids = list(job.video_ids)
+    _update_videos(ids, status="processing")
+    _update_job(job.id, status="processing", stage="starting", started_at=datetime.utcnow(),
+                attempts=JobRecord.attempts + 1)
+    _publish_progress(job, "starting", force=True)
+    preview = None
+    try:
+        on_progress = lambda stage, **f: _publish_progress(job, stage, **f)
+        info = cached_probe(job.source_key, full=True)
+        if info is None and (MAX_DURATION or _wants_preview(job) or _splits_mp3(job)):
+            # /batch items and anything else that reached the queue unprobed. The download
+            # then loads this info instead of extracting the video itself, so it's not extracted twice.
+            try:
+                probe(job.url)
+            except JobError:
+                pass   # the download itself will report what's wrong with the URL
+            info = cached_probe(job.source_key, full=True)
+        if MAX_DURATION and info is not None:
+            try:
+                check_duration(cached_probe(job.source_key) or _probe_summary(info), job.clip)
+            except HTTPException as e:
+                raise JobError(e.detail)
+        if info is not None and _wants_preview(job, info) and _take_slots(1):   # none free: a late preview is no use
+            preview = _preview_pool.submit(_make_preview, job, info)
+        # job.cost stays what the scheduler saw (it counts heavy jobs by it); the probed duration
+        # only decides the MP3 path
+        parallel = _splits_mp3(job, None if job.cost_known
+                               else estimate_cost(job.source_key, (info or {}).get("duration"), job.clip))
+        if job.live:
+            rel, filename, cpu = _convert_live(job, on_progress, info)
+            outputs = [(job.fmt, rel, filename)]
+        elif len(job.formats) > 1 or parallel:
+            peaks = abs_path(os.path.join(job_dir(job.id), PEAKS_NAME)) if _peaks_enabled() else None
+            outputs, cpu = _convert_multi(job.id, job.url, on_progress, info, job.clip, job.formats, parallel, peaks)
+        else:
+            rel, filename, cpu = _convert(job.id, job.url, on_progress, info, job.clip, job.fmt)
+            outputs = [(job.fmt, rel, filename)]
+        preview_cpu = preview.result() if preview else 0.0
+        sizes: Dict[str, int] = {}
+        crcs: Dict[str, int] = {}
+        for _, rel, _ in outputs:
+            if rel not in sizes:   # "source" and its own codec can be the same file
+                # while the file is local: a ZIP export of it needs no read of its own (build_export)
+                crcs[rel] = archive.file_crc32(abs_path(rel))
+                sizes[rel] = STORAGE.put(rel, abs_path(rel), media_type(rel))
+        cpu = _add_cpu(cpu, preview_cpu)
+    except Exception as e:
+        log.warning("job %s failed: %s", job.id, e)
+        if preview:
+            preview.result()   # before its files are removed
+        msg = str(e) if isinstance(e, JobError) else "Download failed"
+        ids = _finish_job(job, "error")
+        for vid in ids:
+            JOB_ERRORS[vid] = msg
+        _update_videos(ids, status="error")
+        _update_job(job.id, status="error", error=msg, finished_at=datetime.utcnow())
+        _remove_leftovers(job.id)
+        if not STORAGE.local:
+            for name in SIDECARS:
+                try:
+                    STORAGE.delete(os.path.join(job_dir(job.id), name))
+                except Exception:
+                    pass
+        _publish_progress(job, "failed", force=True, error=msg)
+        return
+    artifacts = {fmt: [rel, sizes[rel], name] for fmt, rel, name in outputs}
+    _cache_store(job, artifacts, crcs)
+    _, rel, filename = outputs[0]
+    peaks = _peaks_enabled()
+    if peaks:
+        PEAKS_PENDING.add(job_dir(job.id))   # before any row says ready
+    ids = _finish_job(job, "ready")
+    _update_videos(ids, status="ready", filename=filename, path=rel, job_dir=rel_dir(rel), size=sum(sizes.values()),
+                   crc=crcs[rel], artifacts=json.dumps(artifacts) if len(artifacts) > 1 else None)
+    _update_job(job.id, status="ready", stage="done", finished_at=datetime.utcnow(), cpu_seconds=cpu)
+    # e.g. a stale .part a resumed run no longer needed; with remote storage, the whole scratch dir
+    keep = {*SIDECARS, *(os.path.basename(r) for r in sizes)} if STORAGE.local else ()
+    if peaks:
+        _peaks_pool.submit(_make_peaks, job, abs_path(rel), keep)   # removes the leftovers after
+    else:
+        _remove_leftovers(job.id, keep)
+    _publish_progress(job, "done", force=True, filename=filename, cpu_seconds=cpu)
+    JANITOR_WAKE.set()   # quotas are checked as soon as new bytes land
+
+def _job_worker():
+    while True:
+        job = SCHEDULER.get()
+        if job is None:
+            return
+        try:
+            _run_job(job)
+        except Exception:
+            log.exception("job worker crashed on %s", job.id)
+        finally:
+            SCHEDULER.done(job)
+
+def _stream_worker(job: Job):
+    try:
+        _run_job(job)
+    except Exception:
+        log.exception("stream worker crashed on %s", job.id)
+
+def _cache_store(job: Job, artifacts: Dict[str, list], crcs: Dict[str, int]):
+    """One cache entry per output format, so a later request for any one of them is a hit."""
+    db = SessionLocal()
+    try:
+        for fmt, (rel, size, filename) in artifacts.items():
+            db.merge(CacheEntry(key=cache_key(job.source_key, fmt, format_quality(fmt), job.clip),
+                                source_key=job.source_key, audio_format=fmt, audio_quality=format_quality(fmt),
+                                filename=filename, path=rel, job_dir=rel_dir(rel), size=size, crc=crcs.get(rel), hits=0,
+                                created_at=datetime.utcnow()))
+        db.commit()
+    finally:
+        db.close()
+
+def cache_lookup(db, key: str) -> Optional[CacheEntry]:
+    """Return the cache entry for `key` if its file is still stored (stale entries are deleted
+    in the caller's transaction)."""
+    entry = db.query(CacheEntry).filter(CacheEntry.key == key).first()
+    if not entry:
+        return None
+    try:
+        size = STORAGE.size(entry.path or entry.filename)
+    except Exception:
+        log.exception("storage lookup of %s failed", entry.path)
+        return None   # a miss this time, but keep the entry
+    if size is None or (entry.size is not None and size != entry.size):
+        db.delete(entry); db.flush()
+        return None
+    return entry
+
+def submit_jobs(db, urls: List[str], owner: str, batch_id: Optional[str] = None,
+                clip: Optional[tuple] = None, fmt: str = AUDIO_FORMAT,
+                formats: Optional[List[str]] = None, live: bool = False) -> List[Video]:
+    """Create one Video row per URL for `owner`, all in one transaction (together with whatever
+    the caller already added to `db`). Each row is served from the cache, attached to the
+    in-flight job for the same source, or gets a new job. New jobs of a batch run at most
+    BATCH_CONCURRENCY at a time. Raises 503 if the jobs would overflow JOB_QUEUE_MAX.
+    `formats`: several output formats instead of `fmt` (see _convert_multi). `live`: new jobs
+    are streaming jobs, as far as STREAM_MAX allows (see /stream)."""
+    if formats and len(formats) > 1:
+        fmt, fmts = formats[0], json.dumps(formats)
+    else:
+        fmt, fmts = (formats[0] if formats else fmt), None
+    videos = []
+    for url in urls:
+        src = source_key(url)
+        meta = cached_probe(src) or {}
+        videos.append(Video(id=str(uuid.uuid4()), url=url, owner_username=owner, source_key=src, batch_id=batch_id,
+                            title=meta.get("title"), duration=meta.get("duration"),
+                            clip_start=clip[0] if clip else None, clip_end=clip[1] if clip else None,
+                            audio_format=fmt, formats=fmts))
+    return _enqueue(db, videos, owner, batch_id, live)
+
+def _enqueue(db, videos: List[Video], owner: str, batch_id: Optional[str] = None, live: bool = False) -> List[Video]:
+    """submit_jobs for prepared rows, new or existing (see restore_video)."""
+    planned = []
+    for video in videos:
+        entries = [cache_lookup(db, k) for k in format_keys(video)]
+        # a row's artifacts all live in one job directory (Video.job_dir, see release_file)
+        hit = all(entries) and len({e.job_dir for e in entries}) == 1
+        planned.append((video, video_key(video), entries if hit else None))
+
+    run = BatchRun(BATCH_CONCURRENCY) if batch_id else None
+    user = db.query(User).filter(User.username == owner).first()
+    weight = JOB_ADMIN_WEIGHT if user is not None and user.is_admin else 1.0
+    with _inflight_lock:
+        new = {key: video for video, key, entries in planned if not entries and key not in INFLIGHT}
+        if len(INFLIGHT) + len(new) > JOB_QUEUE_MAX:
+            db.rollback()
+            raise HTTPException(status_code=503, detail="Job queue is full, try again later")
+        costs = {key: estimate_cost(video.source_key, video.duration, video_clip(video)) for key, video in new.items()}
+        if JOB_QUEUE_MAX_COST and new and INFLIGHT:   # an idle queue takes anything (MAX_DURATION caps single jobs)
+            queued_cost = sum(j.cost for j in INFLIGHT.values())
+            if queued_cost + sum(c for c, _ in costs.values()) > JOB_QUEUE_MAX_COST:
+                db.rollback()
+                raise HTTPException(status_code=503, detail="Job queue is full (estimated work), try again later",
+                                    headers={"Retry-After": "60"})
+
+        new_jobs = []
+        now = datetime.utcnow()
+        for video, key, entries in planned:
+            job = None
+            if entries:
+                for entry in entries:
+                    entry.hits = (entry.hits or 0) + 1
+                    entry.last_hit_at = now
+                entry = entries[0]
+                video.status, video.filename, video.path, video.size = "ready", entry.filename, entry.path, entry.size
+                video.job_dir, video.crc = entry.job_dir, entry.crc
+                if len(entries) > 1:
+                    video.artifacts = json.dumps({e.audio_format: [e.path or e.filename, e.size, e.filename]
+                                                  for e in entries})
+                    video.size = sum({e.path: e.size or 0 for e in entries}.values())
+                CACHE_STATS["hits"] += 1
+            elif key in INFLIGHT:
+                job = INFLIGHT[key]
+                job.video_ids.append(video.id)
+                job.owners[video.id] = owner
+                VIDEO_JOBS[video.id] = job
+                video.status = job.status
+                CACHE_STATS["coalesced"] += 1
+            else:
+                job = Job(key, video.source_key, video.url, owner, video.id)
+                if video.job_id:
+                    job.id = str(uuid.uuid4())   # the row's earlier job keeps its record
+                job.batch = run
+                job.weight = weight
+                job.cost, job.cost_known = costs[key]
+                job.clip = video_clip(video)
+                job.formats = video_formats(video)
+                job.fmt = job.formats[0]
+                if live and sum(1 for j in INFLIGHT.values() if j.live) < STREAM_MAX:
+                    job.live = LiveStream(abs_path(os.path.join(job_dir(job.id), "live.mp3")))
+                INFLIGHT[key] = job
+                VIDEO_JOBS[video.id] = job
+                new_jobs.append(job)
+                video.status = "queued"
+                CACHE_STATS["misses"] += 1
+                db.add(JobRecord(id=job.id, cache_key=key, url=video.url, owner_username=owner, batch_id=batch_id,
+                                 status="queued", stage="queued", queued_at=now,
+                                 audio_format="+".join(job.formats)))
+            if job is not None:
+                video.job_id = job.id
+            db.add(video)
+        try:
+            db.commit()   # rows exist before any worker can report on them
+        except Exception:
+            db.rollback()
+            for job in new_jobs:
+                INFLIGHT.pop(job.key, None)
+            raise
+        for job in new_jobs:
+            if job.live:
+                threading.Thread(target=_stream_worker, args=(job,), name=f"stream-{job.id[:8]}", daemon=True).start()
+            else:
+                _dispatch(job)
+    return videos
+
+def submit_job(db, url: str, owner: str, clip: Optional[tuple] = None, fmt: str = AUDIO_FORMAT,
+               formats: Optional[List[str]] = None) -> Video:
+    return submit_jobs(db, [url], owner, clip=clip, fmt=fmt, formats=formats)[0]
+
+def release_file(db, rel: Optional[str], exclude_ids: List[str]):
+    """Remove an artifact (path relative to TMP_DIR, one of video_files) and its cache entry
+    unless another Video row still points at it. The caller commits.
+    A job directory holds every format of its job and rows may use any of them, so there the
+    whole directory is released together, once no row uses any file in it (indexed job_dir
+    lookups: a row's artifacts are all in one directory, see _enqueue)."""
+    if not rel:
+        return
+    d = rel_dir(rel)
+    if d:
+        same = Video.job_dir == d
+        entries = CacheEntry.job_dir == d
+    else:
+        same = or_(Video.path == rel, and_(Video.path == None, Video.filename == rel))
+        entries = or_(CacheEntry.path == rel, and_(CacheEntry.path == None, CacheEntry.filename == rel))
+    still_used = (db.query(Video)
+                    .filter(same, Video.status != "evicted", Video.id.notin_(exclude_ids))
+                    .count())
+    if still_used:
+        return
+    keys = {rel} | {e.path or e.filename for e in db.query(CacheEntry).filter(entries).all()}
+    if d:
+        keys.update(os.path.join(d, name) for name in SIDECARS)
+    db.query(CacheEntry).filter(entries).delete(synchronize_session=False)
+    try:
+        for key in keys:
+            STORAGE.delete(key)
+        if d:
+            shutil.rmtree(abs_path(d), ignore_errors=True)   # the rest of its job directory
+    except Exception:
+        pass
+
+# Jobs left queued/processing by a previous process: resume them (same job directory, so
+# yt-dlp continues its .part file or reuses a finished download) or fail them and clean up.
+JOB_RESUME = os.environ.get("JOB_RESUME", "1") == "1"
+JOB_RESUME_ATTEMPTS = int(os.environ.get("JOB_RESUME_ATTEMPTS", "3"))       # worker pickups before giving up
+JOB_RESUME_MAX_AGE = timedelta(hours=float(os.environ.get("JOB_RESUME_MAX_AGE_HOURS", "24")))
+SWEEP_BUDGET = float(os.environ.get("SWEEP_BUDGET", "30"))                  # seconds for the TMP_DIR sweep
+INTERRUPTED = "Interrupted by a server restart"
+_UUID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def reconcile_jobs() -> set:
+    """Re-queue or fail the unfinished jobs of the previous run. Only touches unfinished rows
+    (indexed by status), so it costs the same however long the history is. Returns the ids of
+    the resumed jobs, whose temp files must be kept."""
+    db = SessionLocal()
+    now = datetime.utcnow()
+    resume: List[tuple] = []
+    failed: List[str] = []
+    try:
+        admins = {u.username for u in db.query(User).filter(User.is_admin == True).all()}
+        recs = (db.query(JobRecord)
+                  .filter(JobRecord.status.in_(("queued", "processing")))
+                  .order_by(JobRecord.queued_at)
+                  .all())
+        keys = set()
+        for rec in recs:
+            videos = (db.query(Video)
+                        .filter(Video.job_id == rec.id, Video.status.in_(("queued", "processing")))
+                        .all())
+            if (JOB_RESUME and videos and (rec.attempts or 0) < JOB_RESUME_ATTEMPTS
+                    and rec.queued_at and now - rec.queued_at < JOB_RESUME_MAX_AGE
+                    and rec.cache_key not in keys and len(resume) < JOB_QUEUE_MAX):
+                keys.add(rec.cache_key)
+                rec.status, rec.stage = "queued", "queued"
+                for v in videos:
+                    v.status = "queued"
+                duration = max((v.duration or 0 for v in videos), default=0)
+                resume.append((rec.id, rec.cache_key, rec.url, rec.owner_username,
+                               [(v.id, v.owner_username) for v in videos], duration, video_clip(videos[0]),
+                               video_formats(videos[0])))
+            else:
+                rec.status, rec.error, rec.finished_at = "error", INTERRUPTED, now
+                failed.append(rec.id)
+                for v in videos:
+                    v.status = "error"
+                    JOB_ERRORS[v.id] = INTERRUPTED
+        # rows stuck mid-job from before jobs were recorded
+        for v in (db.query(Video)
+                    .filter(Video.status.in_(("queued", "processing")), Video.job_id == None)
+                    .all()):
+            v.status = "error"
+            JOB_ERRORS[v.id] = INTERRUPTED
+        db.commit()
+    finally:
+        db.close()
+    for job_id in failed:
+        _remove_leftovers(job_id)
+
+    with _inflight_lock:
+        for job_id, key, url, owner, videos, duration, clip, formats in resume:
+            job = Job(key, source_key(url), url, owner, job_id)
+            job.clip, job.fmt, job.formats = clip, formats[0], formats
+            job.cost, job.cost_known = estimate_cost(job.source_key, duration, clip)
+            job.video_ids = [vid for vid, _ in videos]
+            job.owners = {vid: o or "" for vid, o in videos}
+            job.weight = JOB_ADMIN_WEIGHT if owner in admins else 1.0
+            INFLIGHT[key] = job
+            for vid in job.video_ids:
+                VIDEO_JOBS[vid] = job
+            _dispatch(job)   # batch caps are not restored; the per-user cap still applies
+    if resume or recs:
+        log.info("startup: resumed %d interrupted job(s), failed %d", len(resume), len(recs) - len(resume))
+    return {r[0] for r in resume}
+
+def _sweep_leftovers(keep: set, before: float):
+    """Remove temp files ({job id}-*) that jobs from before the sharded layout left in TMP_DIR
+    itself. Streams the directory and stops after SWEEP_BUDGET seconds; files newer than
+    `before` (this process's start) are left alone."""
+    deadline = time.monotonic() + SWEEP_BUDGET
+    removed = 0
+    try:
+        with os.scandir(TMP_DIR) as it:
+            for entry in it:
+                if time.monotonic() > deadline:
+                    log.warning("startup sweep of %s stopped after %.0fs", TMP_DIR, SWEEP_BUDGET)
+                    break
+                name = entry.name
+                if len(name) < 38 or name[36] != "-" or not _UUID_RE.match(name[:36]) or name[:36] in keep:
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < before:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+    except OSError:
+        log.exception("startup sweep of %s failed", TMP_DIR)
+    if removed:
+        log.info("startup sweep removed %d leftover file(s) from %s", removed, TMP_DIR)
+
+@app.on_event("startup")
+def _start_job_workers():
+    keep = reconcile_jobs()
+    threading.Thread(target=_sweep_leftovers, args=(keep, time.time()), name="tmp-sweep", daemon=True).start()
+    for i in range(max(1, JOB_WORKERS)):
+        t = threading.Thread(target=_job_worker, name=f"job-worker-{i}", daemon=True)
+        t.start()
+        _job_threads.append(t)
+    if JOB_ENGINE == "inprocess":
+        try:
+            import ytdl_engine
+            pool = _engine()
+            for _ in range(max(1, JOB_WORKERS)):
+                pool.submit(ytdl_engine.warm, AUDIO_FORMAT, AUDIO_QUALITY, OUTPUT_FORMATS[AUDIO_FORMAT][1])   # spawn + preload before the first job
+        except Exception:
+            log.exception("could not start the yt-dlp engine; jobs will use the CLI")
+
+@app.on_event("shutdown")
+def _stop_job_workers():
+    SCHEDULER.stop(len(_job_threads))
+    _job_threads.clear()
+    _drop_engine()
+
+@app.get("/admin/cache_stats", tags=["admin"], summary="Admin Conversion Cache Stats")
+def admin_cache_stats(authorization: str = Header(None)):
+    admin = _get_user_by_token(authorization)
+    if not admin.is_admin:
+        raise HTTPException(status_code=403, detail="Admins only")
+    db = SessionLocal()
+    try:
+        entries = db.query(CacheEntry).all()
+        with _inflight_lock:
+            stats = dict(CACHE_STATS)
+        lookups = stats["hits"] + stats["misses"]
+        with _probe_lock:
+            probes = {**PROBE_STATS, "entries": len(PROBES), "max_entries": PROBE_CACHE_SIZE, "ttl": PROBE_TTL}
+        return {
+            **stats,
+            "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else None,
+            "entries": len(entries),
+            "bytes": sum(e.size or 0 for e in entries),
+            "total_hits": sum(e.hits or 0 for e in entries),
+            "probe": probes,
+        }
+    finally:
+        db.close()
+
+@app.get("/admin/scheduler", tags=["admin"], summary="Admin Job Scheduler Stats")
+def admin_scheduler(authorization: str = Header(None)):
+    admin = _get_user_by_token(authorization)
+    if not admin.is_admin:
+        raise HTTPException(status_code=403, detail="Admins only")
+    return {
+        "workers": max(1, JOB_WORKERS),
+        "per_user": SCHEDULER.per_user,
+        "admin_weight": JOB_ADMIN_WEIGHT,
+        "sjf": SCHEDULER.sjf,
+        "heavy_cost": JOB_HEAVY_COST,
+        "heavy_slots": SCHEDULER.heavy_slots,
+        "queued_cost": round(sum(j.cost for j in list(INFLIGHT.values()))),
+        "max_queued_cost": JOB_QUEUE_MAX_COST or None,
+        "users": SCHEDULER.stats(),   # queue wait in seconds, p50/p95 over the last 200 jobs
+        "cost_buckets": SCHEDULER.bucket_stats(),
+    }
+
+@app.get("/admin/job_cpu", tags=["admin"], summary="Admin CPU Seconds per Job by Output Format")
+def admin_job_cpu(authorization: str = Header(None)):
+    admin = _get_user_by_token(authorization)
+    if not admin.is_admin:
+        raise HTTPException(status_code=403, detail="Admins only")
+    db = SessionLocal()
+    try:
+        rows = (db.query(JobRecord.audio_format, JobRecord.cpu_seconds)
+                  .filter(JobRecord.status == "ready", JobRecord.cpu_seconds != None)
+                  .order_by(JobRecord.finished_at.desc())
+                  .limit(5000)
+                  .all())
+    finally:
+        db.close()
+    by_fmt: Dict[str, List[float]] = {}
+    for fmt, cpu in rows:
+        by_fmt.setdefault(fmt or AUDIO_FORMAT, []).append(cpu)
+    out = {}
+    for fmt, xs in sorted(by_fmt.items()):
+        xs.sort()
+        out[fmt] = {
+            "jobs": len(xs),
+            "cpu_seconds_total": round(sum(xs), 2),
+            "cpu_seconds_avg": round(sum(xs) / len(xs), 3),
+            "cpu_seconds_p50": round(xs[len(xs) // 2], 3),
+            "cpu_seconds_p95": round(xs[min(len(xs) - 1, int(len(xs) * 0.95))], 3),
+        }
+    return out   # over the last 5000 successful jobs
+
+# -------------------- Storage quotas --------------------
+# A janitor thread keeps the converted files within byte quotas by evicting the least recently
+# downloaded ones (and, optionally, anything not downloaded for STORAGE_MAX_AGE_DAYS). Evicted
+# rows keep their title but lose their file (status "evicted"); POST /restore/{file_id} converts
+# them again. 0 disables a limit.
+STORAGE_QUOTA = int(os.environ.get("STORAGE_QUOTA_BYTES", "0"))             # all artifacts together
+STORAGE_USER_QUOTA = int(os.environ.get("STORAGE_USER_QUOTA_BYTES", "0"))   # per user (shared files count for each)
+STORAGE_MAX_AGE_DAYS = float(os.environ.get("STORAGE_MAX_AGE_DAYS", "0"))
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "300"))         # seconds between passes
+JANITOR_WAKE = threading.Event()
+JANITOR_STATS = {"runs": 0, "evicted": 0, "evicted_bytes": 0, "last_run": None}
+
+ACCESS_TIMES: Dict[str, datetime] = {}   # file_id -> last download, written to Video.accessed_at by the janitor
+
+def touch(file_id: str):
+    ACCESS_TIMES[file_id] = datetime.utcnow()
+
+def _flush_access(db):
+    while ACCESS_TIMES:
+        fid, at = ACCESS_TIMES.popitem()
+        db.query(Video).filter(Video.id == fid).update({"accessed_at": at}, synchronize_session=False)
+    db.commit()
+
+_artifact = func.coalesce(Video.path, Video.filename)
+_last_used = func.coalesce(Video.accessed_at, Video.timestamp)
+
+def _fill_sizes(db, limit: int = 1000):
+    """Record sizes of ready rows that predate size tracking (a bounded batch per pass)."""
+    for v in db.query(Video).filter(Video.status == "ready", Video.size == None).limit(limit).all():
+        rel = v.path or v.filename
+        try:
+            v.size = (STORAGE.size(rel) if rel else 0) or 0
+        except Exception:
+            v.size = 0
+    db.commit()
+
+def _evict(db, rows: List[Video]) -> int:
+    """Mark rows evicted and delete their artifact once no ready row uses it. Returns bytes freed."""
+    freed = 0
+    by_rel: Dict[str, List[Video]] = {}
+    for v in rows:
+        by_rel.setdefault(v.path or v.filename, []).append(v)
+    for rel, vs in by_rel.items():
+        ids = [v.id for v in vs]
+        existed = STORAGE.exists(rel)
+        release_file(db, rel, ids)
+        for other in {r for v in vs for r in video_files(v)} - {rel}:
+            release_file(db, other, ids)
+        if existed and not STORAGE.exists(rel):
+            freed += vs[0].size or 0
+        for v in vs:
+            v.status, v.path, v.size, v.artifacts, v.job_dir = "evicted", None, None, None, None
+    db.commit()
+    for vs in by_rel.values():
+        for v in vs:
+            publish_video("evicted", v)
+    return freed
+
+def storage_usage(db) -> dict:
+    total = (db.query(func.max(Video.size))
+               .filter(Video.status == "ready")
+               .group_by(_artifact)
+               .all())
+    users = (db.query(Video.owner_username, func.sum(Video.size))
+               .filter(Video.status == "ready")
+               .group_by(Video.owner_username)
+               .all())
+    return {"bytes": sum(t[0] or 0 for t in total), "files": len(total),
+            "users": {u or "": int(b or 0) for u, b in users}}
+
+def janitor_pass() -> dict:
+    """One eviction pass: age limit, then per-user quotas, then the global quota (LRU first)."""
+    db = SessionLocal()
+    evicted = freed = 0
+    try:
+        _flush_access(db)
+        _fill_sizes(db)
+        ready = db.query(Video).filter(Video.status == "ready")
+
+        if STORAGE_MAX_AGE_DAYS > 0:
+            cutoff = datetime.utcnow() - timedelta(days=STORAGE_MAX_AGE_DAYS)
+            stale = [r[0] for r in (db.query(_artifact)
+                                      .filter(Video.status == "ready")
+                                      .group_by(_artifact)
+                                      .having(func.max(_last_used) < cutoff)
+                                      .all())]
+            if stale:
+                rows = ready.filter(_artifact.in_(stale)).all()
+                freed += _evict(db, rows); evicted += len(rows)
 
-        subprocess.run(args, check=True, env=env)
+        if STORAGE_USER_QUOTA > 0:
+            for owner, used in storage_usage(db)["users"].items():
+                if used <= STORAGE_USER_QUOTA:
+                    continue
+                victims = []
+                for v in ready.filter(Video.owner_username == owner).order_by(_last_used).all():
+                    if used <= STORAGE_USER_QUOTA:
+                        break
+                    victims.append(v)
+                    used -= v.size or 0
+                freed += _evict(db, victims); evicted += len(victims)
 
-        matches = glob.glob(f"{TMP_DIR}/{video_id}-*.mp3")
-        if not matches:
-            video.status = "error"; db.commit()
-            raise HTTPException(status_code=500, detail="MP3 not found")
-        original_path = matches[0]
-        original_filename = os.path.basename(original_path)
-        trimmed_filename = original_filename[len(video_id) + 1:]
-        new_path = os.path.join(TMP_DIR, trimmed_filename)
-        os.rename(original_path, new_path)
-        video.status = "ready"; video.filename = trimmed_filename; db.commit()
-        return {"file_id": video_id, "filename": trimmed_filename}
-    except subprocess.CalledProcessError:
-        video.status = "error"; db.commit()
-        raise HTTPException(status_code=500, detail="Download failed")
+        if STORAGE_QUOTA > 0:
+            used = storage_usage(db)["bytes"]
+            if used > STORAGE_QUOTA:
+                lru = (db.query(_artifact, func.max(Video.size))
+                         .filter(Video.status == "ready")
+                         .group_by(_artifact)
+                         .order_by(func.max(_last_used))
+                         .all())
+                victims = []
+                for rel, size in lru:
+                    if used <= STORAGE_QUOTA:
+                        break
+                    victims.append(rel)
+                    used -= size or 0
+                rows = ready.filter(_artifact.in_(victims)).all()
+                freed += _evict(db, rows); evicted += len(rows)
+    finally:
+        db.close()
+    JANITOR_STATS["runs"] += 1
+    JANITOR_STATS["evicted"] += evicted
+    JANITOR_STATS["evicted_bytes"] += freed
+    JANITOR_STATS["last_run"] = datetime.utcnow().isoformat()
+    if evicted:
+        log.info("janitor evicted %d row(s), freed %d bytes", evicted, freed)
+    return {"evicted": evicted, "freed_bytes": freed}
+
+def _janitor():
+    while True:
+        JANITOR_WAKE.wait(JANITOR_INTERVAL)
+        JANITOR_WAKE.clear()
+        try:
+            janitor_pass()
+        except Exception:
+            log.exception("janitor pass failed")
+
+@app.on_event("startup")
+def _start_janitor():
+    if STORAGE_QUOTA or STORAGE_USER_QUOTA or STORAGE_MAX_AGE_DAYS:
+        threading.Thread(target=_janitor, name="storage-janitor", daemon=True).start()
+        JANITOR_WAKE.set()
+
+@app.on_event("shutdown")
+def _save_access_times():
+    db = SessionLocal()
+    try:
+        _flush_access(db)
+    finally:
+        db.close()
+
+@app.get("/admin/storage", tags=["admin"], summary="Admin Storage Usage")
+def admin_storage(authorization: str = Header(None)):
+    admin = _get_user_by_token(authorization)
+    if not admin.is_admin:
+        raise HTTPException(status_code=403, detail="Admins only")
+    db = SessionLocal()
+    try:
+        return {
+            **storage_usage(db),
+            "quota": STORAGE_QUOTA or None,
+            "user_quota": STORAGE_USER_QUOTA or None,
+            "max_age_days": STORAGE_MAX_AGE_DAYS or None,
+            "evicted_rows": db.query(Video).filter(Video.status == "evicted").count(),
+            "janitor": dict(JANITOR_STATS),
+        }
     finally:
         db.close()
 
+# -------------------- Video endpoints --------------------
+class VideoRequest(BaseModel):
+    url: str
+    start: Optional[Union[float, str]] = None   # clip: seconds or [[h:]m:]s, e.g. "1:30"
+    end: Optional[Union[float, str]] = None
+    format: str = AUDIO_FORMAT                  # mp3 | opus | m4a | source (see OUTPUT_FORMATS)
+    formats: Optional[List[str]] = None         # several of them from one download + decode, instead of format
+
+def check_format(fmt: str):
+    if fmt not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(OUTPUT_FORMATS)}")
+
+def check_formats(formats: Optional[List[str]]) -> Optional[List[str]]:
+    """Validated `formats`, duplicates dropped (order kept: the first is the main artifact)."""
+    if formats is None:
+        return None
+    if not formats:
+        raise HTTPException(status_code=400, detail="formats must not be empty")
+    for fmt in formats:
+        check_format(fmt)
+    return list(dict.fromkeys(formats))
+
+def parse_time(v) -> Optional[float]:
+    if v is None or v == "":
+        return None
+    try:
+        if isinstance(v, str) and ":" in v:
+            t = 0.0
+            for part in v.strip().split(":"):
+                t = t * 60 + float(part)
+        else:
+            t = float(v)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid time {v!r}")
+    if t < 0 or t != t or t == float("inf"):
+        raise HTTPException(status_code=400, detail=f"Invalid time {v!r}")
+    return round(t, 3)
+
+def parse_clip(start, end) -> Optional[tuple]:
+    start, end = parse_time(start), parse_time(end)
+    if start is None and end is None:
+        return None
+    start = start or 0.0
+    if end is not None and end - start < 1:
+        raise HTTPException(status_code=400, detail="A clip must be at least one second long")
+    return start, end
+
+@app.post("/download", tags=["videos"], summary="Start YouTube → MP3", status_code=202)
+def download_video(data: VideoRequest, response: Response, authorization: str = Header(None)):
+    current = _get_user_by_token(authorization)
+    if not os.getenv("FFMPEG_LOCATION") and not shutil.which("ffmpeg"):
+        raise HTTPException(status_code=500, detail="ffmpeg not found. Install ffmpeg or set FFMPEG_LOCATION.")
+    clip = parse_clip(data.start, data.end)
+    check_format(data.format)
+    formats = check_formats(data.formats)
+    if MAX_DURATION or JOB_PROBE:
+        try:
+            summary = probe(data.url)[0]
+        except JobError:
+            summary = None   # the job itself will report what's wrong with the URL
+        if summary:
+            check_duration(summary, clip)
+    db = SessionLocal()
+    try:
+        video = submit_job(db, data.url, current.username, clip, data.format, formats)
+        publish_video("created", video)
+        if video.status == "ready":
+            response.status_code = 200   # served from cache
+        return {"file_id": video.id, "status": video.status, "filename": video.filename,
+                "title": video.title, "duration": video.duration,
+                "start": video.clip_start, "end": video.clip_end, "format": video_format(video),
+                "formats": video_formats(video)}
+    finally:
+        db.close()
+
+@app.get("/probe", tags=["videos"], summary="Video metadata (title, duration, formats) without downloading")
+def probe_video(url: str, authorization: str = Header(None)):
+    _ = _get_user_by_token(authorization)
+    try:
+        summary, cached = probe(url)
+    except JobError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    allowed = True
+    try:
+        check_duration(summary)
+    except HTTPException:
+        allowed = False
+    return {**summary, "cached": cached, "allowed": allowed, "max_duration": int(MAX_DURATION) or None}
+
+def video_state(video: Video) -> dict:
+    """Status snapshot for one Video row, merged with the live progress of its job (if any)."""
+    st = {"file_id": video.id, "status": video.status, "filename": video.filename}
+    job = VIDEO_JOBS.get(video.id)
+    if job is not None:
+        with _inflight_lock:
+            st.update(job.progress)
+            st["status"] = job.status
+    if st["status"] == "error":
+        st["error"] = JOB_ERRORS.get(video.id)
+    return st
+
 @app.get("/status/{file_id}", tags=["videos"], summary="Check Download Status")
 def check_status(file_id: str, authorization: str = Header(None)):
     _ = _get_user_by_token(authorization)
     db = SessionLocal()
+    try:
+        video = db.query(Video).filter(Video.id == file_id).first()
+        if not video:
+            return {"ready": False, "status": "unknown"}
+        rel = video.path or video.filename
+        ready = video.status == "ready" and bool(rel) and STORAGE.exists(rel)
+        st = video_state(video)
+        return {
+            "ready": ready,
+            "status": video.status,
+            "filename": video.filename,
+            "title": video.title,
+            "duration": video.duration,
+            "format": video_format(video),
+            "formats": video_formats(video),
+            "error": JOB_ERRORS.get(file_id) if video.status == "error" else None,
+            "progress": {k: v for k, v in st.items() if k not in ("file_id", "status", "filename", "error")} or None,
+        }
+    finally:
+        db.close()
+
+# -------------------- Batches / playlists --------------------
+class BatchRequest(BaseModel):
+    urls: List[str] = []
+    playlist_url: Optional[str] = None
+    format: str = AUDIO_FORMAT
+    formats: Optional[List[str]] = None
+
+def _expand_batch(batch_id: str, owner: str, playlist_url: str, urls: List[str], fmt: str = AUDIO_FORMAT,
+                  formats: Optional[List[str]] = None):
+    """Background part of POST /batch for playlists: flat-extract, then create all items."""
+    db = SessionLocal()
+    try:
+        batch = db.query(Batch).filter(Batch.id == batch_id).first()
+        try:
+            urls = (urls + expand_playlist(playlist_url))[:BATCH_MAX_ITEMS]
+            if not urls:
+                raise JobError("Playlist is empty")
+            batch.status, batch.total = "running", len(urls)
+            videos = submit_jobs(db, urls, owner, batch_id=batch_id, fmt=fmt, formats=formats)
+        except (JobError, HTTPException) as e:
+            db.rollback()
+            batch = db.query(Batch).filter(Batch.id == batch_id).first()
+            batch.status = "failed"
+            batch.error = str(e.detail if isinstance(e, HTTPException) else e)
+            db.commit()
+            return
+        for v in videos:
+            publish_video("created", v)
+    except Exception:
+        log.exception("batch %s expansion failed", batch_id)
+    finally:
+        db.close()
+
+@app.post("/batch", tags=["videos"], summary="Start many conversions (URL list or playlist)", status_code=202)
+def start_batch(data: BatchRequest, authorization: str = Header(None)):
+    current = _get_user_by_token(authorization)
+    if not data.urls and not data.playlist_url:
+        raise HTTPException(status_code=400, detail="Give urls or a playlist_url")
+    if len(data.urls) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} URLs per batch")
+    check_format(data.format)
+    formats = check_formats(data.formats)
+    if not os.getenv("FFMPEG_LOCATION") and not shutil.which("ffmpeg"):
+        raise HTTPException(status_code=500, detail="ffmpeg not found. Install ffmpeg or set FFMPEG_LOCATION.")
+    db = SessionLocal()
+    try:
+        batch = Batch(id=str(uuid.uuid4()), owner_username=current.username, playlist_url=data.playlist_url)
+        if data.playlist_url:
+            # flat extraction can take a while on long playlists: answer now, expand in the background
+            batch.status = "expanding"
+            db.add(batch); db.commit()
+            threading.Thread(target=_expand_batch, name=f"batch-{batch.id[:8]}", daemon=True,
+                             args=(batch.id, current.username, data.playlist_url, list(data.urls), data.format,
+                                   formats)).start()
+            return {"batch_id": batch.id, "status": batch.status, "total": None, "items": []}
+        batch.status, batch.total = "running", len(data.urls)
+        db.add(batch)
+        videos = submit_jobs(db, data.urls, current.username, batch_id=batch.id, fmt=data.format,
+                             formats=formats)   # commits batch + items
+        for v in videos:
+            publish_video("created", v)
+        return {
+            "batch_id": batch.id, "status": batch.status, "total": batch.total,
+            "items": [{"file_id": v.id, "url": v.url, "status": v.status, "filename": v.filename} for v in videos],
+        }
+    finally:
+        db.close()
+
+@app.get("/batch/{batch_id}", tags=["videos"], summary="Batch progress")
+def batch_status(batch_id: str, authorization: str = Header(None)):
+    current = _get_user_by_token(authorization)
+    db = SessionLocal()
+    try:
+        batch = db.query(Batch).filter(Batch.id == batch_id).first()
+        if not batch or (batch.owner_username != current.username and not current.is_admin):
+            raise HTTPException(status_code=404, detail="Batch not found")
+        items = [video_state(v) for v in
+                 db.query(Video).filter(Video.batch_id == batch_id).order_by(Video.timestamp).all()]
+        counts: Dict[str, int] = {}
+        for it in items:
+            counts[it["status"]] = counts.get(it["status"], 0) + 1
+        finished = counts.get("ready", 0) + counts.get("error", 0)
+        total = batch.total or len(items)
+        # finished items count fully, running ones by their download percent
+        work = finished + sum((it.get("percent") or 0) / 100.0 for it in items if it["status"] == "processing")
+        status = batch.status
+        if status == "running" and items and finished == len(items):
+            status = "done"
+        return {
+            "batch_id": batch.id,
+            "status": status,
+            "playlist_url": batch.playlist_url,
+            "error": batch.error,
+            "total": total,
+            "counts": counts,
+            "done": counts.get("ready", 0),
+            "failed": counts.get("error", 0),
+            "percent": round(work * 100.0 / total, 1) if total else None,
+            "items": items,
+        }
+    finally:
+        db.close()
+
+SSE_KEEPALIVE = 15   # seconds
+WS_PING = 25         # seconds of silence before the socket sends {"type": "ping"}
+TERMINAL_STATES = ("ready", "error", "deleted")
+
+def _event_for(ev: dict, file_id: str) -> dict:
+    """Client view of a bus event for one of its file_ids."""
+    out = {k: v for k, v in ev.items() if k != "owners"}
+    out["file_id"] = file_id
+    if out.get("status") == "error":
+        out.setdefault("error", JOB_ERRORS.get(file_id))
+    return out
+
+def _sse(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+def _load_video_state(file_id: str) -> Optional[dict]:
+    db = SessionLocal()
+    try:
+        video = db.query(Video).filter(Video.id == file_id).first()
+        return video_state(video) if video else None
+    finally:
+        db.close()
+
+@app.get("/events/{file_id}", tags=["videos"], summary="Job Progress Stream (SSE)")
+async def job_events(file_id: str, authorization: Optional[str] = Header(None), token: Optional[str] = None):
+    """Server-Sent Events: one `data:` JSON message per stage/progress change of the job behind
+    `file_id` (status, stage, downloaded_bytes, total_bytes, percent, eta, speed). The stream
+    ends after the ready/error event. EventSource can't send headers, so `?token=` takes a URL
+    token (POST /url_token) too."""
+    if token:
+        if not _username_from_url_token(token):
+            raise HTTPException(status_code=401, detail="Invalid token")
+    else:
+        await run_in_threadpool(_get_user_by_token, authorization)
+
+    q, _, _ = BUS.subscribe(lambda ev: file_id in ev["owners"])   # before the snapshot, so nothing is missed
+    state = await run_in_threadpool(_load_video_state, file_id)
+    if state is None:
+        BUS.unsubscribe(q)
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    async def stream():
+        try:
+            yield "retry: 3000\n" + _sse(state)
+            if state["status"] in TERMINAL_STATES:
+                return
+            while True:
+                try:
+                    ev = await asyncio.wait_for(q.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                out = _event_for(ev, file_id)
+                yield _sse(out)
+                if out["status"] in TERMINAL_STATES:
+                    return
+        finally:
+            BUS.unsubscribe(q)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _drain_socket(ws: WebSocket):
+    try:
+        while True:
+            if (await ws.receive())["type"] == "websocket.disconnect":
+                return
+    except Exception:
+        return
+
+@app.websocket("/ws")
+async def user_socket(ws: WebSocket, token: Optional[str] = None, cursor: Optional[int] = None,
+                      epoch: Optional[str] = None):
+    """One socket per session with state changes of all of the user's videos.
+
+    Auth: `?token=<URL token>` (POST /url_token) or an `Authorization: Bearer` header with the
+    session token. The first message is
+    {"type": "hello", "epoch": E, "cursor": N}; every later event carries its `seq`. To resume
+    after a reconnect, pass `?epoch=E&cursor=<last seen seq>`: missed events are replayed, or
+    {"type": "resync"} is sent when they are no longer retained or the server restarted
+    (reload /my_downloads)."""
+    auth = ws.headers.get("authorization") or ""
+    if token:
+        username = _username_from_url_token(token)
+    elif auth.startswith("Bearer "):
+        username = await run_in_threadpool(_username_from_token, auth.split(" ", 1)[1])
+    else:
+        username = None
+    if not username:
+        await ws.close(code=4401)
+        return
+    await ws.accept()
+
+    if cursor is not None and epoch != BUS.epoch:
+        cursor = -1   # cursor from a previous server process: forces a resync
+    q, backlog, head = BUS.subscribe(lambda ev: username in ev["owners"].values(), since=cursor)
+    receiver = asyncio.ensure_future(_drain_socket(ws))
+    getter = None
+    try:
+        await ws.send_json({"type": "hello", "user": username, "epoch": BUS.epoch, "cursor": head})
+        if cursor is not None:
+            if backlog is None:
+                await ws.send_json({"type": "resync", "cursor": head})
+            else:
+                for ev in backlog:
+                    for fid, owner in ev["owners"].items():
+                        if owner == username:
+                            await ws.send_json(_event_for(ev, fid))
+        while True:
+            getter = getter or asyncio.ensure_future(q.get())
+            done, _ = await asyncio.wait({getter, receiver}, timeout=WS_PING,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                break
+            if getter in done:
+                ev = getter.result(); getter = None
+                for fid, owner in ev["owners"].items():
+                    if owner == username:
+                        await ws.send_json(_event_for(ev, fid))
+            else:
+                await ws.send_json({"type": "ping"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        BUS.unsubscribe(q)
+        receiver.cancel()
+        if getter:
+            getter.cancel()
+
+# -------------------- File responses --------------------
+# Downloads answer Range requests themselves (single range or multipart/byteranges), so seeking
+# in <audio> or resuming an interrupted download only moves the missing bytes, and revalidate
+# with a strong ETag (If-None-Match -> 304, If-Range -> ranges only while the file is unchanged).
+MAX_RANGES = 16          # more ranges than this in one request: send the whole file instead
+FILE_CHUNK = 64 * 1024
+# FILE_SERVING=direct (default): this process sends the bytes.
+# FILE_SERVING=x-accel: answer with X-Accel-Redirect: {X_ACCEL_PREFIX}<path in TMP_DIR> and let
+#   nginx send the file from an `internal` location aliased to TMP_DIR (docs/nginx-x-accel.conf).
+# FILE_SERVING=x-sendfile: answer with X-Sendfile: <absolute path> (Apache mod_xsendfile, lighttpd).
+# The proxy then also does Range / If-None-Match itself.
+FILE_SERVING = os.environ.get("FILE_SERVING", "direct")
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/_files/")
+
+def file_etag(path: str, st: os.stat_result) -> str:
+    """Strong validator. Artifacts are written once into their own job directory and never
+    modified in place, so path + size + mtime identify the bytes."""
+    return '"%s"' % hashlib.sha1(f"{path}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+
+def parse_ranges(header: str, size: int) -> Optional[List[tuple]]:
+    """'bytes=0-99,200-,-50' -> sorted, merged [(start, end_exclusive)].
+    None: header not usable, serve the whole file. []: nothing satisfiable (416)."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    parts = spec.split(",")
+    if len(parts) > MAX_RANGES:
+        return None
+    ranges = []
+    for part in parts:
+        first, sep, last = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first == "":   # suffix range: the last N bytes
+                n = int(last)
+                if n <= 0:
+                    continue
+                start, end = max(0, size - n), size
+            else:
+                start = int(first)
+                end = int(last) + 1 if last else max(size, start + 1)
+                if start < 0 or end <= start:
+                    return None
+                end = min(end, size)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    merged: List[tuple] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match comparison (weak: W/ prefixes are ignored)."""
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in (t[2:] if t.startswith("W/") else t for t in tags)
+
+def _read_range(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            chunk = f.read(min(FILE_CHUNK, left))
+            if not chunk:
+                return
+            left -= len(chunk)
+            yield chunk
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def send_file(request: Request, path: str, media_type: str, filename: str) -> Response:
+    """FileResponse with conditional and Range handling, or a hand-off to the front proxy."""
+    if FILE_SERVING in ("x-accel", "x-sendfile"):
+        headers = {"Content-Disposition": _content_disposition(filename), "Cache-Control": "private"}
+        if FILE_SERVING == "x-accel":
+            rel = os.path.relpath(path, TMP_DIR).replace(os.sep, "/")
+            headers["X-Accel-Redirect"] = X_ACCEL_PREFIX.rstrip("/") + "/" + quote(rel)
+        else:
+            headers["X-Sendfile"] = os.path.abspath(path)
+        return Response(media_type=media_type, headers=headers)
+
+    st = os.stat(path)
+    full = lambda headers: FileResponse(path, media_type=media_type, filename=filename, headers=headers,
+                                        stat_result=st)
+    return ranged_response(request, st.st_size, file_etag(path, st), formatdate(st.st_mtime, usegmt=True),
+                           media_type, filename, lambda start, end: _read_range(path, start, end), full)
+
+def ranged_response(request: Request, size: int, etag: str, last_modified: Optional[str], media_type: str,
+                    filename: str, read: Callable, full: Optional[Callable] = None) -> Response:
+    """Conditional + Range handling for any body of known size. read(start, end) yields bytes
+    [start, end); full(headers), if given, answers a plain GET (default: stream read(0, size))."""
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private"}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+
+    inm = request.headers.get("if-none-match")
+    if inm is not None and _etag_matches(inm, etag):
+        return Response(status_code=304, headers=headers)
+
+    rng = request.headers.get("range")
+    if rng is None and full is not None:
+        return full(headers)
+
+    ranges = None
+    if rng is not None:
+        if_range = request.headers.get("if-range")
+        if if_range is None or if_range.strip() in (etag, last_modified or etag):   # strong comparison
+            ranges = parse_ranges(rng, size)
+    headers["Content-Disposition"] = _content_disposition(filename)
+    if ranges is None:
+        # no or ignored Range (stale If-Range, unusable header): the whole body ourselves,
+        # FileResponse would act on the Range header again
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(read(0, size), media_type=media_type, headers=headers)
+    if not ranges:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["Content-Length"] = str(end - start)
+        return StreamingResponse(read(start, end), status_code=206, media_type=media_type, headers=headers)
+
+    boundary = secrets.token_hex(16)
+    heads = [(f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+              f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode() for start, end in ranges]
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(h) for h in heads) + sum(e - s for s, e in ranges) + 2 * (len(ranges) - 1) + len(tail)
+
+    def body():
+        for i, ((start, end), head) in enumerate(zip(ranges, heads)):
+            yield (b"\r\n" + head) if i else head
+            yield from read(start, end)
+        yield tail
+
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(body(), status_code=206, media_type=f"multipart/byteranges; boundary={boundary}",
+                             headers=headers)
+
+# -------------------- Signed download URLs --------------------
+# POST /download_url/{file_id} hands out a short-lived link that carries everything /download
+# needs (user, expiry, artifact path, download name) under an HMAC, so following it costs no
+# token or Video lookup and the session token never appears in a URL.
+DOWNLOAD_URL_TTL = int(os.environ.get("DOWNLOAD_URL_TTL", "300"))   # seconds
+_URL_KEY = hashlib.sha256(b"ytmp3 download url\0" + SECRET_KEY).digest()
+
+def _url_sig(file_id: str, user: str, exp: int, rel: str, name: str) -> str:
+    msg = "\n".join((file_id, user, str(exp), rel, name)).encode()
+    return base64.urlsafe_b64encode(hmac.new(_URL_KEY, msg, hashlib.sha256).digest()).decode().rstrip("=")
+
+def signed_download_url(video: Video, user: str, fmt: Optional[str] = None) -> tuple:
+    exp = int(time.time()) + DOWNLOAD_URL_TTL
+    rel, name = pick_artifact(video, fmt)
+    params = {"u": user, "exp": exp, "p": rel, "n": name, "sig": _url_sig(video.id, user, exp, rel, name)}
+    return f"/download/{video.id}?{urlencode(params)}", exp
+
+def verify_download_sig(file_id: str, user: str, exp: str, rel: str, name: str, sig: str) -> bool:
+    try:
+        exp_i = int(exp)
+    except (TypeError, ValueError):
+        return False
+    if exp_i < time.time() or None in (user, rel, name):
+        return False
+    return hmac.compare_digest(sig, _url_sig(file_id, user, exp_i, rel, name))
+
+def _accept_q(accept: str, mtype: str) -> float:
+    """Quality the Accept header gives `mtype` (the most specific matching range wins)."""
+    q, best = 0.0, -1
+    for part in accept.split(","):
+        rng, *params = [p.strip() for p in part.split(";")]
+        spec = {mtype: 2, mtype.split("/")[0] + "/*": 1, "*/*": 0}.get(rng.lower(), -1)
+        if spec > best:
+            best, q = spec, 1.0
+            for p in params:
+                if p.startswith("q="):
+                    q = _num(p[2:]) or 0.0
+    return q
+
+def pick_artifact(video: Video, fmt: Optional[str] = None, accept: Optional[str] = None) -> tuple:
+    """(path, download name) of the row's artifact in `fmt`, else the one the Accept header
+    prefers, else the main one."""
+    arts = video_artifacts(video)
+    if fmt:
+        if fmt not in arts:
+            raise HTTPException(status_code=404, detail=f"No {fmt} file, available: {', '.join(arts)}")
+        art = arts[fmt]
+    else:
+        art = next(iter(arts.values()))
+        if accept and len(arts) > 1:
+            q, best = max((_accept_q(accept, media_type(a[0])), -i) for i, a in enumerate(arts.values()))
+            if q > 0:
+                art = list(arts.values())[-best]
+    return art[0], art[2]
+
+def serve_artifact(request: Request, rel: str, filename: str) -> Response:
+    """The artifact itself, or with remote storage a redirect to a presigned URL, so the bytes
+    never pass through this process."""
+    mtype = media_type(rel)
+    if not STORAGE.local:
+        url = STORAGE.url(rel, filename, mtype, DOWNLOAD_URL_TTL)
+        return RedirectResponse(url, status_code=307, headers={"Cache-Control": "no-store"})
+    path = STORAGE.path(rel)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return send_file(request, path, mtype, filename)
+
+@app.post("/download_url/{file_id}", tags=["videos"], summary="Signed, expiring download link")
+def download_url(file_id: str, format: Optional[str] = None, authorization: str = Header(None)):
+    current = _get_user_by_token(authorization)
+    db = SessionLocal()
     try:
         video = db.query(Video).filter(Video.id == file_id).first()
         if not video or not video.filename:
-            return {"ready": False}
-        return {"ready": os.path.exists(os.path.join(TMP_DIR, video.filename))}
+            raise HTTPException(status_code=404, detail="File not found")
+        if video.status == "evicted":
+            raise HTTPException(status_code=410, detail="File was evicted to free space; restore it first")
+        url, exp = signed_download_url(video, current.username, format)
+        return {"url": url, "expires_at": exp}
     finally:
         db.close()
 
-@app.get("/download/{file_id}", tags=["videos"], summary="Download MP3 (via header or token query)")
-def get_file(file_id: str, authorization: Optional[str] = Header(None), token: Optional[str] = None):
+@app.get("/download/{file_id}", tags=["videos"], summary="Download MP3 (signed link, header or token query)")
+def get_file(file_id: str, request: Request, authorization: Optional[str] = Header(None), token: Optional[str] = None,
+             u: Optional[str] = None, exp: Optional[str] = None, p: Optional[str] = None, n: Optional[str] = None,
+             sig: Optional[str] = None, format: Optional[str] = None):
+    """A signed link names its artifact itself. Otherwise, for rows with several formats,
+    `format` picks one, or else the Accept header does (audio/mp4 -> m4a, ...)."""
+    if sig is not None:
+        if not verify_download_sig(file_id, u, exp, p, n, sig):
+            raise HTTPException(status_code=403, detail="Invalid or expired download link")
+        touch(file_id)
+        return serve_artifact(request, p, n)
+
     username = None
     if token:
         username = _username_from_token(token)
@@ -558,10 +3116,209 @@ def get_file(file_id: str, authorization: Optional[str] = Header(None), token: O
         video = db.query(Video).filter(Video.id == file_id).first()
         if not video or not video.filename:
             raise HTTPException(status_code=404, detail="File not found")
-        path = os.path.join(TMP_DIR, video.filename)
-        if not os.path.exists(path):
-            raise HTTPException(status_code=404, detail="File not found")
-        return FileResponse(path, media_type="audio/mpeg", filename=video.filename)
+        if video.status == "evicted":
+            raise HTTPException(status_code=410, detail="File was evicted to free space; restore it first")
+        touch(video.id)
+        rel, name = pick_artifact(video, format, None if format else request.headers.get("accept"))
+        resp = serve_artifact(request, rel, name)
+        if video.artifacts and not format:
+            resp.headers["Vary"] = "Accept"
+        return resp
+    finally:
+        db.close()
+
+@app.get("/preview/{file_id}", tags=["videos"], summary="Short low-bitrate preview (there before the full file)")
+def get_preview(file_id: str, request: Request, authorization: Optional[str] = Header(None),
+                token: Optional[str] = None):
+    """The first PREVIEW_SECONDS at PREVIEW_BITRATE (see _make_preview), to check it's the
+    right track while the full conversion still runs. 404 with Retry-After while it is not
+    there yet. `?token=` takes a URL token (POST /url_token), for `<audio>`."""
+    if token:
+        if not _username_from_url_token(token):
+            raise HTTPException(status_code=401, detail="Invalid token")
+    else:
+        _ = _get_user_by_token(authorization)
+
+    db = SessionLocal()
+    try:
+        video = db.query(Video).filter(Video.id == file_id).first()
+        if not video:
+            raise HTTPException(status_code=404, detail="Video not found")
+        rel = video_sidecar(video, PREVIEW_NAME)
+        if not rel or video.status in ("evicted", "error") or not STORAGE.exists(rel):
+            running = video.status in ("queued", "processing")
+            raise HTTPException(status_code=404, detail="No preview yet" if running else "No preview",
+                                headers={"Retry-After": "2"} if running else None)
+        stem = os.path.splitext(video.filename)[0] if video.filename else (video.title or "audio")
+        return serve_artifact(request, rel, f"{stem} (preview).mp3")
+    finally:
+        db.close()
+
+@app.get("/peaks/{file_id}", tags=["videos"], summary="Waveform peaks (min/max per zoom level)")
+def get_peaks(file_id: str, request: Request, authorization: Optional[str] = Header(None),
+              token: Optional[str] = None, level: Optional[int] = None, width: Optional[int] = None):
+    """Without `level` / `width`: the whole peaks file, binary (format in waveform.py), for
+    clients that zoom by themselves. With `level` (0 = finest), or `width` (the coarsest level
+    with at least that many peaks): that level as JSON, `peaks` = [min, max, min, max, ...] in
+    -128..127. Peaks never change once written: strong ETag, cacheable for PEAKS_MAX_AGE.
+    `?token=` takes a URL token (POST /url_token)."""
+    if token:
+        if not _username_from_url_token(token):
+            raise HTTPException(status_code=401, detail="Invalid token")
+    else:
+        _ = _get_user_by_token(authorization)
+
+    db = SessionLocal()
+    try:
+        video = db.query(Video).filter(Video.id == file_id).first()
+        if not video:
+            raise HTTPException(status_code=404, detail="Video not found")
+        rel = video_sidecar(video, PEAKS_NAME)
+        st = STORAGE.stat(rel) if rel and video.status == "ready" else None
+        if st is None:
+            running = video.status in ("queued", "processing") or video.job_dir in PEAKS_PENDING
+            raise HTTPException(status_code=404, detail="No peaks yet" if running else "No peaks",
+                                headers={"Retry-After": "5"} if running else None)
+        stem = os.path.splitext(video.filename)[0] if video.filename else (video.title or "audio")
+    finally:
+        db.close()
+
+    cache = f"private, max-age={PEAKS_MAX_AGE}"
+    if level is None and width is None:
+        resp = serve_artifact(request, rel, f"{stem}.peaks")
+        if STORAGE.local:
+            resp.headers["Cache-Control"] = cache
+        return resp
+
+    etag = '"%s"' % hashlib.sha1(f"{rel}:{st[0]}:{st[1]}:{level}:{width}".encode()).hexdigest()
+    headers = {"ETag": etag, "Cache-Control": cache}
+    inm = request.headers.get("if-none-match")
+    if inm is not None and _etag_matches(inm, etag):
+        return Response(status_code=304, headers=headers)
+    try:
+        rate, samples, levels = waveform.parse_header(b"".join(STORAGE.read(rel, 0, waveform.HEADER_MAX)))
+    except ValueError:
+        log.warning("corrupt peaks file %s", rel)
+        raise HTTPException(status_code=404, detail="No peaks")
+    if level is None:
+        level = waveform.pick_level(levels, max(1, width))
+    if not 0 <= level < len(levels):
+        raise HTTPException(status_code=400, detail=f"level must be 0..{len(levels) - 1}")
+    spp, count, offset = levels[level]
+    data = b"".join(STORAGE.read(rel, offset, offset + 2 * count))
+    return JSONResponse({"file_id": file_id, "sample_rate": rate, "samples": samples, "level": level,
+                         "levels": len(levels), "samples_per_peak": spp,
+                         "peaks": list(memoryview(data).cast("b"))}, headers=headers)
+
+def _start_stream(url: str, username: str) -> tuple:
+    """The blocking half of /stream: (file_id of the caller's new row, job it is attached to or None)."""
+    if MAX_DURATION or JOB_PROBE:
+        try:
+            summary = probe(url)[0]
+        except JobError:
+            summary = None   # the job itself will report what's wrong with the URL
+        if summary:
+            check_duration(summary)
+    db = SessionLocal()
+    try:
+        video = submit_jobs(db, [url], username, fmt="mp3", live=True)[0]
+        publish_video("created", video)
+        return video.id, VIDEO_JOBS.get(video.id)
+    finally:
+        db.close()
+
+def _finished_artifact(file_id: str) -> Optional[tuple]:
+    db = SessionLocal()
+    try:
+        video = db.query(Video).filter(Video.id == file_id).first()
+        if not video or video.status != "ready":
+            return None
+        touch(video.id)
+        return pick_artifact(video, "mp3")
+    finally:
+        db.close()
+
+@app.get("/stream", tags=["videos"], summary="Convert to MP3 and stream it while it is encoded")
+async def stream_video(url: str, request: Request, authorization: Optional[str] = Header(None),
+                       token: Optional[str] = None):
+    """Like POST /download with format mp3, but the response is the MP3 itself, sent (chunked)
+    as ffmpeg produces it, so playback starts within seconds instead of after the whole job.
+    The file is cached as usual; X-File-Id names the new row. A cached file is sent like
+    /download sends it. Past STREAM_MAX streams, or when a non-streaming job for the source is
+    already running, the response waits for the finished file. `<audio>` can't send headers,
+    so `?token=` takes a URL token (POST /url_token) too."""
+    if token:
+        username = _username_from_url_token(token)
+        if not username:
+            raise HTTPException(status_code=401, detail="Invalid token")
+    else:
+        username = (await run_in_threadpool(_get_user_by_token, authorization)).username
+    if not os.getenv("FFMPEG_LOCATION") and not shutil.which("ffmpeg"):
+        raise HTTPException(status_code=500, detail="ffmpeg not found. Install ffmpeg or set FFMPEG_LOCATION.")
+    file_id, job = await run_in_threadpool(lambda: _start_stream(url, username))
+    live = job.live if job else None
+
+    if live is not None:
+        while not live.size and not live.done:
+            if await request.is_disconnected():
+                return Response(status_code=204)   # nobody to answer; the job goes on
+            await asyncio.sleep(STREAM_POLL)
+        if live.error:
+            raise HTTPException(status_code=502, detail=live.error)
+        try:
+            f = await run_in_threadpool(open, live.path, "rb")
+        except FileNotFoundError:   # it has already become the finished artifact
+            f = None
+        if f is not None:
+            async def follow():
+                try:
+                    while True:
+                        done = live.done   # before the read: whatever was written by then is in the file
+                        chunk = await run_in_threadpool(f.read, FILE_CHUNK)   # disk I/O off the event loop
+                        if chunk:
+                            yield chunk
+                        elif done:
+                            return   # complete, or cut short by an error the row will show
+                        else:
+                            await asyncio.sleep(STREAM_POLL)
+                finally:
+                    f.close()
+
+            return StreamingResponse(follow(), media_type="audio/mpeg",
+                                     headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no",
+                                              "X-File-Id": file_id})
+
+    # not streaming: wait for the job (if any) and send its file
+    while job is not None and job.progress.get("stage") not in ("done", "failed"):
+        if await request.is_disconnected():
+            return Response(status_code=204)
+        await asyncio.sleep(0.5)
+    art = await run_in_threadpool(_finished_artifact, file_id)
+    if art is None:
+        raise HTTPException(status_code=502, detail=JOB_ERRORS.get(file_id) or "Conversion failed")
+    resp = serve_artifact(request, *art)
+    resp.headers["X-File-Id"] = file_id
+    return resp
+
+@app.post("/restore/{file_id}", tags=["videos"], summary="Re-convert an evicted file", status_code=202)
+def restore_video(file_id: str, response: Response, authorization: str = Header(None)):
+    current = _get_user_by_token(authorization)
+    db = SessionLocal()
+    try:
+        video = db.query(Video).filter(Video.id == file_id).first()
+        if not video:
+            raise HTTPException(status_code=404, detail="Video not found")
+        if (video.owner_username or "") != current.username and not current.is_admin:
+            raise HTTPException(status_code=403, detail="Not allowed")
+        if video.status != "evicted":
+            raise HTTPException(status_code=409, detail=f"Video is {video.status}, not evicted")
+        video.source_key = video.source_key or source_key(video.url)
+        video.accessed_at = datetime.utcnow()
+        _enqueue(db, [video], video.owner_username or current.username)
+        publish_video("created", video)
+        if video.status == "ready":
+            response.status_code = 200   # someone else's copy was still cached
+        return {"file_id": video.id, "status": video.status, "filename": video.filename}
     finally:
         db.close()
 
@@ -575,10 +3332,10 @@ def delete_file(file_id: str, authorization: str = Header(None)):
             raise HTTPException(status_code=404, detail="Video not found")
         if (video.owner_username or "") != current.username and not current.is_admin:
             raise HTTPException(status_code=403, detail="Not allowed")
-        path = os.path.join(TMP_DIR, video.filename) if video.filename else None
-        if path and os.path.exists(path):
-            os.remove(path)
+        for rel in video_files(video):
+            release_file(db, rel, [video.id])
         db.delete(video); db.commit()
+        publish_video("deleted", video, status="deleted")
         return {"message": "Deleted"}
     finally:
         db.close()
@@ -610,13 +3367,25 @@ def my_downloads(authorization: str = Header(None)):
                   .filter(Video.owner_username == current.username)
                   .order_by(Video.timestamp.desc())
                   .all())
-        return [{
-            "id": v.id,
-            "url": v.url,
-            "status": v.status,
-            "filename": v.filename,
-            "timestamp": v.timestamp.isoformat(),
-        } for v in rows]
+        out = []
+        for v in rows:
+            # signed links come with the list, so a download click needs no request of its own
+            url, exp = (signed_download_url(v, current.username) if v.status == "ready" and v.filename
+                        else (None, None))
+            out.append({
+                "id": v.id,
+                "url": v.url,
+                "status": v.status,
+                "filename": v.filename,
+                "batch_id": v.batch_id,
+                "start": v.clip_start,
+                "end": v.clip_end,
+                "formats": video_formats(v),
+                "timestamp": v.timestamp.isoformat(),
+                "download_url": url,
+                "download_url_expires_at": exp,
+            })
+        return out
     finally:
         db.close()
 
@@ -639,6 +3408,128 @@ def user_downloads(username: str, authorization: str = Header(None)):
     finally:
         db.close()
 
+# -------------------- Library export --------------------
+# POST /exports picks videos (own library, or any user's for admins) and returns a signed link;
+# GET /export/{id} streams them as one stored ZIP or a TAR. The archive layout is computed from
+# the file list up front (archive.py), so the response has a Content-Length, answers Range /
+# If-Range like a single file, and is read straight from the artifacts: nothing is buffered or
+# written to disk.
+EXPORT_URL_TTL = int(os.environ.get("EXPORT_URL_TTL", "86400"))   # seconds; long enough to resume
+EXPORT_KEEP_DAYS = 7
+EXPORT_TYPES = {"zip": "application/zip", "tar": "application/x-tar"}
+
+class ExportRequest(BaseModel):
+    file_ids: Optional[List[str]] = None   # default: every ready file of `username`
+    username: Optional[str] = None         # whose library (admins only for someone else's)
+    format: str = "zip"
+
+def _export_sig(export_id: str, user: str, exp: int) -> str:
+    msg = "\n".join(("export", export_id, user, str(exp))).encode()
+    return base64.urlsafe_b64encode(hmac.new(_URL_KEY, msg, hashlib.sha256).digest()).decode().rstrip("=")
+
+def _member_name(title: str, taken: set) -> str:
+    name = re.sub(r'[\\/\x00-\x1f]', "_", title).strip(". ") or "audio.mp3"
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while name.lower() in taken:
+        n += 1
+        name = f"{stem} ({n}){ext}"
+    taken.add(name.lower())
+    return name
+
+def build_export(db, export: Export):
+    """(archive, etag) for the export's videos that are still ready on disk. ZIP headers take
+    the CRC-32 recorded when each artifact was stored; only rows from before that are read
+    (once: the CRC is recorded then)."""
+    ids = json.loads(export.file_ids)
+    rows = {v.id: v for v in db.query(Video).filter(Video.id.in_(ids), Video.status == "ready").all()}
+    members, taken = [], set()
+    for file_id in ids:
+        v = rows.get(file_id)
+        rel = (v.path or v.filename) if v else None
+        st = STORAGE.stat(rel) if rel else None
+        if st is None:
+            continue
+        size, mtime = st
+        if export.format == "zip" and v.crc is None:
+            v.crc = archive.crc32(STORAGE.read(rel, 0, size))
+        crc = v.crc if export.format == "zip" else 0
+        members.append(archive.Member(_member_name(v.filename, taken), rel, size, mtime, crc))
+    if db.dirty:
+        db.commit()
+    if not members:
+        raise HTTPException(status_code=404, detail="None of the exported files are available any more")
+    build = archive.zip_archive if export.format == "zip" else archive.tar_archive
+    arc = build(members, STORAGE.read)
+    manifest = "\n".join(f"{m.name}\0{m.path}\0{m.size}\0{m.mtime}" for m in members)
+    etag = '"%s"' % hashlib.sha1(f"{export.format}\n{manifest}".encode()).hexdigest()
+    return arc, etag, members
+
+@app.post("/exports", tags=["videos"], summary="Export many files as one ZIP/TAR (signed link)")
+def create_export(data: ExportRequest, authorization: str = Header(None)):
+    current = _get_user_by_token(authorization)
+    if data.format not in EXPORT_TYPES:
+        raise HTTPException(status_code=400, detail="format must be 'zip' or 'tar'")
+    target = data.username or current.username
+    if target != current.username and not current.is_admin:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    db = SessionLocal()
+    try:
+        q = db.query(Video).filter(Video.status == "ready")
+        if data.file_ids:
+            q = q.filter(Video.id.in_(data.file_ids))
+            if not current.is_admin:
+                q = q.filter(Video.owner_username == current.username)
+        else:
+            q = q.filter(Video.owner_username == target)
+        rows = {v.id: v for v in q.all()}
+        order = data.file_ids or [v.id for v in sorted(rows.values(), key=lambda v: v.timestamp)]
+        ids = [i for i in dict.fromkeys(order) if i in rows]
+        if not ids:
+            raise HTTPException(status_code=404, detail="No ready files to export")
+
+        cutoff = datetime.utcnow() - timedelta(days=EXPORT_KEEP_DAYS)
+        db.query(Export).filter(Export.created_at < cutoff).delete()
+        export = Export(id=str(uuid.uuid4()), owner_username=current.username, format=data.format,
+                        file_ids=json.dumps(ids))
+        db.add(export); db.commit()
+        arc, _, members = build_export(db, export)
+        exp = int(time.time()) + EXPORT_URL_TTL
+        params = {"u": current.username, "exp": exp, "sig": _export_sig(export.id, current.username, exp)}
+        return {"export_id": export.id, "url": f"/export/{export.id}?{urlencode(params)}", "expires_at": exp,
+                "files": len(members), "size": arc.size}
+    finally:
+        db.close()
+
+@app.get("/export/{export_id}", tags=["videos"], summary="Download an export (signed link or header)")
+def get_export(export_id: str, request: Request, authorization: Optional[str] = Header(None),
+               u: Optional[str] = None, exp: Optional[str] = None, sig: Optional[str] = None):
+    if sig is not None:
+        try:
+            exp_i = int(exp)
+        except (TypeError, ValueError):
+            exp_i = 0
+        if exp_i < time.time() or u is None or not hmac.compare_digest(sig, _export_sig(export_id, u, exp_i)):
+            raise HTTPException(status_code=403, detail="Invalid or expired export link")
+        username = u
+    else:
+        username = _get_user_by_token(authorization).username
+
+    db = SessionLocal()
+    try:
+        export = db.query(Export).filter(Export.id == export_id).first()
+        if not export or export.owner_username != username:
+            raise HTTPException(status_code=404, detail="Export not found")
+        arc, etag, members = build_export(db, export)
+        for file_id in json.loads(export.file_ids):
+            touch(file_id)
+        stamp = export.created_at or datetime.utcnow()
+        name = f"{export.owner_username}-{stamp:%Y%m%d-%H%M%S}.{export.format}"
+        # no Last-Modified: a date can't tell that a file dropped out of the set
+        return ranged_response(request, arc.size, etag, None, EXPORT_TYPES[export.format], name, arc.read)
+    finally:
+        db.close()
+
 # -------------------- Admin: delete user + their downloads --------------------
 @app.delete("/admin/delete_user/{username}", tags=["admin"], summary="Delete User and Their Downloads")
 def admin_delete_user(username: str, authorization: str = Header(None)):
@@ -656,16 +3547,16 @@ def admin_delete_user(username: str, authorization: str = Header(None)):
             if admins <= 1:
                 raise HTTPException(status_code=400, detail="Cannot delete the only admin")
         vids = db.query(Video).filter(Video.owner_username == username).all()
+        ids = [v.id for v in vids]
         for v in vids:
-            if v.filename:
-                fp = os.path.join(TMP_DIR, v.filename)
-                try:
-                    if os.path.exists(fp):
-                        os.remove(fp)
-                except Exception:
-                    pass
+            for rel in video_files(v):
+                release_file(db, rel, ids)
             db.delete(v)
+        db.query(Batch).filter(Batch.owner_username == username).delete()
+        db.query(Export).filter(Export.owner_username == username).delete()
         db.delete(target); db.commit()
+        for v in vids:
+            publish_video("deleted", v, status="deleted")
         return {"deleted_user": username, "deleted_videos": len(vids)}
     finally:
         db.close()
\ No newline at end of file
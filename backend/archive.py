@@ -0,0 +1,147 @@
+"""
+Streamed ZIP (stored, no compression) and TAR archives with a layout fixed up front.
+
+An archive is a list of segments, each either header bytes or a whole member file. The total
+size is therefore known before the first byte goes out, any byte range can be produced without
+building the archive anywhere, and memory use does not depend on the size of the members.
+MP3s don't compress, so ZIP members are stored; the CRC-32 each ZIP header needs comes from
+the caller (app.py records it per artifact when storing it, see `file_crc32`). Member contents are read through a callable, so
+they can come from local files or a remote store alike.
+
+Kept free of any app.py imports.
+"""
+import bisect, struct, tarfile, time, zlib
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+CHUNK = 64 * 1024
+
+
+class Member(NamedTuple):
+    name: str            # path inside the archive
+    path: str            # file on disk, or whatever key `read_file` understands
+    size: int
+    mtime: float
+    crc: int = 0         # CRC-32 of the content (ZIP only)
+
+
+class Archive:
+    def __init__(self, segments: List[Tuple[Optional[bytes], Optional[str], int]],
+                 read_file: Optional[Callable] = None):
+        self._segments = segments     # (header bytes, None, len) or (None, file path, size)
+        self._read_file = read_file or _read_file   # (path, start, end) -> chunks
+        self._starts = []
+        pos = 0
+        for _, _, length in segments:
+            self._starts.append(pos)
+            pos += length
+        self.size = pos
+
+    def read(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yield bytes [start, end) of the archive."""
+        end = self.size if end is None else min(end, self.size)
+        i = max(0, bisect.bisect_right(self._starts, start) - 1)
+        while start < end and i < len(self._segments):
+            data, path, length = self._segments[i]
+            seg_start = self._starts[i]
+            lo, hi = start - seg_start, min(length, end - seg_start)
+            if data is not None:
+                yield data[lo:hi]
+            else:
+                yield from self._read_file(path, lo, hi)
+            start = seg_start + hi
+            i += 1
+
+
+def _read_file(path: str, lo: int, hi: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(lo)
+        left = hi - lo
+        while left > 0:
+            chunk = f.read(min(CHUNK, left))
+            if not chunk:
+                raise IOError(f"{path} shrank while being archived")
+            left -= len(chunk)
+            yield chunk
+
+
+def crc32(chunks: Iterable[bytes]) -> int:
+    crc = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def file_crc32(path: str) -> int:
+    with open(path, "rb") as f:
+        return crc32(iter(lambda: f.read(CHUNK), b""))
+
+
+# -------------------- ZIP --------------------
+_U32 = 0xFFFFFFFF
+_U16 = 0xFFFF
+
+
+def _dos_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))   # ZIP can't go before 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def zip_archive(members: List[Member], read_file: Optional[Callable] = None) -> Archive:
+    """Stored ZIP, with ZIP64 records where sizes, offsets or the entry count need them."""
+    segments, central = [], []
+    offset = 0
+    for m in members:
+        name = m.name.encode("utf-8")
+        dtime, ddate = _dos_time(m.mtime)
+        big = m.size >= _U32
+        extra = struct.pack("<HHQQ", 0x0001, 16, m.size, m.size) if big else b""
+        size32 = _U32 if big else m.size
+        version = 45 if big else 20
+        header = struct.pack("<IHHHHHIIIHH", 0x04034B50, version, 0x0800, 0, dtime, ddate,
+                             m.crc, size32, size32, len(name), len(extra)) + name + extra
+        segments.append((header, None, len(header)))
+        segments.append((None, m.path, m.size))
+
+        cextra = b""
+        if big:
+            cextra += struct.pack("<QQ", m.size, m.size)
+        if offset >= _U32:
+            cextra += struct.pack("<Q", offset)
+        if cextra:
+            cextra = struct.pack("<HH", 0x0001, len(cextra)) + cextra
+            version = 45
+        central.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | version, version, 0x0800, 0,
+                                   dtime, ddate, m.crc, size32, size32, len(name), len(cextra), 0, 0, 0,
+                                   0o100644 << 16, min(offset, _U32)) + name + cextra)
+        offset += len(header) + m.size
+
+    cd = b"".join(central)
+    tail = b""
+    n = len(members)
+    if n >= _U16 or len(cd) >= _U32 or offset >= _U32:
+        zip64_at = offset + len(cd)
+        tail += struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, n, n, len(cd), offset)
+        tail += struct.pack("<IIQI", 0x07064B50, 0, zip64_at, 1)
+    tail += struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, min(n, _U16), min(n, _U16),
+                        min(len(cd), _U32), min(offset, _U32), 0)
+    segments.append((cd + tail, None, len(cd) + len(tail)))
+    return Archive(segments, read_file)
+
+
+# -------------------- TAR --------------------
+def tar_archive(members: List[Member], read_file: Optional[Callable] = None) -> Archive:
+    """POSIX (pax) TAR; pax headers only appear for names ustar can't hold."""
+    segments = []
+    for m in members:
+        info = tarfile.TarInfo(m.name)
+        info.size, info.mtime, info.mode, info.type = m.size, int(m.mtime), 0o644, tarfile.REGTYPE
+        header = info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8", errors="strict")
+        segments.append((header, None, len(header)))
+        segments.append((None, m.path, m.size))
+        pad = -m.size % tarfile.BLOCKSIZE
+        if pad:
+            segments.append((b"\0" * pad, None, pad))
+    end = b"\0" * (2 * tarfile.BLOCKSIZE)
+    segments.append((end, None, len(end)))
+    return Archive(segments, read_file)
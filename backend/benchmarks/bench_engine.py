@@ -0,0 +1,86 @@
+"""
+Per-job overhead: yt-dlp CLI subprocess vs. the embedded engine (ytdl_engine.py).
+
+Converts a locally generated audio file through both paths, so no network is involved and the
+difference is the fixed cost each job pays (interpreter start + extractor import for the CLI).
+
+    cd backend && python benchmarks/bench_engine.py --jobs 10
+    cd backend && python benchmarks/bench_engine.py --jobs 10 --simulate   # extraction only, no ffmpeg post-processing
+
+Needs ffmpeg (and ffprobe unless --simulate) on PATH or FFMPEG_LOCATION.
+"""
+import argparse, multiprocessing, os, shutil, statistics, subprocess, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ytdl_engine  # noqa: E402
+
+
+def make_source(workdir: str, seconds: int) -> str:
+    ffmpeg = os.path.join(os.environ["FFMPEG_LOCATION"], "ffmpeg") if os.environ.get("FFMPEG_LOCATION") else "ffmpeg"
+    path = os.path.join(workdir, "source.m4a")
+    subprocess.run([ffmpeg, "-loglevel", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                    "-c:a", "aac", path], check=True)
+    return "file://" + path
+
+
+def run_cli(url: str, outdir: str, jobs: int, simulate: bool):
+    times = []
+    for i in range(jobs):
+        args = ["yt-dlp", "--enable-file-urls", "-q", "-x", "--audio-format", "mp3", "--audio-quality", "5",
+                "-o", f"{outdir}/cli-{i}-%(title)s.%(ext)s", url]
+        if simulate:
+            args.append("--simulate")
+        if os.environ.get("FFMPEG_LOCATION"):
+            args.extend(["--ffmpeg-location", os.environ["FFMPEG_LOCATION"]])
+        t0 = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def run_engine(url: str, outdir: str, jobs: int, simulate: bool):
+    extra = {"enable_file_urls": True}
+    if simulate:
+        extra["simulate"] = True
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=ytdl_engine.init,
+                             initargs=(os.environ.get("FFMPEG_LOCATION"), False, extra)) as pool:
+        t0 = time.perf_counter()
+        pool.submit(ytdl_engine.warm, "mp3", "5").result()
+        warmup = time.perf_counter() - t0
+        times = []
+        for i in range(jobs):
+            t0 = time.perf_counter()
+            pool.submit(ytdl_engine.convert, f"{outdir}/eng-{i}-%(title)s.%(ext)s", url, "mp3", "5").result()
+            times.append(time.perf_counter() - t0)
+    return warmup, times
+
+
+def fmt(times):
+    return (f"mean {statistics.mean(times) * 1000:8.1f} ms   median {statistics.median(times) * 1000:8.1f} ms   "
+            f"min {min(times) * 1000:8.1f} ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--jobs", type=int, default=10)
+    ap.add_argument("--seconds", type=int, default=5, help="length of the generated source audio")
+    ap.add_argument("--simulate", action="store_true", help="skip download/post-processing")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-engine-")
+    try:
+        url = make_source(workdir, args.seconds)
+        cli = run_cli(url, workdir, args.jobs, args.simulate)
+        warmup, eng = run_engine(url, workdir, args.jobs, args.simulate)
+        print(f"jobs={args.jobs} simulate={args.simulate}")
+        print(f"subprocess  {fmt(cli)}")
+        print(f"inprocess   {fmt(eng)}   (one-off worker start {warmup * 1000:.0f} ms)")
+        print(f"saved per job: {(statistics.mean(cli) - statistics.mean(eng)) * 1000:.1f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+API latency under heavy download traffic: FILE_SERVING=direct vs. x-accel.
+
+Starts the backend with uvicorn once per mode, puts one large artifact in a scratch TMP_DIR and
+lets --downloaders threads fetch it in a loop, each read at --rate-mb MB/s like a real client
+on a real link (so both modes see the same request rate), while the main thread times
+GET /status calls.
+In x-accel mode the proxy's part (reading the X-Accel-Redirect target) is played by a separate
+`python -m http.server` process, so only the hand-off runs in the API process, as with nginx.
+
+    cd backend && python benchmarks/bench_offload.py --downloaders 32 --size-mb 20
+"""
+import argparse, json, os, shutil, socket, sqlite3, statistics, subprocess, sys, tempfile, threading, time
+import urllib.request
+from datetime import datetime
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILE_ID = "00000000-0000-4000-8000-000000000000"
+REL = f"store/aa/bb/{FILE_ID}/audio.mp3"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_up(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def call(url: str, data=None, headers=None):
+    req = urllib.request.Request(url, data=json.dumps(data).encode() if data is not None else None,
+                                 headers={"Content-Type": "application/json", **(headers or {})})
+    with urllib.request.urlopen(req, timeout=60) as r:
+        return json.loads(r.read())
+
+
+def start_backend(mode: str, workdir: str, tmp_dir: str):
+    rundir = os.path.join(workdir, mode)
+    os.makedirs(rundir)
+    os.symlink(os.path.join(BACKEND, "static"), os.path.join(rundir, "static"))   # fresh videos.db / secret.key per run
+    port = free_port()
+    env = dict(os.environ, FILE_SERVING=mode, TMP_DIR=tmp_dir, X_ACCEL_PREFIX="/_files/",
+               PYTHONPATH=BACKEND, JOB_WORKERS="1")
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=rundir, env=env)
+    base = f"http://127.0.0.1:{port}"
+    wait_up(base + "/")
+    call(base + "/register", {"username": "bench", "password": "bench-pass"})
+    token = call(base + "/login", {"username": "bench", "password": "bench-pass"})["token"]
+    db = sqlite3.connect(os.path.join(rundir, "videos.db"))
+    db.execute("INSERT INTO videos (id, url, status, filename, owner_username, path, timestamp) VALUES (?,?,?,?,?,?,?)",
+               (FILE_ID, "https://example.invalid/bench", "ready", "bench.mp3", "bench", REL, datetime.utcnow().isoformat(" ")))
+    db.commit(); db.close()
+    return proc, base, token
+
+
+def drain(resp, rate: float) -> int:
+    n, t0 = 0, time.perf_counter()
+    while True:
+        chunk = resp.read(256 * 1024)
+        if not chunk:
+            return n
+        n += len(chunk)
+        ahead = n / rate - (time.perf_counter() - t0)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def downloader(base: str, token: str, proxy: str, rate: float, stop: threading.Event, moved: list):
+    url = f"{base}/download/{FILE_ID}?token={token}"
+    while not stop.is_set():
+        with urllib.request.urlopen(url, timeout=120) as r:
+            target = r.headers.get("X-Accel-Redirect")
+            n = drain(r, rate)
+        if target:   # what nginx would do: serve the internal location from disk
+            with urllib.request.urlopen(proxy + target[len("/_files"):], timeout=120) as r:
+                n += drain(r, rate)
+        moved.append(n)
+
+
+def probe(base: str, token: str, count: int):
+    times = []
+    for _ in range(count):
+        t0 = time.perf_counter()
+        call(f"{base}/status/{FILE_ID}", headers={"Authorization": f"Bearer {token}"})
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def pct(times, p):
+    s = sorted(times)
+    return s[min(len(s) - 1, int(len(s) * p))] * 1000
+
+
+def run(mode: str, args, workdir: str, tmp_dir: str, proxy: str):
+    proc, base, token = start_backend(mode, workdir, tmp_dir)
+    try:
+        idle = probe(base, token, 50)
+        stop, moved = threading.Event(), []
+        threads = [threading.Thread(target=downloader, args=(base, token, proxy, args.rate_mb * 1e6, stop, moved),
+                                    daemon=True)
+                   for _ in range(args.downloaders)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(1)   # let the transfers ramp up
+        busy = probe(base, token, args.probes)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        print(f"{mode:8s} idle p50 {pct(idle, .5):6.1f} ms | under load p50 {pct(busy, .5):7.1f} ms  "
+              f"p95 {pct(busy, .95):7.1f} ms  p99 {pct(busy, .99):7.1f} ms  mean {statistics.mean(busy) * 1000:7.1f} ms | "
+              f"downloads {len(moved)} ({sum(moved) / elapsed / 1e6:.0f} MB/s)")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--downloaders", type=int, default=32, help="concurrent download loops")
+    ap.add_argument("--size-mb", type=int, default=20, help="size of the served file")
+    ap.add_argument("--rate-mb", type=float, default=5, help="read speed of each downloader, MB/s")
+    ap.add_argument("--probes", type=int, default=200, help="timed API calls under load")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-offload-")
+    tmp_dir = os.path.join(workdir, "files")
+    os.makedirs(os.path.join(tmp_dir, os.path.dirname(REL)))
+    with open(os.path.join(tmp_dir, REL), "wb") as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1 << 20))
+    proxy_port = free_port()
+    proxy = subprocess.Popen([sys.executable, "-m", "http.server", str(proxy_port), "--bind", "127.0.0.1",
+                              "--directory", tmp_dir], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_up(f"http://127.0.0.1:{proxy_port}/")
+        print(f"downloaders={args.downloaders} size={args.size_mb} MB rate={args.rate_mb} MB/s probes={args.probes}")
+        for mode in ("direct", "x-accel"):
+            run(mode, args, workdir, tmp_dir, f"http://127.0.0.1:{proxy_port}")
+    finally:
+        proxy.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Wall-clock speedup of segmented MP3 encoding (mp3_parallel.py) against the number of workers.
+
+Encodes one locally generated source with 1, 2, 4, ... workers up to the core count and reports
+time, speedup and parallel efficiency against the single-process encode, plus how far each
+result's decoded length is from the single-process one (it should be 0 samples).
+
+    cd backend && python benchmarks/bench_parallel_mp3.py --minutes 60
+    cd backend && python benchmarks/bench_parallel_mp3.py --source podcast.m4a --workers 1,2,4,8
+
+Needs ffmpeg on PATH or FFMPEG_LOCATION.
+"""
+import argparse, os, shutil, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mp3_parallel  # noqa: E402
+
+
+def ffmpeg_bin() -> str:
+    return os.path.join(os.environ["FFMPEG_LOCATION"], "ffmpeg") if os.environ.get("FFMPEG_LOCATION") else "ffmpeg"
+
+
+def make_source(workdir: str, minutes: float) -> str:
+    # noise under a sweep: something LAME has to work at, unlike a pure tone
+    path = os.path.join(workdir, "source.opus")
+    seconds = minutes * 60
+    subprocess.run([ffmpeg_bin(), "-loglevel", "error", "-y",
+                    "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.2:duration={seconds}",
+                    "-f", "lavfi", "-i", f"sine=frequency=220:beep_factor=4:duration={seconds}",
+                    "-filter_complex", "amix=inputs=2,aformat=channel_layouts=stereo",
+                    "-c:a", "libopus", "-b:a", "128k", path], check=True)
+    return path
+
+
+def decoded_samples(path: str) -> int:
+    out = subprocess.run([ffmpeg_bin(), "-loglevel", "error", "-i", path, "-f", "s16le", "-ac", "1", "-"],
+                         capture_output=True, check=True).stdout
+    return len(out) // 2
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--minutes", type=float, default=30, help="length of the generated source")
+    ap.add_argument("--source", help="encode this file instead of a generated one")
+    ap.add_argument("--workers", help="comma-separated worker counts (default: 1, 2, 4, ... up to the cores)")
+    ap.add_argument("--quality", default="5", help="LAME VBR quality, as AUDIO_QUALITY")
+    args = ap.parse_args()
+
+    cores = os.cpu_count() or 1
+    if args.workers:
+        counts = sorted({int(w) for w in args.workers.split(",")} | {1})
+    else:
+        counts, w = [], 1
+        while w < cores:
+            counts.append(w)
+            w *= 2
+        counts.append(cores)
+
+    workdir = tempfile.mkdtemp(prefix="bench-mp3-")
+    try:
+        src = args.source or make_source(workdir, args.minutes)
+        duration, rate = mp3_parallel.probe(ffmpeg_bin(), src)
+        print(f"source {duration:.0f} s at {rate} Hz, {cores} cores")
+        print(f"{'workers':>7} {'wall s':>8} {'cpu s':>8} {'speedup':>8} {'efficiency':>10} {'len diff':>9}")
+        base_time = base_len = None
+        for w in counts:
+            dst = os.path.join(workdir, f"out-{w}.mp3")
+            t0 = time.perf_counter()
+            cpu = mp3_parallel.encode(ffmpeg_bin(), src, dst, ["-q:a", args.quality], workers=w,
+                                      duration=duration, rate=rate)
+            wall = time.perf_counter() - t0
+            n = decoded_samples(dst)
+            if base_time is None:
+                base_time, base_len = wall, n
+            speedup = base_time / wall
+            print(f"{w:>7} {wall:>8.2f} {cpu or 0:>8.2f} {speedup:>7.2f}x {speedup / w:>10.0%} {n - base_len:>9}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Parallel MP3 encoding of long sources (MP3_PARALLEL_WORKERS, see app.py).
+
+LAME is single-threaded, so one ffmpeg process encodes a 3-hour podcast on one core however
+many others are idle. `encode` cuts the source into one time segment per worker, has an ffmpeg
+process decode and encode each segment at the same time, and joins the resulting MP3 frames
+into one file without a gap or click at the seams:
+
+- Segment boundaries fall on MP3 frame boundaries (1152 samples, 576 below 32 kHz). Every
+  segment is encoded from PREROLL frames before its start to PREROLL frames past its end, and
+  the frames covering those margins are dropped again. LAME's encoder delay is the same in
+  every segment, so the first kept frame starts exactly where the previous segment's last kept
+  frame ends; the margins give the encoder its settled state at the start and real audio
+  instead of silence in its look-ahead at the end, so the overlapping halves of the frames
+  either side of a seam still add up.
+- The bit reservoir is off (`-reservoir 0`). With it a frame may borrow bytes from the frames
+  before it, which after the join would belong to another segment.
+- The joined file starts with a Xing header (frame count, byte count, seek table), so players
+  get the duration of the VBR result and seek in it correctly, and with the LAME tag of the
+  last segment (encoder delay and end padding, which the join leaves unchanged), so gapless
+  decoders trim exactly what they would trim from a single-process encode.
+
+Below `min_duration`, or with a single worker, it is one plain ffmpeg run. Either way, the
+ffmpeg processes report how far they are (`-progress`, see `watch`) to `encode`'s `progress`.
+
+Kept free of any app.py imports.
+"""
+import os, re, struct, subprocess, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+PREROLL = 8                  # frames encoded before and after each segment and dropped (~0.2 s)
+CHUNK = 1024 * 1024
+RATES = (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000)   # what MP3 can hold
+
+_BITRATES = {   # Layer III, kbps by bitrate index
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),   # MPEG-1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),       # MPEG-2 / 2.5
+}
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def probe(ffmpeg: str, src: str) -> Tuple[Optional[float], Optional[int]]:
+    """(duration in seconds, sample rate) of the first audio stream of `src`, from what ffmpeg
+    prints about its input (None where it can't tell)."""
+    r = subprocess.run([ffmpeg, "-hide_banner", "-nostdin", "-i", src], capture_output=True, text=True,
+                       errors="replace")
+    duration = rate = None
+    m = re.search(r"Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)", r.stderr)
+    if m:
+        duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    m = re.search(r"Stream #.*?Audio: .*?(\d+) Hz", r.stderr)
+    if m:
+        rate = int(m.group(1))
+    return duration, rate
+
+
+def out_rate(rate: Optional[int]) -> int:
+    """Sample rate of the MP3: the source's, or the nearest family MP3 supports."""
+    if rate in RATES:
+        return rate
+    return 44100 if rate and rate % 11025 == 0 else 48000
+
+
+def _header(h: bytes) -> Optional[Tuple[int, int, int]]:
+    """(frame length in bytes, samples per frame, sample rate) of an MPEG audio Layer III frame
+    header, None if `h` isn't one."""
+    if len(h) < 4 or h[0] != 0xFF or (h[1] & 0xE0) != 0xE0 or (h[1] >> 1) & 3 != 1:
+        return None
+    version, br, sr = (h[1] >> 3) & 3, h[2] >> 4, (h[2] >> 2) & 3
+    if version == 1 or br in (0, 15) or sr == 3:
+        return None
+    rate = _SAMPLE_RATES[version][sr]
+    kbps = _BITRATES[1 if version == 3 else 2][br]
+    pad = (h[2] >> 1) & 1
+    if version == 3:
+        return 144000 * kbps // rate + pad, 1152, rate
+    return 72000 * kbps // rate + pad, 576, rate
+
+
+def frames(path: str) -> Tuple[List[int], List[int], bytes]:
+    """Offsets and lengths of the MP3 frames in `path` (anything else is skipped), plus the
+    first frame's header."""
+    offsets, lengths, first = [], [], b""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        pos = 0
+        while pos + 4 <= size:
+            f.seek(pos)
+            h = f.read(10)
+            if h[:3] == b"ID3" and len(h) == 10:   # an ID3v2 tag: syncsafe size after the header
+                pos += 10 + ((h[6] << 21) | (h[7] << 14) | (h[8] << 7) | h[9])
+                continue
+            info = _header(h)
+            # the sample rate must match the first frame's, a false sync in garbage usually doesn't
+            if info is None or (first and info[2] != _header(first)[2]) or pos + info[0] > size:
+                pos += 1
+                continue
+            if not first:
+                first = h[:4]
+            offsets.append(pos)
+            lengths.append(info[0])
+            pos += info[0]
+    return offsets, lengths, first
+
+
+def _side_info(header: bytes) -> int:
+    """Bytes of side info after a frame header (no CRC), where a Xing tag starts."""
+    mpeg1, mono = (header[1] >> 3) & 3 == 3, header[3] >> 6 == 3
+    return (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+
+
+def _crc16(data: bytes) -> int:
+    """CRC-16/ARC (0x8005 reflected, initial 0), the checksum of LAME tags."""
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def lame_tag(frame: bytes) -> Optional[bytes]:
+    """The quality field and LAME tag (4 + 36 bytes) of a Xing/Info frame, None if `frame`
+    is an ordinary audio frame."""
+    at = 4 + _side_info(frame)
+    if frame[at:at + 4] not in (b"Xing", b"Info"):
+        return None
+    flags = struct.unpack(">I", frame[at + 4:at + 8])[0]
+    at += 8 + 4 * (flags & 1) + 4 * (flags >> 1 & 1) + 100 * (flags >> 2 & 1)
+    if not flags & 8 or len(frame) < at + 40:
+        return None
+    return frame[at:at + 40]
+
+
+def xing_frame(header: bytes, nframes: int, nbytes: int, toc: bytes, lame: Optional[bytes] = None) -> bytes:
+    """A silent frame shaped like `header` carrying a Xing tag (frames, bytes, TOC) and, given
+    one from lame_tag, the LAME tag with its file length and checksums updated."""
+    side = _side_info(header)
+    tag = b"Xing" + struct.pack(">III", 0xF if lame else 0x7, nframes, nbytes) + toc
+    if lame:
+        # music length = the whole file here; nobody checks the music CRC, so leave it out
+        tag += lame[:32] + struct.pack(">IH", nbytes, 0)
+    for br in range(1, 15):   # the smallest bitrate whose frame holds the tag
+        h = bytes((0xFF, header[1] | 1, (br << 4) | (header[2] & 0x0C), header[3]))   # no CRC, no padding
+        length = _header(h)[0]
+        if length >= 4 + side + len(tag) + 2:
+            frame = h + b"\0" * side + tag
+            if lame:
+                frame += struct.pack(">H", _crc16(frame))   # over everything before it
+            return frame + b"\0" * (length - len(frame))
+    raise ValueError("no frame size fits a Xing tag")
+
+
+_PROGRESS_LINE = re.compile(r"^[a-z0-9_]+=\S*$")
+
+
+def progress_args() -> List[str]:
+    """ffmpeg global options for the progress reports `watch` reads (put right after the binary)."""
+    return ["-progress", "pipe:2", "-nostats"]
+
+
+def watch(stream, on_time: Optional[Callable[[float], None]] = None) -> str:
+    """Read the stderr of an ffmpeg run with progress_args() to its end: calls `on_time` with
+    the seconds of output written so far at every report and returns everything else (its
+    messages). Lines may be str or bytes."""
+    err = []
+    for line in stream:
+        if isinstance(line, bytes):
+            line = line.decode(errors="replace")
+        if not _PROGRESS_LINE.match(line.strip()):
+            err.append(line)
+        elif on_time and line.startswith("out_time_us="):
+            try:
+                on_time(int(line.strip().split("=", 1)[1]) / 1e6)
+            except ValueError:   # N/A before the first frame
+                pass
+    return "".join(err)
+
+
+def _run(args: List[str], on_time: Optional[Callable[[float], None]] = None) -> Optional[float]:
+    """Run ffmpeg; returns its CPU seconds (None where unknown)."""
+    args = args[:1] + progress_args() + args[1:]
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+    err = watch(proc.stderr, on_time)
+    cpu = None
+    if hasattr(os, "wait4"):
+        _, status, ru = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        cpu = ru.ru_utime + ru.ru_stime
+    if proc.wait() != 0:
+        raise RuntimeError(err.strip()[-500:] or f"ffmpeg exited with {proc.returncode}")
+    return cpu
+
+
+def segments(duration: float, rate: int, workers: int) -> List[Tuple[int, Optional[int]]]:
+    """[(first frame, end frame or None for the last)] of `workers` equal segments."""
+    per_frame = 1152 if rate >= 32000 else 576
+    total = int(duration * rate) // per_frame + 1
+    n = max(1, min(workers, total // (PREROLL * 4)))
+    step = total // n
+    return [(i * step, (i + 1) * step if i < n - 1 else None) for i in range(n)]
+
+
+def _join(pieces: List[Tuple[str, int, int]], lengths: List[int], header: bytes, lame: Optional[bytes], dst: str):
+    """Write `dst`: a Xing frame, then the byte ranges `pieces` ((file, start, end), holding
+    frames of `lengths` bytes)."""
+    if not header:
+        raise RuntimeError("no MP3 frames were produced")
+    xing_len = len(xing_frame(header, 0, 0, bytes(100), lame))
+    nbytes = xing_len + sum(lengths)
+    toc, pos, at = bytearray(), xing_len, 0
+    for i in range(100):   # byte position of each percent of the frames, in 1/256ths of the file
+        target = i * len(lengths) // 100
+        while at < target:
+            pos += lengths[at]
+            at += 1
+        toc.append(min(255, pos * 256 // nbytes))
+
+    tmp = dst + ".part"
+    with open(tmp, "wb") as out:
+        out.write(xing_frame(header, len(lengths), nbytes, bytes(toc), lame))
+        for path, lo, hi in pieces:
+            with open(path, "rb") as f:
+                f.seek(lo)
+                left = hi - lo
+                while left > 0:
+                    chunk = f.read(min(CHUNK, left))
+                    if not chunk:
+                        raise RuntimeError(f"{path} shrank while being joined")
+                    out.write(chunk)
+                    left -= len(chunk)
+    os.replace(tmp, dst)
+
+
+def add_xing(src: str, dst: str):
+    """Copy the MP3 `src` to `dst` with a Xing header in front. ffmpeg can only write one into
+    a seekable output, so e.g. an encode written to a pipe has none, and players then guess the
+    duration of a VBR file from its first frames."""
+    offsets, lengths, header = frames(src)
+    if offsets and lame_tag(_read(src, offsets[0], lengths[0])) is not None:
+        offsets, lengths = offsets[1:], lengths[1:]   # it has one already: replace it
+    pieces = [(src, offsets[0], offsets[-1] + lengths[-1])] if offsets else []
+    _join(pieces, lengths, header, None, dst)
+
+
+def _read(path: str, offset: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def encode(ffmpeg: str, src: str, dst: str, quality: Sequence[str] = (), workers: int = 0,
+           min_duration: float = 0.0, duration: Optional[float] = None, rate: Optional[int] = None,
+           progress: Optional[Callable[[float], None]] = None) -> Optional[float]:
+    """Encode the first audio stream of `src` to the MP3 file `dst`, in up to `workers` segments
+    at once (default: all cores). `quality`: LAME options for ffmpeg (e.g. ["-q:a", "5"]).
+    `duration` / `rate` of the source are probed unless given. `progress` is called (from any
+    thread) with the seconds of the source encoded so far, all segments together. Returns the
+    CPU seconds all ffmpeg processes used together (None where unknown). Raises RuntimeError
+    on failure."""
+    workers = workers or os.cpu_count() or 1
+    if duration is None or rate is None:
+        d, r = probe(ffmpeg, src)
+        duration, rate = duration or d, rate or r
+    base = [ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y"]
+    if workers < 2 or not duration or duration < min_duration:
+        return _run(base + ["-i", src, "-map", "0:a:0", "-c:a", "libmp3lame", *quality, "-f", "mp3", dst], progress)
+
+    rate = out_rate(rate)
+    per_frame = 1152 if rate >= 32000 else 576
+    parts = segments(duration, rate, workers)
+    work = tempfile.mkdtemp(prefix=".mp3-", dir=os.path.dirname(os.path.abspath(dst)))
+    paths = [os.path.join(work, f"{i:03d}.mp3") for i in range(len(parts))]
+    done = [0.0] * len(parts)   # seconds each segment has encoded (with its preroll: near enough)
+
+    def seg_progress(i: int) -> Optional[Callable[[float], None]]:
+        if progress is None:
+            return None
+
+        def on_time(t: float):
+            done[i] = t
+            progress(sum(done))
+        return on_time
+
+    try:
+        def run(i: int) -> Optional[float]:
+            first, end = parts[i]
+            start = max(0, first - PREROLL)
+            args = list(base)
+            if start:
+                args += ["-ss", f"{start * per_frame / rate:.6f}"]
+            args += ["-i", src]
+            if end is not None:
+                args += ["-t", f"{(end + PREROLL - start) * per_frame / rate:.6f}"]
+            args += ["-map", "0:a:0", "-ar", str(rate), "-c:a", "libmp3lame", *quality, "-reservoir", "0",
+                     # only the last segment's info frame is of use (its end padding)
+                     "-write_xing", "1" if end is None else "0", "-id3v2_version", "0", "-f", "mp3", paths[i]]
+            return _run(args, seg_progress(i))
+
+        with ThreadPoolExecutor(max_workers=len(parts)) as pool:   # each thread waits on its ffmpeg
+            cpus = list(pool.map(run, range(len(parts))))
+
+        # which byte ranges of which segment file make up the result
+        pieces, lengths, header, lame = [], [], b"", None
+        for i, (first, end) in enumerate(parts):
+            offsets, lens, h = frames(paths[i])
+            if end is None and offsets:
+                lame = lame_tag(_read(paths[i], offsets[0], lens[0]))
+                if lame is not None:
+                    offsets, lens = offsets[1:], lens[1:]
+            skip = first - max(0, first - PREROLL)
+            keep = slice(skip, None if end is None else skip + end - first)
+            offsets, lens = offsets[keep], lens[keep]
+            if offsets:
+                pieces.append((paths[i], offsets[0], offsets[-1] + lens[-1]))
+                lengths += lens
+                header = header or h
+        _join(pieces, lengths, header, lame, dst)
+    finally:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        try:
+            os.rmdir(work)
+        except OSError:
+            pass
+    return sum(cpus) if None not in cpus else None
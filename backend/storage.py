@@ -0,0 +1,185 @@
+"""
+Where finished artifacts live (STORAGE_BACKEND=local | s3).
+
+Conversions always run in a local scratch directory (the job directory under TMP_DIR); the
+finished file is then handed to the backend under its key, the same relative path that is
+stored in Video.path / CacheEntry.path (store/ab/cd/<job id>/audio.mp3).
+
+- LocalStorage keeps artifacts where the job left them, under TMP_DIR. Downloads are served
+  by app.py itself (or the front proxy, see FILE_SERVING).
+- S3Storage uploads them to an S3-compatible bucket (AWS, MinIO, Ceph, R2, ...) with multipart
+  uploads for large files, and downloads are redirects to presigned GET URLs. Any number of
+  app nodes can then share one bucket.
+
+Kept free of any app.py imports.
+"""
+import abc, os
+from urllib.parse import quote
+from typing import Iterator, Optional, Tuple
+
+CHUNK = 64 * 1024
+
+
+class Storage(abc.ABC):
+    local = True   # artifacts are files under `root` that can be sent directly
+
+    @abc.abstractmethod
+    def put(self, key: str, src: str, content_type: Optional[str] = None) -> int:
+        """Take over the finished local file `src` as `key` (src is gone afterwards). Returns its size."""
+
+    @abc.abstractmethod
+    def stat(self, key: str) -> Optional[Tuple[int, float]]:
+        """(size, mtime) of `key`, None if it doesn't exist."""
+
+    def size(self, key: str) -> Optional[int]:
+        st = self.stat(key)
+        return st[0] if st else None
+
+    def exists(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        """Remove `key`; a missing key is not an error."""
+
+    @abc.abstractmethod
+    def read(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        """Yield bytes [start, end) of `key`."""
+
+    def path(self, key: str) -> Optional[str]:
+        """Local file of `key` (local backends only)."""
+        return None
+
+    def url(self, key: str, filename: str, content_type: str, expires: int) -> Optional[str]:
+        """Time-limited URL the client can fetch `key` from directly (remote backends only)."""
+        return None
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def put(self, key: str, src: str, content_type: Optional[str] = None) -> int:
+        dst = self.path(key)
+        if os.path.abspath(src) != os.path.abspath(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+        return os.path.getsize(dst)
+
+    def stat(self, key: str) -> Optional[Tuple[int, float]]:
+        try:
+            st = os.stat(self.path(key))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def read(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            left = end - start
+            while left > 0:
+                chunk = f.read(min(CHUNK, left))
+                if not chunk:
+                    return
+                left -= len(chunk)
+                yield chunk
+
+
+class S3Storage(Storage):
+    local = False
+    MIN_PART = 5 * 1024 * 1024   # S3's minimum size for every part but the last
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, part_size: int = 16 * 1024 * 1024, client=None):
+        if client is None:
+            import boto3   # only needed for this backend
+            from botocore.config import Config
+            client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None,
+                                  config=Config(signature_version="s3v4",
+                                                # MinIO & co. usually don't do virtual-hosted buckets
+                                                s3={"addressing_style": "path" if endpoint_url else "auto"},
+                                                retries={"max_attempts": 5, "mode": "standard"}))
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.part_size = max(part_size, self.MIN_PART)
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key.replace(os.sep, "/")
+
+    def _missing(self, e: Exception) -> bool:
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, key: str, src: str, content_type: Optional[str] = None) -> int:
+        size = os.path.getsize(src)
+        extra = {"ContentType": content_type} if content_type else {}
+        with open(src, "rb") as f:
+            if size <= self.part_size:
+                self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=f, **extra)
+            else:
+                self._multipart(key, f, extra)
+        os.remove(src)
+        return size
+
+    def _multipart(self, key: str, f, extra: dict):
+        """Upload in part_size pieces: memory stays at one part, and a failed part is retried by
+        botocore on its own instead of restarting the whole file."""
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self._key(key), **extra)["UploadId"]
+        parts = []
+        try:
+            while True:
+                data = f.read(self.part_size)
+                if not data:
+                    break
+                n = len(parts) + 1
+                r = self.client.upload_part(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                            PartNumber=n, Body=data)
+                parts.append({"PartNumber": n, "ETag": r["ETag"]})
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except BaseException:
+            # otherwise the uploaded parts linger (and are billed) until a lifecycle rule reaps them
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id)
+            except Exception:
+                pass
+            raise
+
+    def stat(self, key: str) -> Optional[Tuple[int, float]]:
+        try:
+            r = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception as e:
+            if self._missing(e):
+                return None
+            raise
+        return r["ContentLength"], r["LastModified"].timestamp()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def read(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        if end <= start:
+            return
+        r = self.client.get_object(Bucket=self.bucket, Key=self._key(key), Range=f"bytes={start}-{end - 1}")
+        body = r["Body"]
+        try:
+            yield from body.iter_chunks(CHUNK)
+        finally:
+            body.close()
+
+    def url(self, key: str, filename: str, content_type: str, expires: int) -> str:
+        return self.client.generate_presigned_url("get_object", ExpiresIn=expires, Params={
+            "Bucket": self.bucket, "Key": self._key(key),
+            "ResponseContentType": content_type,
+            "ResponseContentDisposition": f"attachment; filename*=utf-8''{quote(filename)}",
+        })
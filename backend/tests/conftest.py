@@ -0,0 +1,4 @@
+import os, sys
+
+# the backend modules are plain top-level modules next to app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,128 @@
+"""
+S3Storage against moto's in-memory S3 (the same API MinIO & co. speak).
+
+    pip install -r requirements-dev.txt && python -m pytest tests
+"""
+import os
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+requests = pytest.importorskip("requests")
+
+from storage import S3Storage
+
+BUCKET = "artifacts"
+PART = S3Storage.MIN_PART
+
+
+@pytest.fixture
+def store(monkeypatch):
+    for name, value in (("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        store = S3Storage(BUCKET, prefix="/media/", region="us-east-1", part_size=PART)   # its own client
+        store.client.create_bucket(Bucket=BUCKET)
+        yield store
+
+
+@pytest.fixture
+def s3(store):
+    return store.client
+
+
+def _file(tmp_path, size: int, name: str = "audio.mp3") -> str:
+    path = tmp_path / name
+    path.write_bytes(bytes(i % 251 for i in range(size)))
+    return str(path)
+
+
+def _calls(monkeypatch, client, *names):
+    calls = []
+    for name in names:
+        real = getattr(client, name)
+        monkeypatch.setattr(client, name, lambda *a, _n=name, _f=real, **k: (calls.append(_n), _f(*a, **k))[1])
+    return calls
+
+
+def test_put_single_part(store, s3, tmp_path, monkeypatch):
+    src = _file(tmp_path, 1000)
+    data = open(src, "rb").read()
+    calls = _calls(monkeypatch, s3, "put_object", "create_multipart_upload")
+    assert store.put(os.path.join("store", "ab", "audio.mp3"), src, "audio/mpeg") == 1000
+    assert calls == ["put_object"]
+    assert not os.path.exists(src)
+    obj = s3.get_object(Bucket=BUCKET, Key="media/store/ab/audio.mp3")
+    assert obj["ContentType"] == "audio/mpeg"
+    assert obj["Body"].read() == data
+
+
+def test_put_multipart(store, s3, tmp_path, monkeypatch):
+    size = 2 * PART + 123
+    src = _file(tmp_path, size)
+    data = open(src, "rb").read()
+    calls = _calls(monkeypatch, s3, "put_object", "upload_part", "complete_multipart_upload")
+    assert store.put("store/ab/audio.mp3", src, "audio/mpeg") == size
+    assert calls == ["upload_part"] * 3 + ["complete_multipart_upload"]
+    assert not os.path.exists(src)
+    assert store.stat("store/ab/audio.mp3")[0] == size
+    assert b"".join(store.read("store/ab/audio.mp3", 0, size)) == data
+    assert s3.head_object(Bucket=BUCKET, Key="media/store/ab/audio.mp3")["ContentType"] == "audio/mpeg"
+
+
+def test_multipart_aborted_on_failure(store, s3, tmp_path, monkeypatch):
+    src = _file(tmp_path, 2 * PART + 1)
+    real = s3.upload_part
+
+    def flaky(**kw):
+        if kw["PartNumber"] == 2:
+            raise ConnectionError("connection reset")
+        return real(**kw)
+
+    monkeypatch.setattr(s3, "upload_part", flaky)
+    with pytest.raises(ConnectionError):
+        store.put("store/ab/audio.mp3", src)
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get("Uploads")
+    assert store.stat("store/ab/audio.mp3") is None
+    assert os.path.exists(src)   # still there to retry from
+
+
+def test_ranged_read(store, tmp_path):
+    src = _file(tmp_path, 300 * 1024)
+    data = open(src, "rb").read()
+    store.put("k", src)
+    assert b"".join(store.read("k", 0, len(data))) == data
+    assert b"".join(store.read("k", 1000, 70000)) == data[1000:70000]
+    assert b"".join(store.read("k", len(data) - 1, len(data))) == data[-1:]
+    assert b"".join(store.read("k", 5, 5)) == b""
+
+
+def test_stat_and_delete(store, tmp_path):
+    assert store.stat("k") is None
+    assert not store.exists("k")
+    store.put("k", _file(tmp_path, 42))
+    size, mtime = store.stat("k")
+    assert size == 42 and mtime > 0
+    assert store.size("k") == 42
+    store.delete("k")
+    assert store.stat("k") is None
+    store.delete("k")   # missing is fine
+
+
+def test_url(store, tmp_path):
+    src = _file(tmp_path, 2048)
+    data = open(src, "rb").read()
+    store.put("store/ab/audio.mp3", src)
+    url = store.url("store/ab/audio.mp3", "Mein Lied.mp3", "audio/mpeg", 600)
+    parsed = urlparse(url)
+    q = parse_qs(parsed.query)
+    assert parsed.path.endswith("/media/store/ab/audio.mp3")
+    assert q["X-Amz-Expires"] == ["600"]
+    assert q["response-content-type"] == ["audio/mpeg"]
+    assert q["response-content-disposition"] == ["attachment; filename*=utf-8''Mein%20Lied.mp3"]
+    r = requests.get(url)
+    assert r.status_code == 200
+    assert r.content == data
+    assert r.headers["Content-Disposition"] == "attachment; filename*=utf-8''Mein%20Lied.mp3"
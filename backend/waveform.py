@@ -0,0 +1,167 @@
+"""
+Waveform peaks for the UI (GET /peaks/{file_id}, see app.py).
+
+`compute` has ffmpeg decode an audio file to mono 16-bit PCM at RATE Hz (`save` takes that PCM
+from an ffmpeg run that is decoding anyway) and reduces it with NumPy, one chunk at a time (memory stays at CHUNK samples however long the file is), to the
+(min, max) sample of every BASE samples. Each further zoom level merges FACTOR peaks of the
+one before, down to a few hundred peaks for the whole file, so a client can draw any width
+without touching the audio.
+
+File format (little-endian):
+
+    header   b"PEAK", version u8, bits u8 (8), levels u16, sample rate u32, samples u64
+    levels   per level: samples per peak u32, peaks u32, data offset u32
+    data     per level: peaks x (min i8, max i8), i.e. the 16-bit samples >> 8
+
+Kept free of any app.py imports.
+"""
+import os, struct, subprocess
+from typing import List, Optional, Tuple
+
+RATE = 22050        # decode rate; peaks don't need more
+BASE = 256          # samples per peak of level 0 (~86 peaks a second)
+FACTOR = 4          # each level has 1/FACTOR of the peaks of the one before
+MIN_PEAKS = 256     # the coarsest level has at least this many (unless level 0 has fewer)
+CHUNK = BASE * 4096
+MAGIC, VERSION = b"PEAK", 1
+_HEAD = struct.Struct("<4sBBHIQ")
+_LEVEL = struct.Struct("<III")
+
+
+def _reduce(mins, maxs, factor: int):
+    """Merge every `factor` (min, max) pairs; a short last group is merged on its own."""
+    import numpy as np
+    pad = -len(mins) % factor
+    if pad:
+        mins = np.concatenate([mins, np.full(pad, mins[-1], mins.dtype)])
+        maxs = np.concatenate([maxs, np.full(pad, maxs[-1], maxs.dtype)])
+    return mins.reshape(-1, factor).min(axis=1), maxs.reshape(-1, factor).max(axis=1)
+
+
+def _pcm_peaks(stream) -> Tuple[object, object, int]:
+    """(mins, maxs, samples) of level 0 from a stream of s16le mono samples."""
+    import numpy as np
+    mins: List[object] = []
+    maxs: List[object] = []
+    samples, rest = 0, b""
+    while True:
+        data = stream.read(CHUNK * 2)
+        if not data:
+            break
+        data = rest + data
+        usable = len(data) // (BASE * 2) * (BASE * 2)
+        rest = data[usable:]
+        if usable:
+            block = np.frombuffer(data[:usable], dtype="<i2").reshape(-1, BASE)
+            mins.append(block.min(axis=1))
+            maxs.append(block.max(axis=1))
+            samples += usable // 2
+    if len(rest) >= 2:   # the last, shorter block
+        tail = np.frombuffer(rest[:len(rest) // 2 * 2], dtype="<i2")
+        mins.append(tail.min(keepdims=True))
+        maxs.append(tail.max(keepdims=True))
+        samples += len(tail)
+    if not mins:
+        return np.zeros(0, "<i2"), np.zeros(0, "<i2"), 0
+    return np.concatenate(mins), np.concatenate(maxs), samples
+
+
+def build(mins, maxs, samples: int) -> bytes:
+    """The peaks file for level-0 `mins` / `maxs` (int16 arrays) of `samples` samples."""
+    import numpy as np
+    levels = [(BASE, mins, maxs)]
+    while len(levels[-1][1]) >= MIN_PEAKS * FACTOR:
+        spp, lo, hi = levels[-1]
+        levels.append((spp * FACTOR, *_reduce(lo, hi, FACTOR)))
+    offset = _HEAD.size + _LEVEL.size * len(levels)
+    table, data = [], []
+    for spp, lo, hi in levels:
+        pairs = np.empty(len(lo) * 2, dtype=np.int8)
+        pairs[0::2] = lo >> 8
+        pairs[1::2] = hi >> 8
+        table.append(_LEVEL.pack(spp, len(lo), offset))
+        data.append(pairs.tobytes())
+        offset += len(pairs)
+    return _HEAD.pack(MAGIC, VERSION, 8, len(levels), RATE, samples) + b"".join(table) + b"".join(data)
+
+
+def pcm_args() -> List[str]:
+    """ffmpeg output options for the PCM `save` reads (after the output's -map)."""
+    return ["-ac", "1", "-ar", str(RATE), "-f", "s16le"]
+
+
+def available() -> bool:
+    try:
+        import numpy   # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def save(stream, dst: str):
+    """Write the peaks file of the PCM (see pcm_args) read from `stream` to `dst`, reading it to
+    the end. Raises RuntimeError if there was none."""
+    mins, maxs, samples = _pcm_peaks(stream)
+    if not samples:
+        raise RuntimeError("no audio")
+    tmp = dst + ".part"
+    with open(tmp, "wb") as f:
+        f.write(build(mins, maxs, samples))
+    os.replace(tmp, dst)
+
+
+def compute(ffmpeg: str, src: str, dst: str) -> Optional[float]:
+    """Write the peaks file of the audio file `src` to `dst`. Returns ffmpeg's CPU seconds
+    (None where unknown). Raises RuntimeError if ffmpeg fails, ImportError without NumPy."""
+    import numpy   # noqa: F401  (fail before starting ffmpeg)
+    args = [ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", src, "-map", "0:a:0",
+            *pcm_args(), "pipe:1"]
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        mins, maxs, samples = _pcm_peaks(proc.stdout)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+    err = proc.stderr.read().decode(errors="replace")
+    cpu = None
+    if hasattr(os, "wait4"):
+        _, status, ru = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        cpu = ru.ru_utime + ru.ru_stime
+    if proc.wait() != 0 or not samples:
+        raise RuntimeError(err.strip()[-500:] or f"ffmpeg exited with {proc.returncode}")
+    tmp = dst + ".part"
+    with open(tmp, "wb") as f:
+        f.write(build(mins, maxs, samples))
+    os.replace(tmp, dst)
+    return cpu
+
+
+def parse_header(head: bytes) -> Tuple[int, int, List[Tuple[int, int, int]]]:
+    """(sample rate, samples, [(samples per peak, peaks, data offset)] per level) from the
+    start of a peaks file (header_size(levels) bytes; HEADER_MAX always suffice)."""
+    if len(head) < _HEAD.size:
+        raise ValueError("not a peaks file")
+    magic, version, bits, n, rate, samples = _HEAD.unpack_from(head)
+    if magic != MAGIC or version != VERSION or bits != 8 or len(head) < header_size(n):
+        raise ValueError("not a peaks file")
+    return rate, samples, [_LEVEL.unpack_from(head, _HEAD.size + i * _LEVEL.size) for i in range(n)]
+
+
+def header_size(levels: int) -> int:
+    return _HEAD.size + _LEVEL.size * levels
+
+
+HEADER_MAX = header_size(32)   # 4**32 samples per peak: more levels than any file can have
+
+
+def pick_level(levels: List[Tuple[int, int, int]], width: int) -> int:
+    """Index of the coarsest level with at least `width` peaks (else the finest)."""
+    best = 0
+    for i, (_, peaks, _) in enumerate(levels):
+        if peaks >= width:
+            best = i
+    return best
+
@@ -0,0 +1,165 @@
+"""
+Embedded yt-dlp engine (JOB_ENGINE=inprocess).
+
+Runs inside long-lived worker processes started by app.py. yt-dlp and all of its extractor
+classes are imported once per process in `init`, and the YoutubeDL instances are kept and
+reused for every job that process handles, so a job no longer pays for an interpreter start
+and a full extractor import.
+
+Kept free of any app.py imports: spawned workers import this module by name, and importing
+app.py there would re-run the DB setup.
+"""
+import os, time
+from typing import Dict, List, Optional, Tuple
+
+_base_opts: Dict = {}
+_ydls: Dict[Tuple[str, str, str], object] = {}   # (audio format, quality, format selector) -> YoutubeDL
+_events = None                              # multiprocessing.Queue back to the parent, or None
+_current_tag: Optional[str] = None          # job id of the conversion running in this process
+_last_emit = 0.0
+
+
+def init(ffmpeg_location: Optional[str] = None, no_check_certs: bool = False, extra_opts: Optional[Dict] = None,
+         events=None):
+    """Process initializer: import yt-dlp and load its extractors up front. Progress of every
+    job is sent to `events` as (tag, stage, fields) tuples."""
+    global _base_opts, _events
+    _events = events
+    try:
+        import certifi
+        os.environ.setdefault("SSL_CERT_FILE", certifi.where())
+    except Exception:
+        pass
+    from yt_dlp.extractor import gen_extractor_classes
+    gen_extractor_classes()   # extractors are imported lazily otherwise, i.e. on the first job
+
+    _base_opts = {
+        "format": "bestaudio/best",
+        "quiet": True,
+        "noprogress": True,
+        "noplaylist": True,
+    }
+    if ffmpeg_location:
+        _base_opts["ffmpeg_location"] = ffmpeg_location
+    if no_check_certs:
+        _base_opts["nocheckcertificate"] = True
+    if extra_opts:
+        _base_opts.update(extra_opts)
+
+
+def warm(fmt: str, quality: str, selector: str = "bestaudio/best") -> int:
+    """Spawn/warm a worker: builds the YoutubeDL instance the first real job will reuse."""
+    _get_ydl(fmt, quality, selector)
+    return os.getpid()
+
+
+def _get_ydl(fmt: str, quality: str, selector: str = "bestaudio/best"):
+    ydl = _ydls.get((fmt, quality, selector))
+    if ydl is None:
+        from yt_dlp import YoutubeDL
+        opts = dict(_base_opts)
+        opts["format"] = selector
+        opts["outtmpl"] = {"default": "%(title)s.%(ext)s"}
+        opts["postprocessors"] = [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": fmt,
+            "preferredquality": quality,
+        }]
+        opts["progress_hooks"] = [_on_download]
+        opts["postprocessor_hooks"] = [_on_postprocess]
+        ydl = _ydls[(fmt, quality, selector)] = YoutubeDL(opts)
+    return ydl
+
+
+def _emit(stage: str, **fields):
+    if _events is not None and _current_tag is not None:
+        try:
+            _events.put_nowait((_current_tag, stage, fields))
+        except Exception:
+            pass
+
+
+def _on_download(d: Dict):
+    global _last_emit
+    if d.get("status") == "downloading" and time.monotonic() - _last_emit >= 0.25:
+        _last_emit = time.monotonic()
+        _emit("downloading", downloaded_bytes=d.get("downloaded_bytes"),
+              total_bytes=d.get("total_bytes") or d.get("total_bytes_estimate"),
+              eta=d.get("eta"), speed=d.get("speed"))
+
+
+def _on_postprocess(d: Dict):
+    if d.get("status") == "started":
+        _emit("converting", postprocessor=d.get("postprocessor"))
+
+
+def _cpu() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:   # Windows
+        return None
+    own, kids = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime
+
+
+def convert(outtmpl: str, url: str, fmt: str, quality: str, tag: Optional[str] = None,
+            info_path: Optional[str] = None, clip: Optional[Tuple[float, Optional[float]]] = None,
+            selector: str = "bestaudio/best") -> Optional[float]:
+    """Download `url` and extract audio to `outtmpl` (same semantics as `yt-dlp -f selector -x
+    -o`); with `info_path`, from that already extracted info JSON instead (`--load-info-json`);
+    with `clip` (start, end or None), only that time range (`--download-sections`).
+    Returns the CPU seconds used by this process and its ffmpeg children for the job (one job
+    per process at a time, so the difference is this job's alone).
+    Raises RuntimeError with yt-dlp's message on failure (yt-dlp's own exceptions don't
+    always survive pickling back to the parent)."""
+    global _current_tag
+    cpu0 = _cpu()
+    ydl = _get_ydl(fmt, quality, selector)
+    ydl.params["outtmpl"]["default"] = outtmpl
+    if clip:
+        from yt_dlp.utils import download_range_func
+        end = float("inf") if clip[1] is None else clip[1]
+        ydl.params["download_ranges"] = download_range_func(None, [(clip[0], end)])
+    _current_tag = tag
+    try:
+        if info_path:
+            ydl.download_with_info_file(info_path)
+        else:
+            ydl.download([url])
+        return _cpu() - cpu0 if cpu0 is not None else None
+    except Exception as e:
+        raise RuntimeError(str(e) or e.__class__.__name__) from None
+    finally:
+        _current_tag = None
+        ydl.params.pop("download_ranges", None)   # the instance is shared by the next job
+
+
+def probe(url: str) -> Dict:
+    """Extract a single video's info without downloading anything (`yt-dlp -J --skip-download`).
+    Returns yt-dlp's sanitized info dict, ready for json.dumps."""
+    from yt_dlp import YoutubeDL
+    opts = dict(_base_opts)
+    opts["skip_download"] = True
+    try:
+        with YoutubeDL(opts) as ydl:
+            return ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise RuntimeError(str(e) or e.__class__.__name__) from None
+
+
+def extract_flat(url: str) -> List[Dict]:
+    """Flat playlist extraction: list the entries of `url` without resolving each video.
+    Returns plain dicts (id, url, title) so they pickle back to the parent."""
+    from yt_dlp import YoutubeDL
+    opts = dict(_base_opts)
+    opts.update({"extract_flat": "in_playlist", "noplaylist": False})
+    try:
+        with YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False, process=True) or {}
+    except Exception as e:
+        raise RuntimeError(str(e) or e.__class__.__name__) from None
+    entries = info.get("entries")
+    if entries is None:   # not a playlist: the URL itself is the only entry
+        entries = [info]
+    return [{"id": e.get("id"), "url": e.get("url") or e.get("webpage_url"), "title": e.get("title")}
+            for e in entries if e]
@@ -18,6 +18,10 @@ const escapeHtml = (s)=> (s||"").replace(/[&<>"']/g, c => (
 function isYtLink(u){
   return /^(https?:\/\/)?(www\.)?(youtube\.com|youtu\.be)\//i.test(u || "");
 }
+// playlist page or a list link without a specific video
+function isPlaylistLink(url){
+  return /[?&]list=/.test(url) && !/[?&]v=/.test(url);
+}
 function updateConvertEnabled(){
   const v = $("yt-url")?.value.trim() || "";
   if ($("btn-download")) $("btn-download").disabled = !isYtLink(v);
@@ -27,7 +31,7 @@ function updateConvertEnabled(){
 function statusClass(s = "") {
   const v = String(s).toLowerCase();
   if (v === "ready") return "st st-ready";
-  if (v === "processing" || v === "in progress") return "st st-progress";
+  if (v === "queued" || v === "processing" || v === "in progress") return "st st-progress";
   return "st st-other";
 }
 
@@ -110,8 +114,7 @@ async function api(path, options={}){
   const res = await fetch(API+path, {...options, headers});
 
   if (res.status === 401) {
-    for (const id of pollers.keys()){ clearInterval(pollers.get(id)); }
-    pollers.clear();
+    stopAllPollers(); disconnectLive(); dlUrls.clear(); urlTok = null;
     window.__token=""; username=""; isAdmin=false; fileId=null; filename=null;
     localStorage.removeItem("ytmp3_token");
     localStorage.removeItem("ytmp3_user");
@@ -127,6 +130,33 @@ async function api(path, options={}){
 }
 
 // robust file download
+// short-lived signed link from the API, so the session token never ends up in a URL;
+// /my_downloads hands them out with the list, one is only requested once that one runs out
+const dlUrls = new Map(); // id -> { url, exp } (exp in epoch seconds)
+const fresh = (exp)=> exp * 1000 - Date.now() > 30000;
+function rememberDownloadUrls(items){
+  for (const it of items) if (it.download_url) dlUrls.set(it.id, { url: it.download_url, exp: it.download_url_expires_at });
+}
+async function signedDownloadUrl(id){
+  let link = dlUrls.get(id);
+  if (!link || !fresh(link.exp)){
+    const { url, expires_at } = await api(`/download_url/${encodeURIComponent(id)}`, { method: "POST" });
+    link = { url, exp: expires_at };
+    dlUrls.set(id, link);
+  }
+  return `${API}${link.url}`;
+}
+
+// ?token= for EventSource / WebSocket URLs: a short-lived URL token, never the session token
+let urlTok = null; // { token, exp }
+async function urlToken(){
+  if (!urlTok || !fresh(urlTok.exp)){
+    const { token, expires_at } = await api("/url_token", { method: "POST" });
+    urlTok = { token, exp: expires_at };
+  }
+  return urlTok.token;
+}
+
 async function startDownload(url, suggestedName) {
   try {
     const a=document.createElement("a");
@@ -158,9 +188,17 @@ let fileId = null, filename = null;
 let __usersCache = [];
 let __downloadsCache = [];
 let __searchTerm = ""; // always lowercase
+let __pending = new Set(); // ids of visible queued/processing downloads
 
 // track active polling timers per file
-const pollers = new Map(); // id -> intervalId
+// (an EventSource on /events/{id}; an interval id when EventSource is unavailable)
+const pollers = new Map(); // id -> EventSource | intervalId
+function stopPoller(id){
+  const p = pollers.get(id);
+  if (p && typeof p.close === "function") p.close(); else clearInterval(p);
+  pollers.delete(id);
+}
+function stopAllPollers(){ for (const id of Array.from(pollers.keys())) stopPoller(id); }
 
 // ---------- Boot ----------
 async function boot(){
@@ -186,7 +224,7 @@ async function boot(){
         localStorage.setItem("ytmp3_user", username);
         localStorage.setItem("ytmp3_admin", String(isAdmin));
       }
-      initAppUI(); show("view-app");
+      initAppUI(); show("view-app"); connectLive();
       await Promise.all([loadDownloads(), loadUsersList()]);
       wireStaticHandlers();
       return;
@@ -217,7 +255,7 @@ async function handleLogin(e){
       localStorage.removeItem("ytmp3_admin");
     }
 
-    initAppUI(); show("view-app");
+    initAppUI(); show("view-app"); connectLive();
     $("yt-url") && ($("yt-url").value="");
     await Promise.all([loadDownloads(), loadUsersList()]);
   }catch(err){ text($("login-msg"),err.message); }
@@ -259,8 +297,7 @@ function wireStaticHandlers(){
   window.__wired = true;
 
   has("btn-logout") && $("btn-logout").addEventListener("click", ()=>{
-    for (const id of pollers.keys()){ clearInterval(pollers.get(id)); }
-    pollers.clear();
+    stopAllPollers(); disconnectLive();
     window.__token=""; username=""; isAdmin=false; fileId=null; filename=null;
     localStorage.removeItem("ytmp3_token");
     localStorage.removeItem("ytmp3_user");
@@ -337,8 +374,6 @@ function initAppUI(){
 async function loadDownloads(){
   const grid=$("myDownloadsGrid"); if(!grid) return;
   grid.innerHTML="<div class='dlCard'>Loading…</div>";
-  for (const id of pollers.keys()){ clearInterval(pollers.get(id)); }
-  pollers.clear();
 
   try{
     const showAll = isAdmin && $("toggle-all")?.checked;
@@ -346,6 +381,7 @@ async function loadDownloads(){
     const items = await api(endpoint);
 
     __downloadsCache = items || [];
+    rememberDownloadUrls(__downloadsCache);
     renderDownloads();
   }catch(e){
     grid.innerHTML=`<div class='dlCard'>${escapeHtml(e.message)}</div>`;
@@ -374,7 +410,8 @@ function renderDownloads(){
     const ts=new Date(it.timestamp).toLocaleString();
     const fname=it.filename||"(processing)";
     const ready = it.status==="ready";
-    const disabled = ready ? "" : "disabled";
+    const evicted = it.status==="evicted";   // file removed to free space; can be converted again
+    const disabled = ready || evicted ? "" : "disabled";
     const owner = showAll && it.owner_username && it.owner_username!==username ? ` • by ${escapeHtml(it.owner_username)}` : "";
     const allowDelete = (it.owner_username ? (it.owner_username===username || isAdmin) : true);
     const delDisabled = allowDelete ? "" : "disabled";
@@ -388,50 +425,153 @@ function renderDownloads(){
           </span>${owner}
         </div>
         <div class="btnRow">
-          <button type="button" class="btnSmall primary js-download" data-id="${it.id}" data-fname="${encodeURIComponent(fname)}" ${disabled}>Download</button>
+          <button type="button" class="btnSmall primary ${evicted ? "js-restore" : "js-download"}" data-id="${it.id}" data-fname="${encodeURIComponent(fname)}" ${disabled}>${evicted ? "Restore" : "Download"}</button>
           <button type="button" class="btnSmall js-delete"   data-id="${it.id}" ${delDisabled}>Delete</button>
         </div>
       </div>`;
   }).join("");
 
   // (no .js-status buttons anymore)
-  grid.querySelectorAll(".js-download").forEach(b => b.addEventListener("click", () => {
-    const url = `${API}/download/${encodeURIComponent(b.dataset.id)}?token=${encodeURIComponent(window.__token||"")}`;
+  grid.querySelectorAll(".js-download").forEach(b => b.addEventListener("click", async () => {
     const fname = b.dataset.fname ? decodeURIComponent(b.dataset.fname) : "download.mp3";
-    startDownload(url, fname);
+    try { startDownload(await signedDownloadUrl(b.dataset.id), fname); } catch(e){ alert(e.message); }
   }));
+  grid.querySelectorAll(".js-restore").forEach(b => b.addEventListener("click", () => restoreOne(b.dataset.id)));
   grid.querySelectorAll(".js-delete").forEach(b => b.addEventListener("click", () => deleteOne(b.dataset.id)));
 
-  // restart pollers for non-ready items currently visible
-  for (const id of pollers.keys()){ clearInterval(pollers.get(id)); }
-  pollers.clear();
-  items.filter(x => x.status !== "ready").forEach(x => startPoller(x.id));
+  // keep one live stream per non-ready item currently visible (open streams are reused)
+  __pending = new Set(items.filter(x => x.status === "queued" || x.status === "processing").map(x => x.id));
+  for (const id of Array.from(pollers.keys())) if (!__pending.has(id)) stopPoller(id);
+  __pending.forEach(startPoller);
+}
+
+
+// live progress label in the downloads grid, e.g. "downloading 42%"
+function showProgress(id, st){
+  const el = document.getElementById(`st-${id}`);
+  if (!el || !st || st.status === "ready" || st.status === "error") return;
+  const stage = st.stage && st.stage !== "starting" ? st.stage : st.status;
+  const live = st.stage === "downloading" || st.stage === "converting";
+  const pct = live && st.percent != null ? ` ${Math.round(st.percent)}%` : "";
+  const eta = live && st.eta != null ? `, ${st.eta < 60 ? `${st.eta}s` : `${Math.round(st.eta / 60)} min`} left` : "";
+  el.textContent = `${stage}${pct}${eta}`;
+}
+
+async function onJobFinished(id, st){
+  await loadDownloads();
+  if (st.status === "error"){
+    if (fileId === id) text($("app-msg"), st.error || "Download failed");
+    return;
+  }
+  if (fileId === id){
+    filename = st.filename || filename;
+    $("btn-get") && ($("btn-get").disabled = false);
+    const ok = $("app-ok");
+    if (ok){
+      ok.textContent = "The link is ready for the download.";
+      ok.classList.remove("hidden");
+      ok.classList.add("flash-green");
+      setTimeout(()=> ok.classList.remove("flash-green"), 1500);
+    }
+  }
+}
+
+// ---------- Live updates ----------
+// One WebSocket per session carries every state change of the user's downloads; it resumes
+// from the last seen seq after a reconnect. Per-item streams (startPoller) are only used while
+// the socket is down.
+let sock = null, sockEpoch = null, sockCursor = null, sockRetry = 0, sockTimer = null, sockReload = null;
+const sockLive = () => !!sock && sock.readyState === WebSocket.OPEN;
+
+async function connectLive(){
+  if (!window.WebSocket || !window.__token || sock) return;
+  clearTimeout(sockTimer);
+  const slot = sock = { close(){} }; // taken while the URL token is fetched
+  let tok;
+  try { tok = await urlToken(); }
+  catch {
+    if (sock !== slot) return;
+    sock = null;
+    sockTimer = setTimeout(connectLive, Math.min(30000, 1000 * 2 ** sockRetry++));
+    return;
+  }
+  if (sock !== slot) return;         // logged out meanwhile
+  let qs = `token=${encodeURIComponent(tok)}`;
+  if (sockCursor != null) qs += `&cursor=${sockCursor}&epoch=${encodeURIComponent(sockEpoch||"")}`;
+  const s = new WebSocket(`${API.replace(/^http/, "ws")}/ws?${qs}`);
+  sock = s;
+  s.onopen = ()=>{ sockRetry = 0; stopAllPollers(); };
+  s.onmessage = (e)=>{ let m; try { m = JSON.parse(e.data); } catch { return; } onLiveMessage(m); };
+  s.onclose = ()=>{
+    if (sock !== s) return;           // replaced or logged out
+    sock = null;
+    if (!window.__token) return;
+    __pending.forEach(startPoller);
+    sockTimer = setTimeout(connectLive, Math.min(30000, 1000 * 2 ** sockRetry++));
+  };
+}
+
+function disconnectLive(){
+  clearTimeout(sockTimer);
+  const s = sock; sock = null; sockEpoch = null; sockCursor = null;
+  if (s) s.close();
+}
+
+function reloadSoon(){
+  clearTimeout(sockReload);
+  sockReload = setTimeout(loadDownloads, 300);
 }
 
+function onLiveMessage(m){
+  if (m.type === "hello"){
+    if (sockEpoch !== m.epoch || sockCursor == null){ sockEpoch = m.epoch; sockCursor = m.cursor; }
+    return;
+  }
+  if (m.seq != null) sockCursor = Math.max(sockCursor || 0, m.seq);
+  if (m.type === "resync"){ sockCursor = m.cursor; reloadSoon(); return; }
+  if (m.type === "created" || m.type === "deleted" || m.type === "evicted"){ reloadSoon(); return; }
+  if (m.type !== "progress") return;
+  showProgress(m.file_id, m);
+  if (m.status === "ready" || m.status === "error") onJobFinished(m.file_id, m);
+}
+
+// server pushes progress over SSE; falls back to polling /status without EventSource
+async function startPoller(id){
+  if (pollers.has(id) || sockLive()) return;
+  if (!window.EventSource){ startIntervalPoller(id); return; }
+  const slot = { close(){} };
+  pollers.set(id, slot);
+  let tok;
+  try { tok = await urlToken(); } catch { if (pollers.get(id) === slot) pollers.delete(id); return; }
+  if (pollers.get(id) !== slot) return; // stopped meanwhile
+  const es = new EventSource(`${API}/events/${encodeURIComponent(id)}?token=${encodeURIComponent(tok)}`);
+  es.onmessage = async (e)=>{
+    let st; try { st = JSON.parse(e.data); } catch { return; }
+    showProgress(id, st);
+    if (st.status === "ready" || st.status === "error"){
+      stopPoller(id);                 // before the server closes, so EventSource doesn't reconnect
+      await onJobFinished(id, st);
+    }
+  };
+  es.onerror = ()=>{
+    if (es.readyState !== EventSource.CLOSED) return;
+    stopPoller(id);
+    // e.g. its URL token ran out before a reconnect: again with a fresh one
+    if (__pending.has(id)) setTimeout(()=> startPoller(id), 3000);
+  };
+  pollers.set(id, es);
+}
 
-function startPoller(id){
-  if (pollers.has(id)) return;
+function startIntervalPoller(id){
   const int = setInterval(async ()=>{
     try{
       const st = await api(`/status/${id}`);
-      if (st && st.ready){
-        clearInterval(int);
-        pollers.delete(id);
-        await loadDownloads();
-
-        if (fileId === id){
-          const ok = $("app-ok");
-          if (ok){
-            ok.textContent = "The link is ready for the download.";
-            ok.classList.remove("hidden");
-            ok.classList.add("flash-green");
-            setTimeout(()=> ok.classList.remove("flash-green"), 1500);
-          }
-        }
+      if (st && (st.status === "error" || st.ready)){
+        stopPoller(id);
+        await onJobFinished(id, st.ready ? { ...st, status: "ready" } : st);
       }
     }catch{
-      clearInterval(int);
-      pollers.delete(id);
+      stopPoller(id);
     }
   }, 2500);
   pollers.set(id, int);
@@ -467,6 +607,13 @@ async function deleteOne(id){
   }catch(e){ alert(e.message); }
 }
 
+async function restoreOne(id){
+  try{
+    await api(`/restore/${id}`,{method:"POST"});
+    await loadDownloads();
+  }catch(e){ alert(e.message); }
+}
+
 // main controls
 async function onConvert(){
   clearText($("app-msg"));
@@ -486,23 +633,28 @@ async function onConvert(){
   $("btn-download") && ($("btn-download").disabled = true);
 
   try{
+    if (isPlaylistLink(url)){
+      // whole playlist -> one batch; items show up in the list as the server adds them
+      await api("/batch", { method: "POST", body: JSON.stringify({ playlist_url: url }) });
+      ok.textContent = "Playlist queued… its songs will appear below as they are added.";
+      await loadDownloads();
+      return;
+    }
+
     const data = await api("/download", {
       method: "POST",
       body: JSON.stringify({ url })
     });
 
     fileId   = data.file_id;
-    filename = data.filename;
+    filename = null;
 
-    // ✅ conversion finished -> show success now
-    ok.classList.remove("flash-info");
-    ok.textContent = "The link is ready for the download.";
-    ok.classList.add("flash-green");
-    setTimeout(()=> ok.classList.remove("flash-green"), 1500);
+    // job is queued on the server -> the poller flips the message once it's ready
+    ok.textContent = "Queued… you can keep working, we'll tell you when it's ready.";
 
-    $("btn-get") && ($("btn-get").disabled = false);
-    startPoller(fileId);       // harmless if already ready
+    $("btn-get") && ($("btn-get").disabled = true);
     await loadDownloads();
+    startPoller(fileId);
   }catch(e){
     text($("app-msg"), e.message);
   }finally{
@@ -523,8 +675,7 @@ async function onCheckStatus(){
 async function onGetDirect(){
   clearText($("app-msg")); clearText($("app-ok"));
   if(!fileId||!filename){ text($("app-msg"),"Nothing to download yet."); return; }
-  const url = `${API}/download/${encodeURIComponent(fileId)}?token=${encodeURIComponent(window.__token||"")}`;
-  try { await startDownload(url, filename); } catch(e){ text($("app-msg"), e.message); }
+  try { await startDownload(await signedDownloadUrl(fileId), filename); } catch(e){ text($("app-msg"), e.message); }
 }
 
 // ---------- Users sidebar + drawer ----------
@@ -648,11 +799,10 @@ function renderSearchResults(){
     });
   });
   box.querySelectorAll("[data-dla]").forEach(el=>{
-    el.addEventListener("click", ()=>{
+    el.addEventListener("click", async ()=>{
       const id = el.getAttribute("data-dla");
       const fname = el.getAttribute("data-fname") ? decodeURIComponent(el.getAttribute("data-fname")) : "download.mp3";
-      const url = `${API}/download/${encodeURIComponent(id)}?token=${encodeURIComponent(window.__token||"")}`;
-      startDownload(url, fname);
+      try { startDownload(await signedDownloadUrl(id), fname); } catch(e){ alert(e.message); }
     });
   });
 }
@@ -691,10 +841,9 @@ async function openUserDrawer(targetUser){
         }).join("");
 
     const body = $("drawerBody");
-    body.querySelectorAll(".js-u-dl").forEach(b => b.addEventListener("click", ()=>{
-      const url = `${API}/download/${encodeURIComponent(b.dataset.id)}?token=${encodeURIComponent(window.__token||"")}`;
+    body.querySelectorAll(".js-u-dl").forEach(b => b.addEventListener("click", async ()=>{
       const fname = b.dataset.fname ? decodeURIComponent(b.dataset.fname) : "download.mp3";
-      startDownload(url, fname);
+      try { startDownload(await signedDownloadUrl(b.dataset.id), fname); } catch(e){ alert(e.message); }
     }));
   }catch(e){
     $("drawerBody").innerHTML=`<div class='dlCard'>${escapeHtml(e.message)}</div>`;